@@ -10,17 +10,22 @@ Lizi Liao (liaolizi.llz@gmail.com)
 I need to rewrite it to be adapted to non-sparse data
 
 '''
-import math
 import os
 import numpy as np
 import tensorflow as tf
 from sklearn.base import BaseEstimator, TransformerMixin
-from sklearn.metrics import mean_squared_error
 from sklearn.metrics import accuracy_score
-from sklearn.metrics import log_loss
 from time import time
 import argparse
+import asyncsgd
+import checkpoint
+import minibatch
+import tfdata
 import LoadData as DATA
+import inference
+from earlystopping import EarlyStopping
+from metrics import StreamingMetric
+from sparsify import csr_from_lists
 from tensorflow.contrib.layers.python.layers import batch_norm as batch_norm
 
 
@@ -53,6 +58,48 @@ def parse_args():
                         help='Show the results per X epochs (0, 1 ... any positive integer)')
     parser.add_argument('--batch_norm', type=int, default=0,
                         help='Whether to perform batch normaization (0 or 1)')
+    parser.add_argument('--cache_dir', nargs='?', default=None,
+                        help='Directory of the binary dataset cache. None: parse the text files on every run')
+    parser.add_argument('--hash_bits', type=int, default=0,
+                        help='Hash the feature entries into 2^hash_bits buckets instead of mapping them. 0: no hashing')
+    parser.add_argument('--vocab_file', nargs='?', default=None,
+                        help='File of the feature vocabulary, read if it exists and written otherwise. None: not saved')
+    parser.add_argument('--min_count', type=int, default=1,
+                        help='Features seen fewer times in the training set share the OOV rows')
+    parser.add_argument('--max_features', type=int, default=0,
+                        help='Keep at most the max_features most frequent training features. 0: no cap')
+    parser.add_argument('--oov_buckets', type=int, default=1,
+                        help='No. of rows shared by the pruned features. 0: the pruned features are dropped')
+    parser.add_argument('--stream', type=int, default=0,
+                        help='Whether to stream the training set from disk instead of loading it in memory (0 or 1)')
+    parser.add_argument('--shuffle_buffer', type=int, default=100000,
+                        help='No. of training rows shuffled together when streaming. 0: no shuffle')
+    parser.add_argument('--passes', type=int, default=1,
+                        help='No. of passes over the streamed training set per epoch')
+    parser.add_argument('--drop_last', type=int, default=1,
+                        help='Whether to drop the last partial batch of an epoch (0 or 1)')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='No. of training batches built ahead in a background thread. 0: no prefetch')
+    parser.add_argument('--tf_data', type=int, default=0,
+                        help='Whether to read the batches through a tf.data pipeline instead of feed_dict (0 or 1)')
+    parser.add_argument('--eval_batch_size', type=int, default=10000,
+                        help='No. of rows evaluated at a time')
+    parser.add_argument('--async_workers', type=int, default=0,
+                        help='No. of threads running Hogwild training steps concurrently. 0: synchronous steps')
+    parser.add_argument('--patience', type=int, default=4,
+                        help='No. of epochs without improvement of the validation result before training stops. 0: never stop')
+    parser.add_argument('--min_delta', type=float, default=0.0,
+                        help='Smallest change of the validation result counted as an improvement')
+    parser.add_argument('--restore_best', type=int, default=1,
+                        help='Whether to restore the weights of the best epoch at the end of training (0 or 1)')
+    parser.add_argument('--checkpoint_dir', nargs='?', default=None,
+                        help='Directory of the checkpoints the training is saved to and resumed from. None: no checkpoints')
+    parser.add_argument('--checkpoint_steps', type=int, default=0,
+                        help='No. of steps between two checkpoints within an epoch. 0: at the end of the epochs only')
+    parser.add_argument('--full_every', type=int, default=5,
+                        help='Write a full checkpoint every full_every checkpoints, the others hold the changed rows only')
+    parser.add_argument('--export', nargs='?', default=None,
+                        help='File to export the trained weights to, for the numpy inference. None: no export')
 
     return parser.parse_args()
 
@@ -60,7 +107,9 @@ def parse_args():
 class FM(BaseEstimator, TransformerMixin):
     def __init__(self, features_M, pretrain_flag, save_file, hidden_factor, loss_type, epoch, batch_size, learning_rate,
                  lambda_bilinear, keep,
-                 optimizer_type, batch_norm, verbose, random_seed=2016):
+                 optimizer_type, batch_norm, verbose, random_seed=2016, eval_batch_size=10000,
+                 drop_last=True, prefetch=2, tf_data=False, async_workers=0,
+                 patience=4, min_delta=0.0, restore_best=True):
         """
 
         :param features_M: No. of features in the input data
@@ -77,6 +126,15 @@ class FM(BaseEstimator, TransformerMixin):
         :param batch_norm:
         :param verbose:
         :param random_seed:
+        :param eval_batch_size: No. of rows fed at a time by evaluate
+        :param drop_last: drop the last partial batch of an epoch
+        :param prefetch: No. of training batches built ahead in a background thread, 0: no prefetch
+        :param tf_data: read the batches of TFDataSplit data from a tf.data iterator
+        :param async_workers: No. of threads running Hogwild steps concurrently, 0: synchronous steps
+        :param patience: No. of epochs without improvement of the validation result after which training stops,
+        0: never stop
+        :param min_delta: smallest change of the validation result counted as an improvement
+        :param restore_best: restore the weights of the best epoch at the end of training
         """
         # bind params to class
         self.batch_size = batch_size
@@ -93,8 +151,17 @@ class FM(BaseEstimator, TransformerMixin):
         self.optimizer_type = optimizer_type
         self.batch_norm = batch_norm
         self.verbose = verbose
+        self.eval_batch_size = eval_batch_size
+        self.drop_last = drop_last
+        self.prefetch = prefetch
+        self.tf_data = tf_data
+        self.dataset_initializers = {}
+        self.async_workers = async_workers
         # performance of each epoch
         self.train_rmse, self.valid_rmse, self.test_rmse = [], [], []
+        self.checkpointer = None  # checkpoint.Checkpointer of train, None: no checkpoints
+        # the validation result is the rmse or the log loss, lower is better
+        self.early_stopping = EarlyStopping(patience, min_delta, 'min', restore_best)
 
         # init all variables in a tensorflow graph
         self._init_graph()
@@ -108,13 +175,23 @@ class FM(BaseEstimator, TransformerMixin):
             # Set graph level random seed
             tf.set_random_seed(self.random_seed)
             # Input data.
-            self.train_features = tf.placeholder(tf.int32, shape=[None, None])  # None * features_M
-            self.train_labels = tf.placeholder(tf.float32, shape=[None, 1])  # None * 1
+            if self.tf_data:
+                # the batches of a TFDataSplit come from this iterator, feeding the placeholders overrides it
+                self.input_iterator = tf.data.Iterator.from_structure(*tfdata.IDS_STRUCTURE)
+                ids, labels = self.input_iterator.get_next()
+                self.data_epoch = tf.placeholder_with_default(tf.constant(0, tf.int64), [])  # seeds the shuffle
+                self.train_features = tf.placeholder_with_default(ids, shape=[None, None])  # None * features_M
+                self.train_labels = tf.placeholder_with_default(labels[:, tf.newaxis], shape=[None, 1])  # None * 1
+            else:
+                self.train_features = tf.placeholder(tf.int32, shape=[None, None])  # None * features_M
+                self.train_labels = tf.placeholder(tf.float32, shape=[None, 1])  # None * 1
             self.dropout_keep = tf.placeholder(tf.float32)
             self.train_phase = tf.placeholder(tf.bool)
 
             # Variables.
             self.weights = self._initialize_weights()
+            # No. of training steps run, the dropout masks are drawn from it (checkpoint.step_dropout)
+            self.train_steps = tf.Variable(0, dtype=tf.int64, trainable=False, name='train_steps')
 
             # Model.
             # _________ sum_square part _____________
@@ -135,7 +212,8 @@ class FM(BaseEstimator, TransformerMixin):
                 self.FM = self.batch_norm_layer(self.FM, train_phase=self.train_phase, scope_bn='bn_fm')
 
             # TODO: How to dropout in a non-NN structure?
-            self.FM = tf.nn.dropout(self.FM, self.dropout_keep)  # dropout at the FM layer
+            self.FM = checkpoint.step_dropout(self.FM, self.dropout_keep, self.random_seed,
+                                              self.train_steps)  # dropout at the FM layer
 
             # _________out _________
             Bilinear = tf.reduce_sum(self.FM, 1, keep_dims=True)  # None * 1
@@ -174,6 +252,9 @@ class FM(BaseEstimator, TransformerMixin):
                 self.optimizer = tf.train.MomentumOptimizer(learning_rate=self.learning_rate, momentum=0.95).minimize(
                     self.loss)
 
+            with tf.control_dependencies([self.optimizer]):
+                self.optimizer = tf.assign_add(self.train_steps, 1).op
+
             # init
             self.saver = tf.train.Saver()
             init = tf.global_variables_initializer()
@@ -220,6 +301,9 @@ class FM(BaseEstimator, TransformerMixin):
             all_weights['bias'] = tf.Variable(tf.constant(0.0), name='bias')  # 1 * 1
         return all_weights
 
+    def get_weights(self):  # the weights as numpy arrays
+        return self.sess.run(self.weights)
+
     def batch_norm_layer(self, x, train_phase, scope_bn):
         # Note: the decay parameter is tunable
         bn_train = batch_norm(x, decay=0.9, center=True, scale=True, updates_collections=None,
@@ -235,36 +319,54 @@ class FM(BaseEstimator, TransformerMixin):
         loss, opt = self.sess.run((self.loss, self.optimizer), feed_dict=feed_dict)
         return loss
 
-    def get_random_block_from_data(self, data, batch_size):  # generate a random block of training data
-        start_index = np.random.randint(0, len(data['Y']) - batch_size)
-        X, Y = [], []
-        # forward get sample
-        i = start_index
-        while len(X) < batch_size and i < len(data['X']):
-            if len(data['X'][i]) == len(data['X'][start_index]):
-                Y.append([data['Y'][i]])
-                X.append(data['X'][i])
-                i = i + 1
-            else:
-                break
-        # backward get sample
-        i = start_index
-        while len(X) < batch_size and i >= 0:
-            if len(data['X'][i]) == len(data['X'][start_index]):
-                Y.append([data['Y'][i]])
-                X.append(data['X'][i])
-                i = i - 1
-            else:
-                break
-        return {'X': X, 'Y': Y}
-
-    def shuffle_in_unison_scary(self, a, b):  # shuffle two lists simutaneously
-        rng_state = np.random.get_state()
-        np.random.shuffle(a)
-        np.random.set_state(rng_state)
-        np.random.shuffle(b)
+    def fit_dataset(self, data, epoch=0):  # fit an epoch of a TFDataSplit, the batches are read from the input iterator
+        self.sess.run(self.dataset_initializer(data, True), feed_dict={self.data_epoch: epoch})
+        feed_dict = {self.dropout_keep: self.keep, self.train_phase: True}
+        try:
+            while True:
+                self.sess.run(self.optimizer, feed_dict=feed_dict)
+        except tf.errors.OutOfRangeError:
+            pass
+
+    def dataset_initializer(self, data, train):  # initializer of the input iterator for the epoch of a TFDataSplit
+        key = (id(data), train)
+        if key not in self.dataset_initializers:
+            with self.graph.as_default():
+                tables = set(tf.get_collection(tf.GraphKeys.TABLE_INITIALIZERS))
+                if train:
+                    dataset = data.dataset(self.batch_size, shuffle=True, drop_last=self.drop_last,
+                                           epoch=self.data_epoch)
+                else:
+                    dataset = data.dataset(self.eval_batch_size)
+                self.dataset_initializers[key] = data, self.input_iterator.make_initializer(dataset)
+                self.sess.run([init for init in tf.get_collection(tf.GraphKeys.TABLE_INITIALIZERS) if init not in tables])
+        return self.dataset_initializers[key][1]
+
+    def epoch_batches(self, data):  # generate the batches of an epoch
+        if isinstance(data, DATA.LibFMStream):
+            for batch in data.batches(self.batch_size):
+                # rows of a batch fed to the embedding lookup must have the same No. of features
+                lengths = np.diff(batch['X_csr'].indptr)
+                for length in np.unique(lengths[lengths > 0]):
+                    index = np.flatnonzero(lengths == length)
+                    yield {'X': batch['X_csr'].take(index).indices.reshape([-1, length]),
+                           'Y': batch['Y'][index, np.newaxis]}
+        else:
+            if 'X_csr' not in data:  # the rows as arrays, for vectorized gathers
+                data['X_csr'] = csr_from_lists(data['X'], self.features_M)
+                data['Y_array'] = np.array(data['Y'])
+            # rows of a batch fed to the embedding lookup must have the same No. of features
+            lengths = np.diff(data['X_csr'].indptr)
+            for index in minibatch.bucket_batches(lengths, self.batch_size, self.drop_last):
+                yield {'X': data['X_csr'].take(index).indices.reshape([index.shape[0], -1]),
+                       'Y': data['Y_array'][index, np.newaxis]}
 
     def train(self, Train_data, Validation_data, Test_data):  # fit a dataset
+        start_epoch = 0
+        if self.checkpointer is not None:
+            start_epoch = self.checkpointer.resume(Train_data)
+        if self.early_stopping.replay(self.valid_rmse):
+            start_epoch = self.epoch  # the resumed run had stopped early
         # Check Init performance
         if self.verbose > 0:
             t2 = time()
@@ -274,15 +376,24 @@ class FM(BaseEstimator, TransformerMixin):
             print("Init: \t train=%.4f, validation=%.4f, test=%.4f [%.1f s]" % (
             init_train, init_valid, init_test, time() - t2))
 
-        for epoch in xrange(self.epoch):
+        for epoch in xrange(start_epoch, self.epoch):
             t1 = time()
-            self.shuffle_in_unison_scary(Train_data['X'], Train_data['Y'])
-            total_batch = int(len(Train_data['Y']) / self.batch_size)
-            for i in xrange(total_batch):
-                # generate a batch
-                batch_xs = self.get_random_block_from_data(Train_data, self.batch_size)
-                # Fit training
-                self.partial_fit(batch_xs)
+            batches = None
+            if self.checkpointer is not None:
+                self.checkpointer.begin_epoch(epoch)
+            if isinstance(Train_data, tfdata.TFDataSplit):
+                self.fit_dataset(Train_data, epoch)
+            else:
+                batches = self.epoch_batches(Train_data)
+                if self.prefetch > 0:
+                    batches = minibatch.Prefetcher(batches, self.prefetch)
+                fitted = batches if self.checkpointer is None else self.checkpointer.track(batches)
+                if self.async_workers > 0:
+                    asyncsgd.fit_async(self, fitted, self.async_workers)
+                else:
+                    for batch_xs in fitted:
+                        # Fit training
+                        self.partial_fit(batch_xs)
             t2 = time()
 
             # output validation
@@ -293,44 +404,64 @@ class FM(BaseEstimator, TransformerMixin):
             self.train_rmse.append(train_result)
             self.valid_rmse.append(valid_result)
             self.test_rmse.append(test_result)
+            stop = self.early_stopping.update(self, epoch, valid_result)
+            if self.checkpointer is not None:
+                self.checkpointer.end_epoch(epoch)
             if self.verbose > 0 and epoch % self.verbose == 0:
                 print("Epoch %d [%.1f s]\ttrain=%.4f, validation=%.4f, test=%.4f [%.1f s]"
                       % (epoch + 1, t2 - t1, train_result, valid_result, test_result, time() - t2))
-            if self.eva_termination(self.valid_rmse):
+                if isinstance(batches, minibatch.Prefetcher):
+                    print("\tinput stall %.1f s" % batches.stall_time)
+            if stop:
+                if self.verbose > 0:
+                    print("Early stopping: no improvement for %d epochs" % self.early_stopping.patience)
                 break
 
+        if self.checkpointer is not None:
+            self.checkpointer.wait()
+        if self.early_stopping.restore(self):
+            if self.verbose > 0:
+                print("Restored the weights of epoch %d, validation=%.4f"
+                      % (self.early_stopping.best_epoch + 1, self.early_stopping.best))
         if self.pretrain_flag < 0:
             print "Save model to file as pretrain."
             # self.saver.save(self.sess, self.save_file)
 
-    def eva_termination(self, valid):
+    def evaluate(self, data):  # evaluate the results for an input set, eval_batch_size rows at a time
         if self.loss_type == 'square_loss':
-            if len(valid) > 5:
-                if valid[-1] > valid[-2] and valid[-2] > valid[-3] and valid[-3] > valid[-4] and valid[-4] > valid[-5]:
-                    return True
-        else:
-            if len(valid) > 5:
-                if valid[-1] < valid[-2] and valid[-2] < valid[-3] and valid[-3] < valid[-4] and valid[-4] < valid[-5]:
-                    return True
-        return False
-
-    def evaluate(self, data):  # evaluate the results for an input set
-        num_example = len(data['Y'])
-        feed_dict = {self.train_features: data['X'], self.train_labels: [[y] for y in data['Y']],
-                     self.dropout_keep: 1.0, self.train_phase: False}
-        predictions = self.sess.run((self.out), feed_dict=feed_dict)
-        y_pred = np.reshape(predictions, (num_example,))
-        y_true = np.reshape(data['Y'], (num_example,))
-        if self.loss_type == 'square_loss':
-            predictions_bounded = np.maximum(y_pred, np.ones(num_example) * min(y_true))  # bound the lower values
-            predictions_bounded = np.minimum(predictions_bounded,
-                                             np.ones(num_example) * max(y_true))  # bound the higher values
-            RMSE = math.sqrt(mean_squared_error(y_true, predictions_bounded))
-            return RMSE
+            result = StreamingMetric('rmse')
         elif self.loss_type == 'log_loss':
-            logloss = log_loss(y_true, y_pred)  # I haven't checked the log_loss
-            return logloss
-
+            result = StreamingMetric('log_loss')
+        if isinstance(data, tfdata.TFDataSplit):
+            result.y_min, result.y_max = data.label_range()
+            self.sess.run(self.dataset_initializer(data, False))
+            feed_dict = {self.dropout_keep: 1.0, self.train_phase: False}
+            try:
+                while True:
+                    result.update(*self.sess.run((self.train_labels, self.out), feed_dict=feed_dict))
+            except tf.errors.OutOfRangeError:
+                pass
+        elif isinstance(data, DATA.LibFMStream):
+            if not np.isfinite(data.y_min):  # the label range of a stream is known after a pass over it
+                for _ in data.read_chunks():
+                    pass
+            result.y_min, result.y_max = data.y_min, data.y_max
+            for Y_, X_csr in data.read_chunks():
+                for index in minibatch.length_groups(np.diff(X_csr.indptr), self.eval_batch_size):
+                    X_ = X_csr.take(index).indices.reshape([index.shape[0], -1])
+                    result.update(Y_[index], self.predict_batch(X_, Y_[index]))
+        else:
+            result.y_min, result.y_max = min(data['Y']), max(data['Y'])
+            Y_ = np.array(data['Y'])
+            for index in minibatch.length_groups(np.array([len(x) for x in data['X']]), self.eval_batch_size):
+                X_ = [data['X'][i] for i in index]
+                result.update(Y_[index], self.predict_batch(X_, Y_[index]))
+        return result.result()
+
+    def predict_batch(self, X, Y):
+        feed_dict = {self.train_features: X, self.train_labels: Y[:, np.newaxis], self.dropout_keep: 1.0,
+                     self.train_phase: False}
+        return self.sess.run((self.out), feed_dict=feed_dict)
 
 '''         # for testing the classification accuracy  
             predictions_binary = [] 
@@ -345,7 +476,10 @@ class FM(BaseEstimator, TransformerMixin):
 if __name__ == '__main__':
     # Data loading
     args = parse_args()
-    data = DATA.LoadData(args.path, args.dataset, args.loss_type)
+    data = DATA.LoadData(args.path, args.dataset, args.loss_type, cache_dir=args.cache_dir, stream_train=args.stream,
+                         buffer_size=args.shuffle_buffer, passes=args.passes, hash_bits=args.hash_bits,
+                         vocab_file=args.vocab_file, min_count=args.min_count, max_features=args.max_features,
+                         oov_buckets=args.oov_buckets)
     if args.verbose > 0:
         print(
         "FM: dataset=%s, factors=%d, loss_type=%s, #epoch=%d, batch=%d, lr=%.4f, lambda=%.1e, keep=%.2f, optimizer=%s, batch_norm=%d"
@@ -356,16 +490,29 @@ if __name__ == '__main__':
     # Training
     t1 = time()
     model = FM(data.features_M, args.pretrain, save_file, args.hidden_factor, args.loss_type, args.epoch,
-               args.batch_size, args.lr, args.regularization_factor, args.keep_prob, args.optimizer, args.batch_norm, args.verbose)
-    model.train(data.Train_data, data.Validation_data, data.Test_data)
-
-    # Find the best validation result across iterations
-    best_valid_score = 0
-    if args.loss_type == 'square_loss':
-        best_valid_score = min(model.valid_rmse)
-    elif args.loss_type == 'log_loss':
-        best_valid_score = max(model.valid_rmse)
-    best_epoch = model.valid_rmse.index(best_valid_score)
-    print ("Best Iter(validation)= %d\t train = %.4f, valid = %.4f, test = %.4f [%.1f s]"
-           % (best_epoch + 1, model.train_rmse[best_epoch], model.valid_rmse[best_epoch], model.test_rmse[best_epoch],
-              time() - t1))
+               args.batch_size, args.lr, args.regularization_factor, args.keep_prob, args.optimizer, args.batch_norm, args.verbose,
+               eval_batch_size=args.eval_batch_size, drop_last=args.drop_last,
+               prefetch=args.prefetch, tf_data=args.tf_data, async_workers=args.async_workers,
+               patience=args.patience, min_delta=args.min_delta, restore_best=args.restore_best)
+    Train_data, Validation_data, Test_data = data.Train_data, data.Validation_data, data.Test_data
+    if args.tf_data:  # a streamed training set is parsed from its files (or cache shards) in the graph
+        Train_data, Validation_data, Test_data = [
+            tfdata.from_data(split, data.features_M, args.loss_type, ids=True, vocab=data.vocab, shuffle_buffer=args.shuffle_buffer,
+                             hasher=data.hasher)
+            for split in [Train_data, Validation_data, Test_data]]
+    if args.checkpoint_dir:
+        model.checkpointer = checkpoint.Checkpointer(model, args.checkpoint_dir, args.checkpoint_steps,
+                                                     args.full_every)
+    model.train(Train_data, Validation_data, Test_data)
+    if args.export:
+        inference.export(model, args.export)
+
+    # The best validation result across iterations, in the direction of the metric
+    best_epoch = model.early_stopping.best_epoch
+    if best_epoch < 0:  # every validation result was nan or inf
+        print ("Best Iter(validation): no finite validation result in %d epochs [%.1f s]"
+               % (len(model.valid_rmse), time() - t1))
+    else:
+        print ("Best Iter(validation)= %d\t train = %.4f, valid = %.4f, test = %.4f [%.1f s]"
+               % (best_epoch + 1, model.train_rmse[best_epoch], model.valid_rmse[best_epoch],
+                  model.test_rmse[best_epoch], time() - t1))
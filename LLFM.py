@@ -2,16 +2,21 @@
 Tensorflow implementation of Localized Factorization Machines
 
 '''
-import math
 import numpy as np
 import tensorflow as tf
 from sklearn.base import BaseEstimator, TransformerMixin
-from sklearn.metrics import mean_squared_error
-from sklearn.metrics import log_loss
 from time import time
 import argparse
+import asyncsgd
+import checkpoint
+import minibatch
+import tfdata
+import warmstart
 import LoadData_nonsparse as DATA
-from sparsify import sparse_concat, sparsify
+from anchor_index import AnchorIndex
+import inference
+from earlystopping import EarlyStopping
+from metrics import StreamingMetric
 from tensorflow.contrib.layers.python.layers import batch_norm as batch_norm
 
 
@@ -41,11 +46,80 @@ def parse_args():
     parser.add_argument('--loss_type', nargs='?', default='square_loss',
                         help='Specify a loss type (square_loss or log_loss).')
     parser.add_argument('--optimizer', nargs='?', default='AdamOptimizer',
-                        help='Specify an optimizer type (AdamOptimizer, AdagradOptimizer, GradientDescentOptimizer, MomentumOptimizer).')
+                        help='Specify an optimizer type (AdamOptimizer, AdagradOptimizer, GradientDescentOptimizer, MomentumOptimizer, FtrlOptimizer).')
     parser.add_argument('--verbose', type=int, default=1,
                         help='Show the results per X epochs (0, 1 ... any positive integer)')
     parser.add_argument('--batch_norm', type=int, default=0,
                         help='Whether to perform batch normaization (0 or 1)')
+    parser.add_argument('--cache_dir', nargs='?', default=None,
+                        help='Directory of the binary dataset cache. None: parse the text files on every run')
+    parser.add_argument('--hash_bits', type=int, default=0,
+                        help='Hash the feature ids into 2^hash_bits buckets, which fixes features_M. 0: no hashing')
+    parser.add_argument('--signed_hash', type=int, default=0,
+                        help='Whether to multiply the hashed features by a hashed sign (0 or 1)')
+    parser.add_argument('--min_count', type=int, default=1,
+                        help='Features seen fewer times in the training set share the OOV rows')
+    parser.add_argument('--max_features', type=int, default=0,
+                        help='Keep at most the max_features most frequent training features. 0: no cap')
+    parser.add_argument('--oov_buckets', type=int, default=1,
+                        help='No. of rows shared by the pruned features. 0: the pruned features are dropped')
+    parser.add_argument('--stream', type=int, default=0,
+                        help='Whether to stream the training set from disk instead of loading it in memory (0 or 1)')
+    parser.add_argument('--shuffle_buffer', type=int, default=100000,
+                        help='No. of training rows shuffled together when streaming. 0: no shuffle')
+    parser.add_argument('--passes', type=int, default=1,
+                        help='No. of passes over the streamed training set per epoch')
+    parser.add_argument('--drop_last', type=int, default=1,
+                        help='Whether to drop the last partial batch of an epoch (0 or 1)')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='No. of training batches built ahead in a background thread. 0: no prefetch')
+    parser.add_argument('--tf_data', type=int, default=0,
+                        help='Whether to read the batches through a tf.data pipeline instead of feed_dict (0 or 1)')
+    parser.add_argument('--eval_batch_size', type=int, default=10000,
+                        help='No. of rows evaluated at a time')
+    parser.add_argument('--gather_active', type=int, default=0,
+                        help='Whether to compute each step on the embedding rows of the features in the batch (0 or 1)')
+    parser.add_argument('--lazy_updates', type=int, default=0,
+                        help='Whether to update only the rows of the features in the batch, with lazy Adam and lazy L2 '
+                             'decay (0 or 1). The anchor rows absent from a batch get the step of the anchor norms as a '
+                             'pending scale, exact with GradientDescentOptimizer')
+    parser.add_argument('--local_anchors', type=int, default=0,
+                        help='No. of nearest anchors used by each sample. 0: all anchors')
+    parser.add_argument('--anchor_lists', type=int, default=0,
+                        help='No. of cells of the nearest-anchor index. 0: sqrt(anchor_points)')
+    parser.add_argument('--anchor_probe', type=int, default=0,
+                        help='No. of cells of the nearest-anchor index searched at evaluation. 0: exact search in the graph')
+    parser.add_argument('--towers', type=int, default=1,
+                        help='No. of data-parallel towers each batch is split across')
+    parser.add_argument('--async_workers', type=int, default=0,
+                        help='No. of threads running Hogwild training steps concurrently. 0: synchronous steps')
+    parser.add_argument('--init_fm', nargs='?', default=None,
+                        help='FM exported by FM_nonsparse.py the weights of every anchor start from. None: random weights')
+    parser.add_argument('--init_noise', type=float, default=0.001,
+                        help='Standard deviation of the noise added to the embeddings tiled from init_fm')
+    parser.add_argument('--kmeans_anchors', type=int, default=0,
+                        help='Whether to place the anchors by mini-batch k-means over the training rows (0 or 1)')
+    parser.add_argument('--kmeans_iterations', type=int, default=100,
+                        help='No. of mini-batch k-means iterations')
+    parser.add_argument('--patience', type=int, default=0,
+                        help='No. of epochs without improvement of the validation result before training stops. 0: never stop')
+    parser.add_argument('--min_delta', type=float, default=0.0,
+                        help='Smallest change of the validation result counted as an improvement')
+    parser.add_argument('--restore_best', type=int, default=1,
+                        help='Whether to restore the weights of the best epoch at the end of training (0 or 1)')
+    parser.add_argument('--checkpoint_dir', nargs='?', default=None,
+                        help='Directory of the checkpoints the training is saved to and resumed from (not with ps_shards). None: no checkpoints')
+    parser.add_argument('--checkpoint_steps', type=int, default=0,
+                        help='No. of steps between two checkpoints within an epoch. 0: at the end of the epochs only')
+    parser.add_argument('--full_every', type=int, default=5,
+                        help='Write a full checkpoint every full_every checkpoints, the others hold the changed rows only')
+    parser.add_argument('--export', nargs='?', default=None,
+                        help='File to export the trained weights to, for the numpy inference. None: no export')
+    parser.add_argument('--ps_shards', type=int, default=0,
+                        help='No. of parameter-server shards holding the weights, partitioned by feature id (the steps of the '
+                        'dense model with GradientDescentOptimizer, approximate with Adagrad). 0: weights in the graph')
+    parser.add_argument('--ps_processes', type=int, default=0,
+                        help='Whether to run each parameter-server shard in its own process (0 or 1)')
 
     return parser.parse_args()
 
@@ -54,7 +128,10 @@ class LLFM(BaseEstimator, TransformerMixin):
     def __init__(self, features_M, pretrain_flag, save_file, hidden_factor, anchor_points, loss_type, epoch, batch_size,
                  learning_rate,
                  lambda_bilinear, keep,
-                 optimizer_type, batch_norm, verbose, random_seed=2016, is_sparse=True):
+                 optimizer_type, batch_norm, verbose, random_seed=2016, is_sparse=True, eval_batch_size=10000,
+                 drop_last=True, prefetch=2, tf_data=False, async_workers=0, gather_active=False,
+                 local_anchors=0, towers=1, lazy_updates=False,
+                 patience=0, min_delta=0.0, restore_best=True):
         """
 
         :param features_M: No. of features in the input data
@@ -72,6 +149,27 @@ class LLFM(BaseEstimator, TransformerMixin):
         :param batch_norm:
         :param verbose:
         :param random_seed:
+        :param is_sparse:
+        :param eval_batch_size: No. of rows fed at a time by evaluate
+        :param drop_last: drop the last partial batch of an epoch
+        :param prefetch: No. of training batches built ahead in a background thread, 0: no prefetch
+        :param tf_data: read the batches of TFDataSplit data from a tf.data iterator (sparse input only)
+        :param async_workers: No. of threads running Hogwild steps concurrently, 0: synchronous steps
+        :param gather_active: compute the model on the rows of the feature ids present in a batch (sparse input only)
+        :param local_anchors: No. of nearest anchors kept by each sample, 0: all anchors (sparse input only). The
+        embeddings are then stored as a [features_M * A, K] table and batch_norm is not applied
+        :param towers: No. of data-parallel towers a batch is split across. With batch_norm the towers share the
+        beta and gamma of the layer, trained by the gradients of every tower, and every tower updates the moving
+        statistics
+        :param lazy_updates: update only the rows of the feature ids present in a batch (sparse input only, implies
+        gather_active): AdamOptimizer becomes LazyAdamOptimizer, the L2 decay of a row is applied when the row is next
+        seen and the norms of the anchors are kept up to date instead of recomputed. The gradient of the norm of an
+        anchor reaches all its rows; for the rows absent from a batch it is a scale of the anchor, kept pending until
+        the rows are read (see _lazy_step)
+        :param patience: No. of epochs without improvement of the validation result after which training stops,
+        0: never stop
+        :param min_delta: smallest change of the validation result counted as an improvement
+        :param restore_best: restore the weights of the best epoch at the end of training
         """
         # bind params to class
         self.batch_size = batch_size
@@ -90,8 +188,26 @@ class LLFM(BaseEstimator, TransformerMixin):
         self.batch_norm = batch_norm
         self.verbose = verbose
         self.is_sparse = is_sparse
+        self.eval_batch_size = eval_batch_size
+        self.drop_last = drop_last
+        self.prefetch = prefetch
+        self.tf_data = tf_data and is_sparse
+        self.dataset_initializers = {}
+        self.async_workers = async_workers
+        self.gather_active = gather_active and is_sparse
+        self.local_anchors = local_anchors if is_sparse else 0
+        self.anchor_index = None
+        self.towers = towers
+        self.lazy_updates = lazy_updates and is_sparse
+        if self.lazy_updates:
+            if towers > 1:
+                raise ValueError('lazy_updates does not support towers > 1')
+            self.gather_active = True
         # performance of each epoch
         self.train_rmse, self.valid_rmse, self.test_rmse = [], [], []
+        self.checkpointer = None  # checkpoint.Checkpointer of train, None: no checkpoints
+        # the validation result is the rmse (lower is better) or the accuracy (higher is better)
+        self.early_stopping = EarlyStopping(patience, min_delta, 'min' if loss_type == 'square_loss' else 'max', restore_best)
 
         # init all variables in a tensorflow graph
         self._init_graph()
@@ -105,43 +221,189 @@ class LLFM(BaseEstimator, TransformerMixin):
             # Set graph level random seed
             tf.set_random_seed(self.random_seed)
             # Input data.
-            if self.is_sparse:
-                self.train_features = tf.sparse_placeholder(tf.float32,
-                                                            shape=[None, self.features_M])  # None * features_M
+            if self.tf_data:
+                # the batches of a TFDataSplit come from this iterator, feeding the placeholders overrides it
+                self.input_iterator = tf.data.Iterator.from_structure(*tfdata.SPARSE_STRUCTURE)
+                indices, values, dense_shape, labels = self.input_iterator.get_next()
+                self.data_epoch = tf.placeholder_with_default(tf.constant(0, tf.int64), [])  # seeds the shuffle
+                self.train_features = tf.SparseTensor(tf.placeholder_with_default(indices, shape=[None, 2]),
+                                                      tf.placeholder_with_default(values, shape=[None]),
+                                                      tf.placeholder_with_default(dense_shape, shape=[2]))  # None * features_M
+                self.train_labels = tf.placeholder_with_default(labels[:, tf.newaxis], shape=[None, 1])  # None * 1
             else:
-                self.train_features = tf.placeholder(tf.float32, shape=[None, self.features_M])  # None * features_M
-            self.train_labels = tf.placeholder(tf.float32, shape=[None, 1])  # None * 1
+                if self.is_sparse:
+                    self.train_features = tf.sparse_placeholder(tf.float32,
+                                                                shape=[None, self.features_M])  # None * features_M
+                else:
+                    self.train_features = tf.placeholder(tf.float32, shape=[None, self.features_M])  # None * features_M
+                self.train_labels = tf.placeholder(tf.float32, shape=[None, 1])  # None * 1
             self.dropout_keep = tf.placeholder(tf.float32)
             self.train_phase = tf.placeholder(tf.bool)
 
             # Variables.
             self.weights = self._initialize_weights()
+            # No. of training steps run, the dropout masks are drawn from it (checkpoint.step_dropout)
+            self.train_steps = tf.Variable(0, dtype=tf.int64, trainable=False, name='train_steps')
+            if self.lazy_updates:
+                # squared norms of the anchors, moved by the rows a step changes; product of the scales of the
+                # anchors since the last sync, and its value when every row was last brought up to date; step of the
+                # last regularization of every feature
+                self.anchor_norms = tf.Variable(tf.reduce_sum(tf.square(
+                    self.weights['anchor_points'].initialized_value()), 0, keep_dims=True), trainable=False,
+                    name='anchor_norms')  # 1 * A
+                self.anchor_scale = tf.Variable(tf.ones([1, self.anchor_points]), trainable=False,
+                                                name='anchor_scale')  # 1 * A
+                self.row_scale = tf.Variable(tf.ones([self.features_M, self.anchor_points]), trainable=False,
+                                             name='row_scale')  # features_M * A
+                self.sync_anchors = self._sync_anchors()
+                self.global_step = tf.Variable(0, dtype=tf.int64, trainable=False, name='global_step')
+                self.last_seen = tf.Variable(tf.zeros([self.features_M], dtype=tf.int64), trainable=False,
+                                             name='last_seen')  # features_M
 
             # Model.
+            if self.towers > 1:
+                self.out, self.loss, grads_and_vars = self._build_towers()
+            else:
+                self.out, self.loss = self._forward(self.train_features, self.train_labels)
+                if self.lambda_bilinear > 0 and self.lazy_updates:
+                    self.loss = self.loss + self._lazy_regularizer()
+                elif self.lambda_bilinear > 0:
+                    self.loss = self.loss + tf.contrib.layers.l2_regularizer(self.lambda_bilinear)(
+                        self.weights['feature_embeddings'])  # regulizer
+
+            # Optimizer.
+            if self.optimizer_type == 'AdamOptimizer' and self.lazy_updates:
+                # the moments of the rows absent from a batch are left as they are
+                optimizer = tf.contrib.opt.LazyAdamOptimizer(learning_rate=self.learning_rate, beta1=0.9, beta2=0.999,
+                                                             epsilon=1e-8)
+            elif self.optimizer_type == 'AdamOptimizer':
+                optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate, beta1=0.9, beta2=0.999,
+                                                   epsilon=1e-8)
+            elif self.optimizer_type == 'AdagradOptimizer':
+                optimizer = tf.train.AdagradOptimizer(learning_rate=self.learning_rate, initial_accumulator_value=1e-8)
+            elif self.optimizer_type == 'GradientDescentOptimizer':
+                optimizer = tf.train.GradientDescentOptimizer(learning_rate=self.learning_rate)
+            elif self.optimizer_type == 'MomentumOptimizer':
+                optimizer = tf.train.MomentumOptimizer(learning_rate=self.learning_rate, momentum=0.95)
+            elif self.optimizer_type == 'FtrlOptimizer':
+                optimizer = tf.train.FtrlOptimizer(learning_rate=self.learning_rate)
+            if self.towers > 1:
+                self.optimizer = optimizer.apply_gradients(grads_and_vars)
+            elif self.lazy_updates:
+                self.optimizer = self._lazy_step(optimizer)
+            else:
+                self.optimizer = optimizer.minimize(self.loss)
+
+            with tf.control_dependencies([self.optimizer]):
+                self.optimizer = tf.assign_add(self.train_steps, 1).op
 
-            # coefficients
-            self.X2 = tf.matmul(tf.sparse_reduce_sum(tf.square(self.train_features), 1, keep_dims=True), tf.ones([1, self.anchor_points]))
-            self.Y2 = tf.matmul(tf.ones_like(self.train_labels, dtype=tf.float32),
-                                tf.reduce_sum(tf.square(self.weights['anchor_points']), 0, keep_dims=True))
-            self.XY = tf.sparse_tensor_dense_matmul(self.train_features, self.weights['anchor_points'])
-            self.distance = self.X2 + self.Y2 - 2 * self.XY
-            self.distance = tf.sqrt(self.distance)
-            self.distance = -10 * self.distance
+            # init
+            self.saver = tf.train.Saver()
+            init = tf.global_variables_initializer()
+            if self.towers > 1:
+                self.sess = tf.Session(config=tf.ConfigProto(inter_op_parallelism_threads=self.towers))
+            else:
+                self.sess = tf.Session()
+            self.sess.run(init)
+
+            # number of params
+            total_parameters = 0
+            for variable in self.weights.values():
+                shape = variable.get_shape()  # shape is an array of tf.Dimension
+                variable_parameters = 1
+                for dim in shape:
+                    variable_parameters *= dim.value
+                total_parameters += variable_parameters
+            if self.verbose > 0:
+                print "#params: %d" % total_parameters
+
+
+    def _forward(self, train_features, train_labels, reuse=False, tower=0):
+        '''
+        The model on a batch (or the slice of a tower)
+        return: out (None * 1), data loss without the regularizer
+        '''
+        if self.gather_active:
+            # gather the rows of the feature ids present in the batch, the model is computed on this compact
+            # slice and the cost of a step follows the nonzeros of the batch instead of features_M
+            self.active_ids, active_index = tf.unique(train_features.indices[:, 1])
+            features = tf.SparseTensor(
+                tf.stack([train_features.indices[:, 0], tf.cast(active_index, tf.int64)], 1),
+                train_features.values,
+                tf.stack([train_features.dense_shape[0], tf.cast(tf.shape(self.active_ids)[0], tf.int64)]))
+            feature_embeddings = tf.gather(self.weights['feature_embeddings'], self.active_ids)  # U * K * A
+            feature_bias = tf.gather(self.weights['feature_bias'], self.active_ids)  # U * A
+            anchor_points = tf.gather(self.weights['anchor_points'], self.active_ids)  # U * A
+        else:
+            features = train_features
+            feature_embeddings = self.weights['feature_embeddings']
+            feature_bias = self.weights['feature_bias']
+            anchor_points = self.weights['anchor_points']
+
+        # coefficients
+        self.X2 = tf.matmul(tf.sparse_reduce_sum(tf.square(train_features), 1, keep_dims=True), tf.ones([1, self.anchor_points]))
+        # the norm of an anchor runs over all features, so Y2 always reads the whole anchor_points, unless the
+        # norms are given (kept by a parameter server) or kept up to date by the lazy updates
+        if 'anchor_norms' in self.weights:
+            anchor_norms = self.weights['anchor_norms']
+        elif self.lazy_updates:
+            # the active rows are read with the scales pending since they were last updated; the gradient of the
+            # norms flows into them here and is taken by _lazy_step for the other rows
+            self.pending_scale = self.anchor_scale / tf.gather(self.row_scale, self.active_ids)  # U * A
+            anchor_points = anchor_points * self.pending_scale
+            self.active_anchors = anchor_points
+            self.active_norms = tf.reduce_sum(tf.square(anchor_points), 0, keep_dims=True)  # 1 * A
+            self.lazy_norms = tf.stop_gradient(self.anchor_norms - self.active_norms) + self.active_norms
+            anchor_norms = self.lazy_norms
+        else:
+            anchor_norms = tf.reduce_sum(tf.square(self.weights['anchor_points']), 0, keep_dims=True)
+        self.Y2 = tf.matmul(tf.ones_like(train_labels, dtype=tf.float32), anchor_norms)
+        self.XY = tf.sparse_tensor_dense_matmul(features, anchor_points)
+        self.distance = self.X2 + self.Y2 - 2 * self.XY
+        self.distance = tf.sqrt(self.distance)
+        self.distance = -10 * self.distance
+        if self.local_anchors > 0:
+            # local coding: a sample keeps its local_anchors nearest anchors, the coefficients are renormalized
+            # over them and the FM terms are computed for them only
+            self.nearest_distance, self.nearest_anchors = tf.nn.top_k(self.distance, self.local_anchors)  # None * k
+            self.coefficient = tf.nn.softmax(self.nearest_distance)  # None * k
+            rows = train_features.indices[:, 0]
+            num_rows = tf.cast(train_features.dense_shape[0], tf.int32)
+            # row feature_id * A + anchor of feature_embeddings and feature_bias for every nonzero entry
+            local_rows = tf.expand_dims(train_features.indices[:, 1] * self.anchor_points, 1) + tf.gather(
+                tf.cast(self.nearest_anchors, tf.int64), rows)  # nnz * k
+            values = tf.reshape(train_features.values, [-1, 1, 1])
+            local_embeddings = values * tf.gather(self.weights['feature_embeddings'], local_rows)  # nnz * k * K
+
+            self.summed_features_emb = tf.unsorted_segment_sum(local_embeddings, rows, num_rows)  # None * k * K
+            self.summed_features_emb_square = tf.square(self.summed_features_emb)  # None * k * K
+            self.squared_sum_features_emb = tf.unsorted_segment_sum(tf.square(local_embeddings), rows,
+                                                                    num_rows)  # None * k * K
+            self.FM = 0.5 * tf.subtract(self.summed_features_emb_square, self.squared_sum_features_emb)
+            self.FM = self._dropout(self.FM, tower)  # dropout at the FM layer
+
+            self.Bilinear = tf.multiply(tf.reduce_sum(self.FM, 2), self.coefficient)  # None * k
+            local_bias = values[:, :, 0] * tf.gather(self.weights['feature_bias'], local_rows)[:, :, 0]  # nnz * k
+            self.Feature_bias = tf.multiply(tf.unsorted_segment_sum(local_bias, rows, num_rows),
+                                            self.coefficient)  # None * k
+            self.Bias = tf.multiply(tf.gather(self.weights['bias'][0], self.nearest_anchors),
+                                    self.coefficient)  # None * k
+        else:
             self.coefficient = tf.nn.softmax(self.distance)  # None * A
 
             # _________ sum_square part _____________
             # get the summed up embeddings of features.
             # Note: train_features must be a sparse, 0/1 matrix
-            # nonzero_embeddings = tf.nn.embedding_lookup(self.weights['feature_embeddings'], self.train_features)
+            # nonzero_embeddings = tf.nn.embedding_lookup(self.weights['feature_embeddings'], train_features)
             # self.summed_features_emb = tf.reduce_sum(nonzero_embeddings, 1)  # None * K
 
-            self.weights_reshape = tf.reshape(self.weights['feature_embeddings'], [self.features_M, self.hidden_factor * self.anchor_points])
+            self.weights_reshape = tf.reshape(feature_embeddings, [-1, self.hidden_factor * self.anchor_points])
 
             if self.is_sparse:
-                self.summed_features_emb = tf.reshape(tf.sparse_tensor_dense_matmul(self.train_features,
+                self.summed_features_emb = tf.reshape(tf.sparse_tensor_dense_matmul(features,
                                                                 self.weights_reshape), [-1, self.hidden_factor, self.anchor_points]) # None * K * A
             else:
-                self.summed_features_emb = tf.reshape(tf.matmul(self.train_features,
+                self.summed_features_emb = tf.reshape(tf.matmul(train_features,
                                             self.weights_reshape), [-1, self.hidden_factor, self.anchor_points])  # None * K * A
 
             # get the element-multiplication
@@ -151,85 +413,147 @@ class LLFM(BaseEstimator, TransformerMixin):
             # self.squared_features_emb = tf.square(nonzero_embeddings)
             # self.squared_sum_features_emb = tf.reduce_sum(self.squared_features_emb, 1)  # None * K * A
             if self.is_sparse:
-                self.squared_sum_features_emb = tf.reshape(tf.sparse_tensor_dense_matmul(tf.square(self.train_features),
+                self.squared_sum_features_emb = tf.reshape(tf.sparse_tensor_dense_matmul(tf.square(features),
                                                                      tf.square(self.weights_reshape)), [-1, self.hidden_factor, self.anchor_points])
             else:
-                self.squared_sum_features_emb = tf.reshape(tf.matmul(tf.square(self.train_features),
+                self.squared_sum_features_emb = tf.reshape(tf.matmul(tf.square(train_features),
                                                  tf.square(self.weights_reshape)), [-1, self.hidden_factor, self.anchor_points])
 
             # ________ FM __________
             self.FM = 0.5 * tf.subtract(self.summed_features_emb_square, self.squared_sum_features_emb)  # None * K * A
             if self.batch_norm:
-                self.FM = self.batch_norm_layer(self.FM, train_phase=self.train_phase, scope_bn='bn_fm')
+                self.FM = self.batch_norm_layer(self.FM, train_phase=self.train_phase, scope_bn='bn_fm', reuse=reuse)
 
             # TODO: How to dropout in a non-NN structure?
-            self.FM = tf.nn.dropout(self.FM, self.dropout_keep)  # dropout at the FM layer
+            self.FM = self._dropout(self.FM, tower)  # dropout at the FM layer
 
             # _________out _________
             self.Bilinear = tf.multiply(tf.reduce_sum(self.FM, 1), self.coefficient)  # None * A
             if self.is_sparse:
-                self.Feature_bias = tf.multiply(tf.sparse_tensor_dense_matmul(self.train_features, self.weights['feature_bias']), self.coefficient)  # None * A
+                self.Feature_bias = tf.multiply(tf.sparse_tensor_dense_matmul(features, feature_bias), self.coefficient)  # None * A
             else:
-                self.Feature_bias = tf.multiply(tf.matmul(self.train_features, self.weights['feature_bias']), self.coefficient)  # None * A
-            self.Bias = tf.multiply(tf.matmul(tf.ones_like(self.train_labels), self.weights['bias']), self.coefficient)  # None * A
-
-            self.bilinear_reduce = tf.reduce_sum(self.Bilinear, 1)
-            self.feature_bias_reduce = tf.reduce_sum(self.Feature_bias, 1)
-            self.bias_reduce = tf.reduce_sum(self.Bias, 1)
-            print(self.bilinear_reduce.shape)
-            print(self.feature_bias_reduce.shape)
-            print(self.bias_reduce.shape)
-            self.out = tf.add_n([self.bilinear_reduce, self.feature_bias_reduce, self.bias_reduce])  # None * 1
-            self.out = self.out[:, tf.newaxis]
-
-            # Compute the loss.
-            if self.loss_type == 'square_loss':
-                if self.lambda_bilinear > 0:
-                    self.loss = tf.nn.l2_loss(
-                        tf.subtract(self.train_labels, self.out)) + tf.contrib.layers.l2_regularizer(
-                        self.lambda_bilinear)(self.weights['feature_embeddings'])  # regulizer
-                else:
-                    self.loss = tf.nn.l2_loss(tf.subtract(self.train_labels, self.out))
-            elif self.loss_type == 'log_loss':
-                self.out = tf.sigmoid(self.out)
-                if self.lambda_bilinear > 0:
-                    self.loss = tf.losses.log_loss(self.train_labels, self.out, weights=1.0, epsilon=1e-07,
-                                                   scope=None) + tf.contrib.layers.l2_regularizer(
-                        self.lambda_bilinear)(self.weights['feature_embeddings'])  # regulizer
-                else:
-                    self.loss = tf.losses.log_loss(self.train_labels, self.out, weights=1.0, epsilon=1e-07,
-                                                   scope=None)
-
-            # Optimizer.
-            if self.optimizer_type == 'AdamOptimizer':
-                self.optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate, beta1=0.9, beta2=0.999,
-                                                        epsilon=1e-8).minimize(self.loss)
-            elif self.optimizer_type == 'AdagradOptimizer':
-                self.optimizer = tf.train.AdagradOptimizer(learning_rate=self.learning_rate,
-                                                           initial_accumulator_value=1e-8).minimize(self.loss)
-            elif self.optimizer_type == 'GradientDescentOptimizer':
-                self.optimizer = tf.train.GradientDescentOptimizer(learning_rate=self.learning_rate).minimize(self.loss)
-            elif self.optimizer_type == 'MomentumOptimizer':
-                self.optimizer = tf.train.MomentumOptimizer(learning_rate=self.learning_rate, momentum=0.95).minimize(
-                    self.loss)
+                self.Feature_bias = tf.multiply(tf.matmul(train_features, self.weights['feature_bias']), self.coefficient)  # None * A
+            self.Bias = tf.multiply(tf.matmul(tf.ones_like(train_labels), self.weights['bias']), self.coefficient)  # None * A
+
+        self.bilinear_reduce = tf.reduce_sum(self.Bilinear, 1)
+        self.feature_bias_reduce = tf.reduce_sum(self.Feature_bias, 1)
+        self.bias_reduce = tf.reduce_sum(self.Bias, 1)
+        print(self.bilinear_reduce.shape)
+        print(self.feature_bias_reduce.shape)
+        print(self.bias_reduce.shape)
+        self.out = tf.add_n([self.bilinear_reduce, self.feature_bias_reduce, self.bias_reduce])  # None * 1
+        self.out = self.out[:, tf.newaxis]
+
+        # Compute the loss.
+        if self.loss_type == 'square_loss':
+            loss = tf.nn.l2_loss(tf.subtract(train_labels, self.out))
+        elif self.loss_type == 'log_loss':
+            self.out = tf.sigmoid(self.out)
+            loss = tf.losses.log_loss(train_labels, self.out, weights=1.0, epsilon=1e-07, scope=None)
+        return self.out, loss
 
-            # init
-            self.saver = tf.train.Saver()
-            init = tf.global_variables_initializer()
-            self.sess = tf.Session()
-            self.sess.run(init)
+    def _dropout(self, x, tower):  # dropout of the FM layer of a tower, with masks drawn from the No. of steps run
+        if self.train_steps is None:
+            return tf.nn.dropout(x, self.dropout_keep)
+        return checkpoint.step_dropout(x, self.dropout_keep, self.random_seed + tower, self.train_steps)
 
-            # number of params
-            total_parameters = 0
-            for variable in self.weights.values():
-                shape = variable.get_shape()  # shape is an array of tf.Dimension
-                variable_parameters = 1
-                for dim in shape:
-                    variable_parameters *= dim.value
-                total_parameters += variable_parameters
-            if self.verbose > 0:
-                print "#params: %d" % total_parameters
+    def _lazy_regularizer(self):
+        '''
+        L2 regularizer of the embeddings of the active features. A row skipped by gap - 1 steps is decayed for all of
+        them at once (lambda * gap * ||w||^2 / 2), so the rows absent from a batch are neither read nor updated
+        '''
+        gap = tf.cast(self.global_step + 1 - tf.gather(self.last_seen, self.active_ids), tf.float32)  # U
+        if self.local_anchors > 0:
+            rows = tf.reshape(tf.expand_dims(self.active_ids * self.anchor_points, 1) + tf.range(
+                self.anchor_points, dtype=tf.int64), [-1])  # (U * A)
+        else:
+            rows = self.active_ids
+        embeddings = tf.reshape(tf.gather(self.weights['feature_embeddings'], rows),
+                                [-1, self.hidden_factor * self.anchor_points])  # U * (K * A)
+        return self.lambda_bilinear * 0.5 * tf.reduce_sum(gap * tf.reduce_sum(tf.square(embeddings), 1))
 
+    def _lazy_step(self, optimizer):
+        '''
+        The optimizer step, then the norms and scales of the anchors and the last seen steps.
+        A gradient step on the norm of anchor a moves every row j of the anchor by -2 * lr * g_a * W_ja, g_a being the
+        gradient of the loss by the norm: the rows absent from the batch are scaled by 1 - 2 * lr * g_a. This scale
+        is multiplied into anchor_scale instead of the rows, a row holds its value at the row_scale of its last update
+        and is brought up to date when it is next active (before the optimizer updates it) or by sync_anchors. With
+        GradientDescentOptimizer the steps are those of the dense model; the other optimizers take the scale as a
+        plain gradient step, their slots of the absent rows are left as they are (FtrlOptimizer computes the rows from
+        its accumulators, the scales are lost when a row is next updated).
+        '''
+        anchor_points = self.weights['anchor_points']
+        variables = tf.trainable_variables()
+        gradients = tf.gradients(self.loss, variables + [self.lazy_norms])
+        scale = 1 - 2 * self.learning_rate * gradients.pop()  # 1 * A
+        # the active rows are stored up to date, their gradient is then the one of the rows read by the forward pass
+        bring_up = tf.scatter_update(anchor_points, self.active_ids, self.active_anchors)
+        grads_and_vars = []
+        for gradient, variable in zip(gradients, variables):
+            if variable is anchor_points:
+                with tf.control_dependencies([bring_up]):
+                    gradient = tf.IndexedSlices(tf.identity(gradient.values / self.pending_scale), gradient.indices,
+                                                gradient.dense_shape)
+            if gradient is not None:
+                grads_and_vars.append((gradient, variable))
+        step = optimizer.apply_gradients(grads_and_vars, global_step=self.global_step)
+        with tf.control_dependencies([step]):
+            new_scale = self.anchor_scale * scale
+            new_norms = tf.reduce_sum(tf.square(tf.gather(anchor_points, self.active_ids)), 0, keep_dims=True)
+            update_norms = tf.assign(self.anchor_norms,
+                                     (self.anchor_norms - self.active_norms) * tf.square(scale) + new_norms)
+            update_rows = tf.scatter_update(self.row_scale, self.active_ids,
+                                            tf.tile(new_scale, [tf.shape(self.active_ids)[0], 1]))
+            update_seen = tf.scatter_update(self.last_seen, self.active_ids,
+                                            tf.fill(tf.shape(self.active_ids), self.global_step.read_value()))
+        with tf.control_dependencies([update_norms, update_rows]):
+            update_scale = tf.assign(self.anchor_scale, new_scale)
+        return tf.group(update_norms, update_rows, update_seen, update_scale)
+
+    def _sync_anchors(self):  # apply the pending scales to all the rows of the anchors, then recompute their norms
+        anchor_points = tf.assign(self.weights['anchor_points'],
+                                  self.weights['anchor_points'] * self.anchor_scale / self.row_scale)
+        with tf.control_dependencies([anchor_points]):
+            reset = tf.group(tf.assign(self.anchor_scale, tf.ones_like(self.anchor_scale)),
+                             tf.assign(self.row_scale, tf.ones_like(self.row_scale)))
+        norms = tf.assign(self.anchor_norms, tf.reduce_sum(tf.square(anchor_points), 0, keep_dims=True))
+        return tf.group(reset, norms)
+
+    def _build_towers(self):
+        '''
+        Data-parallel towers: each tower computes the model on a slice of the rows of the batch and the gradients of
+        the towers are summed, the gradients of gathered rows (IndexedSlices) are concatenated instead of densified.
+        The towers run concurrently on the inter-op threads of the session.
+        return: out (None * 1), loss, aggregated (gradient, variable) pairs
+        '''
+        num_rows = tf.shape(self.train_labels, out_type=tf.int64)[0]
+        bounds = [num_rows * i // self.towers for i in range(self.towers + 1)]
+        outs, losses = [], []
+        for i in range(self.towers):
+            with tf.name_scope('tower_%d' % i):
+                if self.is_sparse:
+                    features = tf.sparse_slice(self.train_features, tf.stack([bounds[i], 0]),
+                                               tf.stack([bounds[i + 1] - bounds[i], self.features_M]))
+                else:
+                    features = self.train_features[bounds[i]:bounds[i + 1]]
+                out, loss = self._forward(features, self.train_labels[bounds[i]:bounds[i + 1]], reuse=i > 0, tower=i)
+                if self.loss_type == 'log_loss':  # the mean over the batch is the size-weighted mean of the towers
+                    loss = loss * tf.cast(bounds[i + 1] - bounds[i], tf.float32) / tf.cast(num_rows, tf.float32)
+                outs.append(out)
+                losses.append(loss)
+        # the weights and the beta and gamma of batch_norm, created by the first tower
+        variables = tf.trainable_variables()
+        gradients = [tf.gradients(loss, variables) for loss in losses]
+        loss = tf.add_n(losses)
+        if self.lambda_bilinear > 0:
+            regularizer = tf.contrib.layers.l2_regularizer(self.lambda_bilinear)(self.weights['feature_embeddings'])
+            loss = loss + regularizer
+            gradients.append(tf.gradients(regularizer, variables))
+        grads_and_vars = [(aggregate_gradients(list(tower_gradients)), variable)
+                          for tower_gradients, variable in zip(zip(*gradients), variables)]
+        grads_and_vars = [(gradient, variable) for gradient, variable in grads_and_vars if gradient is not None]
+        return tf.concat(outs, 0), loss, grads_and_vars
 
     def _initialize_weights(self):
         """
@@ -240,33 +564,66 @@ class LLFM(BaseEstimator, TransformerMixin):
         """
         all_weights = dict()
         if self.pretrain_flag > 0:
-            weight_saver = tf.train.import_meta_graph(self.save_file + '.meta')
-            pretrain_graph = tf.get_default_graph()
-            feature_embeddings = pretrain_graph.get_tensor_by_name('feature_embeddings:0')
-            feature_bias = pretrain_graph.get_tensor_by_name('feature_bias:0')
-            bias = pretrain_graph.get_tensor_by_name('bias:0')
-            with tf.Session() as sess:
-                weight_saver.restore(sess, self.save_file)
-                fe, fb, b = sess.run([feature_embeddings, feature_bias, bias])
-            all_weights['feature_embeddings'] = tf.Variable(fe, dtype=tf.float32)
-            all_weights['feature_bias'] = tf.Variable(fb, dtype=tf.float32)
-            all_weights['bias'] = tf.Variable(b, dtype=tf.float32)
+            # the pretrained model is read in a graph of its own, its variables are not added to this one
+            with tf.Graph().as_default() as pretrain_graph:
+                weight_saver = tf.train.import_meta_graph(self.save_file + '.meta')
+                names = ['feature_embeddings', 'feature_bias', 'bias']
+                if 'anchor_points' in [op.name for op in pretrain_graph.get_operations()]:
+                    names.append('anchor_points')  # a pretrained FM has no anchors, they are drawn at random
+                with tf.Session() as sess:
+                    weight_saver.restore(sess, self.save_file)
+                    values = sess.run([pretrain_graph.get_tensor_by_name(name + ':0') for name in names])
+            for name, value in zip(names, values):
+                all_weights[name] = tf.Variable(value, dtype=tf.float32, name=name)
+            if 'anchor_points' not in all_weights:
+                all_weights['anchor_points'] = tf.Variable(tf.random_uniform([self.features_M, self.anchor_points]),
+                                                           name='anchor_points')  # M * A
         else:
-            all_weights['feature_embeddings'] = tf.Variable(
-                tf.random_normal([self.features_M, self.hidden_factor, self.anchor_points], 0.0, 0.01),
-                name='feature_embeddings')  # features_M * K * A
-            all_weights['feature_bias'] = tf.Variable(
-                tf.random_uniform([self.features_M, self.anchor_points], 0.0, 0.0),
-                name='feature_bias')  # features_M * A
+            if self.local_anchors > 0:
+                # row feature_id * A + anchor holds the embedding and bias of a feature for an anchor, so the rows
+                # of the nearest anchors are gathered without reading the others
+                all_weights['feature_embeddings'] = tf.Variable(
+                    tf.random_normal([self.features_M * self.anchor_points, self.hidden_factor], 0.0, 0.01),
+                    name='feature_embeddings')  # (features_M * A) * K
+                all_weights['feature_bias'] = tf.Variable(
+                    tf.random_uniform([self.features_M * self.anchor_points, 1], 0.0, 0.0),
+                    name='feature_bias')  # (features_M * A) * 1
+            else:
+                all_weights['feature_embeddings'] = tf.Variable(
+                    tf.random_normal([self.features_M, self.hidden_factor, self.anchor_points], 0.0, 0.01),
+                    name='feature_embeddings')  # features_M * K * A
+                all_weights['feature_bias'] = tf.Variable(
+                    tf.random_uniform([self.features_M, self.anchor_points], 0.0, 0.0),
+                    name='feature_bias')  # features_M * A
             all_weights['bias'] = tf.Variable(tf.random_uniform([1, self.anchor_points]), name='bias')  # 1 * A
             all_weights['anchor_points'] = tf.Variable(tf.random_uniform([self.features_M, self.anchor_points]), name='anchor_points')  # M * A
 
         return all_weights
 
-    def batch_norm_layer(self, x, train_phase, scope_bn):
+    def get_weights(self):  # the weights as numpy arrays, feature_embeddings as features_M * K * A
+        if self.lazy_updates:
+            self.sess.run(self.sync_anchors)
+        weights = self.sess.run(self.weights)
+        if self.local_anchors > 0:
+            weights['feature_embeddings'] = np.transpose(np.reshape(
+                weights['feature_embeddings'], [self.features_M, self.anchor_points, self.hidden_factor]), [0, 2, 1])
+            weights['feature_bias'] = np.reshape(weights['feature_bias'], [self.features_M, self.anchor_points])
+        return weights
+
+    def set_weights(self, weights):  # assign numpy arrays given in the layout of get_weights (a warm start)
+        for name, value in weights.items():
+            if self.local_anchors > 0 and name == 'feature_embeddings':
+                value = np.reshape(np.transpose(value, [0, 2, 1]), [-1, self.hidden_factor])
+            elif self.local_anchors > 0 and name == 'feature_bias':
+                value = np.reshape(value, [-1, 1])
+            self.weights[name].load(value, self.sess)
+        if self.lazy_updates:
+            self.sess.run(self.sync_anchors)
+
+    def batch_norm_layer(self, x, train_phase, scope_bn, reuse=False):
         # Note: the decay parameter is tunable
         bn_train = batch_norm(x, decay=0.9, center=True, scale=True, updates_collections=None,
-                              is_training=True, reuse=None, trainable=True, scope=scope_bn)
+                              is_training=True, reuse=reuse or None, trainable=True, scope=scope_bn)
         bn_inference = batch_norm(x, decay=0.9, center=True, scale=True, updates_collections=None,
                                   is_training=False, reuse=True, trainable=True, scope=scope_bn)
         z = tf.cond(train_phase, lambda: bn_train, lambda: bn_inference)
@@ -278,20 +635,50 @@ class LLFM(BaseEstimator, TransformerMixin):
         loss, opt = self.sess.run((self.loss, self.optimizer), feed_dict=feed_dict)
         return loss
 
-    def get_random_block_from_data(self, data, batch_size):  # generate a random block of training data
-        start_index = np.random.randint(0, data['Y'].shape[0] - batch_size)
-        if self.is_sparse:
-            return {
-                'X': sparse_concat(data['X_sparse_list'][start_index:start_index + batch_size], self.features_M),
-                'Y': data['Y'][start_index:start_index + batch_size, np.newaxis]
-            }
+    def fit_dataset(self, data, epoch=0):  # fit an epoch of a TFDataSplit, the batches are read from the input iterator
+        self.sess.run(self.dataset_initializer(data, True), feed_dict={self.data_epoch: epoch})
+        feed_dict = {self.dropout_keep: self.keep, self.train_phase: True}
+        try:
+            while True:
+                self.sess.run(self.optimizer, feed_dict=feed_dict)
+        except tf.errors.OutOfRangeError:
+            pass
+
+    def dataset_initializer(self, data, train):  # initializer of the input iterator for the epoch of a TFDataSplit
+        key = (id(data), train)
+        if key not in self.dataset_initializers:
+            with self.graph.as_default():
+                tables = set(tf.get_collection(tf.GraphKeys.TABLE_INITIALIZERS))
+                if train:
+                    dataset = data.dataset(self.batch_size, shuffle=True, drop_last=self.drop_last,
+                                           epoch=self.data_epoch)
+                else:
+                    dataset = data.dataset(self.eval_batch_size)
+                self.dataset_initializers[key] = data, self.input_iterator.make_initializer(dataset)
+                self.sess.run([init for init in tf.get_collection(tf.GraphKeys.TABLE_INITIALIZERS) if init not in tables])
+        return self.dataset_initializers[key][1]
+
+    def epoch_batches(self, data):  # generate the batches of an epoch
+        if isinstance(data, DATA.LibFMStream):
+            for batch in data.batches(self.batch_size):
+                if self.is_sparse:
+                    yield {'X': batch['X_csr'].to_sparse_tensor(), 'Y': batch['Y'][:, np.newaxis]}
+                else:
+                    yield {'X': batch['X_csr'].to_dense(), 'Y': batch['Y'][:, np.newaxis]}
         else:
-            return {
-                'X': data['X'][start_index:start_index + batch_size, :],
-                'Y': data['Y'][start_index:start_index + batch_size, np.newaxis]
-            }
+            for index in minibatch.epoch_batches(data['Y'].shape[0], self.batch_size, self.drop_last):
+                if self.is_sparse:
+                    X_ = data['X_csr'].take(index).to_sparse_tensor()
+                else:
+                    X_ = data['X_csr'].take(index).to_dense()
+                yield {'X': X_, 'Y': data['Y'][index, np.newaxis]}
 
     def train(self, Train_data, Validation_data, Test_data):  # fit a dataset
+        start_epoch = 0
+        if self.checkpointer is not None:
+            start_epoch = self.checkpointer.resume(Train_data)
+        if self.early_stopping.replay(self.valid_rmse):
+            start_epoch = self.epoch  # the resumed run had stopped early
         # Check Init performance
         if self.verbose > 0:
             t2 = time()
@@ -301,14 +688,26 @@ class LLFM(BaseEstimator, TransformerMixin):
             print("Init: \t train=%.4f, validation=%.4f, test=%.4f [%.1f s]" % (
                 init_train, init_valid, init_test, time() - t2))
 
-        for epoch in xrange(self.epoch):
+        for epoch in xrange(start_epoch, self.epoch):
             t1 = time()
-            total_batch = int(len(Train_data['Y']) / self.batch_size)
-            for i in xrange(total_batch):
-                # generate a batch
-                batch_xs = self.get_random_block_from_data(Train_data, self.batch_size)
-                # Fit training
-                self.partial_fit(batch_xs)
+            batches = None
+            if self.checkpointer is not None:
+                self.checkpointer.begin_epoch(epoch)
+            if isinstance(Train_data, tfdata.TFDataSplit):
+                self.fit_dataset(Train_data, epoch)
+            else:
+                batches = self.epoch_batches(Train_data)
+                if self.prefetch > 0:
+                    batches = minibatch.Prefetcher(batches, self.prefetch)
+                fitted = batches if self.checkpointer is None else self.checkpointer.track(batches)
+                if self.async_workers > 0:
+                    asyncsgd.fit_async(self, fitted, self.async_workers)
+                else:
+                    for batch_xs in fitted:
+                        # Fit training
+                        self.partial_fit(batch_xs)
+            if self.lazy_updates:  # apply the pending scales, drop the rounding errors (and Hogwild races) of the norms
+                self.sess.run(self.sync_anchors)
             t2 = time()
 
             # output validation
@@ -319,66 +718,121 @@ class LLFM(BaseEstimator, TransformerMixin):
             self.train_rmse.append(train_result)
             self.valid_rmse.append(valid_result)
             self.test_rmse.append(test_result)
+            stop = self.early_stopping.update(self, epoch, valid_result)
+            if self.checkpointer is not None:
+                self.checkpointer.end_epoch(epoch)
             if self.verbose > 0 and epoch % self.verbose == 0:
                 print("Epoch %d [%.1f s]\ttrain=%.4f, validation=%.4f, test=%.4f [%.1f s]"
                       % (epoch + 1, t2 - t1, train_result, valid_result, test_result, time() - t2))
-                # if self.eva_termination(self.valid_rmse):
-                #     break
-
+                if isinstance(batches, minibatch.Prefetcher):
+                    print("\tinput stall %.1f s" % batches.stall_time)
+            if stop:
+                if self.verbose > 0:
+                    print("Early stopping: no improvement for %d epochs" % self.early_stopping.patience)
+                break
+
+        if self.checkpointer is not None:
+            self.checkpointer.wait()
+        if self.early_stopping.restore(self):
+            if self.lazy_updates:
+                self.sess.run(self.sync_anchors)
+            if self.verbose > 0:
+                print("Restored the weights of epoch %d, validation=%.4f"
+                      % (self.early_stopping.best_epoch + 1, self.early_stopping.best))
         if self.pretrain_flag < 0:
             print "Save model to file as pretrain."
             # self.saver.save(self.sess, self.save_file)
 
-    def eva_termination(self, valid):
+    def evaluate(self, data):  # evaluate the results for an input set, eval_batch_size rows at a time
+        if self.anchor_index is not None:
+            self.update_anchor_index()
         if self.loss_type == 'square_loss':
-            if len(valid) > 5:
-                if valid[-1] > valid[-2] and valid[-2] > valid[-3] and valid[-3] > valid[-4] and valid[-4] > valid[-5]:
-                    return True
-        else:
-            if len(valid) > 5:
-                if valid[-1] < valid[-2] and valid[-2] < valid[-3] and valid[-3] < valid[-4] and valid[-4] < valid[-5]:
-                    return True
-        return False
-
-    def evaluate(self, data):  # evaluate the results for an input set
-        num_example = data['Y'].shape[0]
-        if self.is_sparse:
-            feed_dict = {self.train_features: data['X_sparse'], self.train_labels: [[y] for y in data['Y']],
-                         self.dropout_keep: 1.0, self.train_phase: False}
-        else:
-            feed_dict = {self.train_features: data['X'], self.train_labels: [[y] for y in data['Y']],
-                         self.dropout_keep: 1.0, self.train_phase: False}
-        predictions = self.sess.run((self.out), feed_dict=feed_dict)
-        y_pred = np.reshape(predictions, (num_example,))
-        y_true = np.reshape(data['Y'], (num_example,))
-        if self.loss_type == 'square_loss':
-            predictions_bounded = np.maximum(y_pred, np.ones(num_example) * min(y_true))  # bound the lower values
-            predictions_bounded = np.minimum(predictions_bounded,
-                                             np.ones(num_example) * max(y_true))  # bound the higher values
-            RMSE = math.sqrt(mean_squared_error(y_true, predictions_bounded))
-            return RMSE
+            result = StreamingMetric('rmse')
         elif self.loss_type == 'log_loss':
-            logloss = log_loss(y_true, y_pred)  # I haven't checked the log_loss
-            y_pred[y_pred > 0.499] = 1
-            y_pred[y_pred < 0.5] = 0
-            y_pred = y_pred.astype(dtype=np.int32)
-            y_true = y_true.astype(dtype=np.int32)
-            return np.sum(y_pred == y_true) / (num_example * 1.0)
+            result = StreamingMetric('accuracy')
+        if isinstance(data, tfdata.TFDataSplit):
+            result.y_min, result.y_max = data.label_range()
+            self.sess.run(self.dataset_initializer(data, False))
+            feed_dict = {self.dropout_keep: 1.0, self.train_phase: False}
+            try:
+                while True:
+                    result.update(*self.sess.run((self.train_labels, self.out), feed_dict=feed_dict))
+            except tf.errors.OutOfRangeError:
+                pass
+        elif isinstance(data, DATA.LibFMStream):
+            if not np.isfinite(data.y_min):  # the label range of a stream is known after a pass over it
+                for _ in data.read_chunks():
+                    pass
+            result.y_min, result.y_max = data.y_min, data.y_max
+            for Y_, X_csr in data.read_chunks():
+                for start in xrange(0, Y_.shape[0], self.eval_batch_size):
+                    stop = min(start + self.eval_batch_size, Y_.shape[0])
+                    X_ = X_csr.rows(start, stop)
+                    if self.anchor_index is not None:
+                        result.update(Y_[start:stop], self.predict_indexed(X_, Y_[start:stop]))
+                        continue
+                    if self.is_sparse:
+                        X_ = X_.to_sparse_tensor()
+                    else:
+                        X_ = X_.to_dense()
+                    result.update(Y_[start:stop], self.predict_batch(X_, Y_[start:stop]))
+        else:
+            result.y_min, result.y_max = np.min(data['Y']), np.max(data['Y'])
+            for start in xrange(0, data['Y'].shape[0], self.eval_batch_size):
+                stop = min(start + self.eval_batch_size, data['Y'].shape[0])
+                if self.anchor_index is not None:
+                    result.update(data['Y'][start:stop],
+                                  self.predict_indexed(data['X_csr'].rows(start, stop), data['Y'][start:stop]))
+                    continue
+                if self.is_sparse:
+                    X_ = data['X_csr'].rows(start, stop).to_sparse_tensor()
+                else:
+                    X_ = data['X_csr'].rows(start, stop).to_dense()
+                result.update(data['Y'][start:stop], self.predict_batch(X_, data['Y'][start:stop]))
+        return result.result()
+
+    def use_anchor_index(self, n_lists=None, n_probe=1):  # search the nearest anchors in an AnchorIndex at evaluation
+        if self.local_anchors <= 0 or self.towers > 1:
+            raise ValueError('the anchor index needs local_anchors > 0 and a single tower')
+        self.anchor_index = AnchorIndex(n_lists, n_probe)
+        return self.anchor_index
+
+    def update_anchor_index(self):  # rebuild the anchor index if training has moved the anchors
+        return self.anchor_index.update(self.sess.run(self.weights['anchor_points']))
+
+    def predict_indexed(self, X_csr, Y):  # predict the rows of a CSRDataset with the anchors found by the index
+        distances, anchors = self.anchor_index.search(X_csr, self.local_anchors)
+        # a missing anchor gets a zero coefficient
+        distances[anchors < 0] = 1e30
+        anchors[anchors < 0] = 0
+        feed_dict = {self.train_features: X_csr.to_sparse_tensor(), self.train_labels: Y[:, np.newaxis],
+                     self.dropout_keep: 1.0, self.train_phase: False,
+                     self.nearest_distance: -10 * distances, self.nearest_anchors: anchors}
+        return self.sess.run((self.out), feed_dict=feed_dict)
+
+    def predict_batch(self, X, Y):
+        feed_dict = {self.train_features: X, self.train_labels: Y[:, np.newaxis], self.dropout_keep: 1.0,
+                     self.train_phase: False}
+        return self.sess.run((self.out), feed_dict=feed_dict)
+
+
+def aggregate_gradients(gradients):  # sum of the gradients of the towers
+    gradients = [gradient for gradient in gradients if gradient is not None]
+    if not gradients:
+        return None
+    if all(isinstance(gradient, tf.IndexedSlices) for gradient in gradients):  # sparse aggregation
+        return tf.IndexedSlices(tf.concat([gradient.values for gradient in gradients], 0),
+                                tf.concat([gradient.indices for gradient in gradients], 0), gradients[0].dense_shape)
+    return tf.add_n([tf.convert_to_tensor(gradient) for gradient in gradients])
 
 
 if __name__ == '__main__':
     # Data loading
     args = parse_args()
-    data = DATA.LoadData(args.path, args.dataset, args.loss_type, False, True)
-    if 'X_sparse' not in data.Train_data:
-        data.Train_data['X_sparse_list'] = sparsify(data.Train_data['X'])
-        data.Train_data['X_sparse'] = sparse_concat(data.Train_data['X_sparse_list'], data.features_M)
-    if 'X_sparse' not in data.Validation_data:
-        data.Validation_data['X_sparse_list'] = sparsify(data.Validation_data['X'])
-        data.Validation_data['X_sparse'] = sparse_concat(data.Validation_data['X_sparse_list'], data.features_M)
-    if 'X_sparse' not in data.Test_data:
-        data.Test_data['X_sparse_list'] = sparsify(data.Test_data['X'])
-        data.Test_data['X_sparse'] = sparse_concat(data.Test_data['X_sparse_list'], data.features_M)
+    data = DATA.LoadData(args.path, args.dataset, args.loss_type, False, True, cache_dir=args.cache_dir,
+                         stream_train=args.stream, buffer_size=args.shuffle_buffer, passes=args.passes,
+                         hash_bits=args.hash_bits, signed_hash=args.signed_hash, min_count=args.min_count,
+                         max_features=args.max_features, oov_buckets=args.oov_buckets)
     if args.verbose > 0:
         print(
             "FM: dataset=%s, factors=%d, loss_type=%s, #epoch=%d, batch=%d, lr=%.4f, lambda=%.1e, keep=%.2f, optimizer=%s, batch_norm=%d"
@@ -388,19 +842,66 @@ if __name__ == '__main__':
     save_file = './pretrain/%s_%d/%s_%d' % (args.dataset, args.hidden_factor, args.dataset, args.hidden_factor)
     # Training
     t1 = time()
-    model = LLFM(data.features_M, args.pretrain, save_file, args.hidden_factor, args.anchor_points, args.loss_type,
-                 args.epoch,
-                 args.batch_size, args.lr, args.regularization_factor, args.keep_prob, args.optimizer, args.batch_norm,
-                 args.verbose, True)
-    model.train(data.Train_data, data.Validation_data, data.Test_data)
-
-    # Find the best validation result across iterations
-    best_valid_score = 0
-    if args.loss_type == 'square_loss':
-        best_valid_score = min(model.valid_rmse)
-    elif args.loss_type == 'log_loss':
-        best_valid_score = max(model.valid_rmse)
-    best_epoch = model.valid_rmse.index(best_valid_score)
-    print ("Best Iter(validation)= %d\t train = %.4f, valid = %.4f, test = %.4f [%.1f s]"
-           % (best_epoch + 1, model.train_rmse[best_epoch], model.valid_rmse[best_epoch], model.test_rmse[best_epoch],
-              time() - t1))
+    if args.ps_shards > 0:
+        # the shards apply the updates: plain SGD for GradientDescentOptimizer, Adagrad otherwise
+        import param_server
+        server = param_server.ParameterServer(
+            data.features_M, args.hidden_factor, args.anchor_points, args.ps_shards, args.ps_processes, args.lr,
+            'sgd' if args.optimizer == 'GradientDescentOptimizer' else 'adagrad')
+        model = param_server.ShardedLLFM(server, args.loss_type, args.epoch, args.batch_size,
+                                         args.regularization_factor, args.keep_prob, args.verbose,
+                                         eval_batch_size=args.eval_batch_size, drop_last=args.drop_last,
+                                         prefetch=args.prefetch, async_workers=args.async_workers)
+    else:
+        model = LLFM(data.features_M, args.pretrain, save_file, args.hidden_factor, args.anchor_points, args.loss_type,
+                     args.epoch,
+                     args.batch_size, args.lr, args.regularization_factor, args.keep_prob, args.optimizer,
+                     args.batch_norm, args.verbose, True, eval_batch_size=args.eval_batch_size,
+                     drop_last=args.drop_last, prefetch=args.prefetch, tf_data=args.tf_data,
+                     async_workers=args.async_workers, gather_active=args.gather_active,
+                     local_anchors=args.local_anchors, towers=args.towers, lazy_updates=args.lazy_updates,
+                     patience=args.patience, min_delta=args.min_delta, restore_best=args.restore_best)
+    if args.ps_shards == 0 and (args.init_fm or args.kmeans_anchors):
+        t2 = time()
+        weights = {}
+        if args.init_fm:
+            weights = warmstart.from_fm(warmstart.load_fm(args.init_fm), args.anchor_points, args.init_noise)
+        if args.kmeans_anchors:
+            weights['anchor_points'] = warmstart.kmeans_anchors(warmstart.sample_rows(data.Train_data),
+                                                                args.anchor_points, iterations=args.kmeans_iterations)
+        model.set_weights(weights)
+        if args.verbose > 0:
+            print("Warm start: %s [%.1f s]" % (', '.join(sorted(weights)), time() - t2))
+    if args.anchor_probe > 0:
+        model.use_anchor_index(args.anchor_lists or None, args.anchor_probe)
+    Train_data, Validation_data, Test_data = data.Train_data, data.Validation_data, data.Test_data
+    if args.tf_data:  # a streamed training set is parsed from its files (or cache shards) in the graph
+        Train_data, Validation_data, Test_data = [
+            tfdata.from_data(split, data.features_M, args.loss_type, shuffle_buffer=args.shuffle_buffer,
+                             hasher=data.hasher, remap=data.remap)
+            for split in [Train_data, Validation_data, Test_data]]
+    if args.checkpoint_dir and args.ps_shards == 0:
+        model.checkpointer = checkpoint.Checkpointer(model, args.checkpoint_dir, args.checkpoint_steps,
+                                                     args.full_every)
+    model.train(Train_data, Validation_data, Test_data)
+    if args.export:
+        inference.export(model, args.export)
+    if args.anchor_probe > 0 and args.verbose > 0:
+        X_ = data.Test_data['X_csr'].rows(0, min(args.eval_batch_size, len(data.Test_data['X_csr'])))
+        t2 = time()
+        model.anchor_index.search(X_, args.local_anchors)
+        t3 = time()
+        model.anchor_index.exact(X_, args.local_anchors)
+        print("Anchor index: recall@%d=%.4f, search %.1f ms, exact %.1f ms per %d rows"
+              % (args.local_anchors, model.anchor_index.recall(X_, args.local_anchors), 1000 * (t3 - t2),
+                 1000 * (time() - t3), len(X_)))
+
+    # The best validation result across iterations, in the direction of the metric
+    best_epoch = model.early_stopping.best_epoch
+    if best_epoch < 0:  # every validation result was nan or inf
+        print ("Best Iter(validation): no finite validation result in %d epochs [%.1f s]"
+               % (len(model.valid_rmse), time() - t1))
+    else:
+        print ("Best Iter(validation)= %d\t train = %.4f, valid = %.4f, test = %.4f [%.1f s]"
+               % (best_epoch + 1, model.train_rmse[best_epoch], model.valid_rmse[best_epoch],
+                  model.test_rmse[best_epoch], time() - t1))
@@ -8,7 +8,16 @@ Lizi Liao (liaolizi.llz@gmail.com)
 
 '''
 import numpy as np
+import os
 import random
+import datacache
+from featurehash import FeatureHasher
+from LoadData_nonsparse import LibFMStream, iter_libfm_blocks
+from pruning import drop_missing, report
+from sparsify import CSRDataset
+from vocab import Vocabulary, tokenize_block
+
+SPLITS = ['train', 'validation', 'test']
 
 
 class LoadData(object):
@@ -21,42 +30,103 @@ class LoadData(object):
     '''
 
     # Three files are needed in the path
-    def __init__(self, path, dataset, loss_type):
+    def __init__(self, path, dataset, loss_type, cache_dir=None, stream_train=False, buffer_size=100000, passes=1,
+                 hash_bits=0, vocab_file=None, min_count=1, max_features=0, oov_buckets=1):
         self.path = path + dataset + "/"
         self.trainfile = self.path + dataset + ".train.libfm"
         self.testfile = self.path + dataset + ".test.libfm"
         self.validationfile = self.path + dataset + ".validation.libfm"
-        self.features = {}
-        self.features_M = self.map_features()
+        # stream_train: Train_data is a LibFMStream over the training file instead of an in-memory dictionary
+        self.stream_train = stream_train
+        self.buffer_size = buffer_size
+        self.passes = passes
+        self.cached = {}
+        # hash_bits > 0: the entries are hashed into 2 ** hash_bits buckets (featurehash) instead of mapped in
+        # self.vocab, which stays empty. Entries carry no value here, so the hash is unsigned
+        self.hasher = FeatureHasher(hash_bits) if hash_bits > 0 else None
+        # vocab_file: the vocabulary is read from this file if it exists (entries missing in it are skipped), and
+        # written to it otherwise
+        self.vocab_file = vocab_file
+        self.vocab_loaded = vocab_file is not None and os.path.exists(vocab_file) and self.hasher is None
+        self.vocab = Vocabulary.load(vocab_file) if self.vocab_loaded else Vocabulary()
+        # min_count > 1 or max_features > 0: the vocabulary keeps the frequent entries of the training file, the
+        # others share oov_buckets rows (pruning)
+        self.min_count = min_count
+        self.max_features = max_features
+        self.oov_buckets = oov_buckets
+        self.pruned = (min_count > 1 or max_features > 0) and not self.vocab_loaded
+        if self.pruned and self.hasher is not None:
+            raise ValueError('pruning applies to the vocabulary, it cannot be combined with hashing')
+        if cache_dir is not None:
+            self.features_M = self.load_cache(cache_dir)
+        else:
+            self.features_M = self.map_features()
+        if vocab_file is not None and not self.vocab_loaded and self.hasher is None:
+            self.vocab.save(vocab_file)
         self.Train_data, self.Validation_data, self.Test_data = self.construct_data(loss_type)
 
-    def map_features(self):  # map the feature entries in all files, kept in self.features dictionary
-        self.read_features(self.trainfile)
-        self.read_features(self.testfile)
-        self.read_features(self.validationfile)
-        print("features_M:", len(self.features))
-        return len(self.features)
-
-    def read_features(self, file):  # read a feature file
-        f = open(file)
-        line = f.readline()
-        i = len(self.features)
-        while line:
-            items = line.strip().split(' ')
-            for item in items[1:]:
-                if item not in self.features:
-                    self.features[item] = i
-                    i = i + 1
-            line = f.readline()
-        f.close()
+    def load_cache(self, cache_dir):  # open the mapped files and the feature map from the binary cache
+        sources = [self.trainfile, self.validationfile, self.testfile]
+        params = {'loader': 'LoadData'}
+        if self.hasher is not None:
+            params['hash_bits'] = self.hasher.hash_bits
+        if self.pruned:
+            params.update(min_count=self.min_count, max_features=self.max_features, oov_buckets=self.oov_buckets)
+        # a loaded vocabulary decides the ids, it is a source of the entry
+        files = sources + [self.vocab_file] if self.vocab_loaded else sources
+        arrays, meta = datacache.load_or_build(cache_dir, files, self.build_cache, params=params)
+        self.vocab = Vocabulary(arrays['features'], meta.get('oov_buckets', 0))
+        for file, split in zip(sources, SPLITS):
+            self.cached[file] = (arrays[split + '_labels'], arrays[split + '_indptr'], arrays[split + '_indices'])
+        print("features_M:", meta['features_M'])
+        return meta['features_M']
+
+    def build_cache(self):
+        features_M = self.map_features()
+        arrays = {'features': self.vocab.tokens()}
+        for file, split in zip([self.trainfile, self.validationfile, self.testfile], SPLITS):
+            X_, Y_, _ = self.read_data(file)
+            arrays[split + '_labels'] = np.array(Y_)
+            arrays[split + '_indptr'] = np.cumsum([0] + [len(line) for line in X_])
+            arrays[split + '_indices'] = np.array([feature for line in X_ for feature in line], dtype=np.int64)
+        return arrays, {'features_M': features_M, 'oov_buckets': self.vocab.oov_buckets}
+
+    def map_features(self):  # map the feature entries in all files, kept in the self.vocab vocabulary
+        if self.hasher is not None:  # no pass over the files
+            print("features_M:", self.hasher.features_M)
+            return self.hasher.features_M
+        if self.pruned:  # only the entries of the training file are candidates
+            counts = self.read_features(self.trainfile)
+            self.vocab, kept = self.vocab.prune(counts, self.min_count, self.max_features, self.oov_buckets)
+            report(counts, kept, self.oov_buckets)
+        elif not self.vocab_loaded:
+            self.read_features(self.trainfile)
+            self.read_features(self.testfile)
+            self.read_features(self.validationfile)
+        print("features_M:", len(self.vocab) + self.vocab.oov_buckets)
+        return len(self.vocab) + self.vocab.oov_buckets
+
+    def read_features(self, file):  # add the entries of a feature file to self.vocab, a block at a time
+        counts = np.zeros([0], dtype=np.int64)  # No. of occurrences of every feature id in the file
+        for block in iter_libfm_blocks(file):
+            entries = tokenize_block(block)[2]
+            self.vocab.update(entries)
+            block_counts = self.vocab.counts(entries)
+            block_counts[:counts.shape[0]] += counts
+            counts = block_counts
+        return counts
 
     def construct_data(self, loss_type):
-        X_, Y_, Y_for_logloss = self.read_data(self.trainfile)
-        if loss_type == 'log_loss':
-            Train_data = self.construct_dataset(X_, Y_for_logloss)
+        if self.stream_train:
+            Train_data = self.construct_stream(self.trainfile, loss_type)
+            print("# of training: streamed")
         else:
-            Train_data = self.construct_dataset(X_, Y_)
-        print("# of training:", len(Y_))
+            X_, Y_, Y_for_logloss = self.read_data(self.trainfile)
+            if loss_type == 'log_loss':
+                Train_data = self.construct_dataset(X_, Y_for_logloss)
+            else:
+                Train_data = self.construct_dataset(X_, Y_)
+            print("# of training:", len(Y_))
 
         X_, Y_, Y_for_logloss = self.read_data(self.validationfile)
         if loss_type == 'log_loss':
@@ -76,26 +146,41 @@ class LoadData(object):
 
     def read_data(self, file):
         # read a data file. For a row, the first column goes into Y_;
-        # the other columns become a row in X_ and entries are maped to indexs in self.features
-        f = open(file)
-        X_ = []
-        Y_ = []
-        Y_for_logloss = []
-        line = f.readline()
-        while line:
-            items = line.strip().split(' ')
-            Y_.append(1.0 * float(items[0]))
-
-            if float(items[0]) > 0:  # > 0 as 1; others as 0
-                v = 1.0
-            else:
-                v = 0.0
-            Y_for_logloss.append(v)
-
-            X_.append([self.features[item] for item in items[1:]])
-            line = f.readline()
-        f.close()
-        return X_, Y_, Y_for_logloss
+        # the other columns become a row in X_ and entries are maped to indexs by self.vocab
+        if file in self.cached:
+            labels, indptr, indices = self.cached.pop(file)
+            indices = indices.tolist()
+            X_ = [indices[start:end] for start, end in zip(indptr[:-1], indptr[1:])]
+            return X_, labels.tolist(), (labels > 0).astype(np.float64).tolist()
+        labels, row_nnz, indices = [np.zeros([0])], [np.zeros([0], dtype=np.int64)], [np.zeros([0], dtype=np.int64)]
+        for block in iter_libfm_blocks(file):
+            labels_, row_nnz_, indices_, _ = self.parse_block(block)
+            labels.append(labels_)
+            row_nnz.append(row_nnz_)
+            indices.append(indices_)
+        labels = np.concatenate(labels)
+        indptr = np.cumsum(np.concatenate([[0]] + row_nnz))
+        indices = np.concatenate(indices).tolist()
+        X_ = [indices[start:end] for start, end in zip(indptr[:-1], indptr[1:])]
+        return X_, labels.tolist(), (labels > 0).astype(np.float64).tolist()  # > 0 as 1; others as 0
+
+    def construct_stream(self, file, loss_type):
+        if file in self.cached:  # memory-mapped arrays of the binary cache
+            labels, indptr, indices = self.cached.pop(file)
+            source = (labels, CSRDataset(indptr, indices, np.broadcast_to(np.float32(1), indices.shape), self.features_M))
+        else:
+            source = file
+        return LibFMStream([source], self.features_M, loss_type, self.buffer_size, self.passes,
+                           parse_block=self.parse_block)
+
+    def parse_block(self, block):  # parse a block of libFM lines for LibFMStream, entries are maped by self.vocab
+        labels, row_nnz, entries = tokenize_block(block)
+        if self.hasher is not None:
+            indices = self.hasher.hash_tokens(entries)[0]
+        else:
+            indices = self.vocab.lookup(entries)
+        row_nnz, indices, _ = drop_missing(row_nnz, indices)  # entries missing in the vocabulary are skipped
+        return labels, row_nnz, indices, np.ones(indices.shape[0])
 
     def construct_dataset(self, X_, Y_):
         Data_Dic = {}
@@ -11,140 +11,457 @@ import numpy as np
 import random
 import os
 import pickle
-from sparsify import sparse_concat
+import datacache
+from featurehash import FeatureHasher
+from pruning import IdRemap, report, select_features
+from sparsify import CSRDataset, csr_concat, index_dtype, sparsify
+
+CHUNK_BYTES = 1 << 26  # size of the byte blocks read by read_libfm
+SPLITS = ['train', 'validation', 'test']
+CSR_FIELDS = ['labels', 'indptr', 'indices', 'values']
+SHARD_ROWS = 1 << 16  # rows read at a time from an in-memory or memory-mapped shard
+
+
+def read_libfm(file, chunk_bytes=CHUNK_BYTES, parse_block=None):
+    '''parse a libFM file in a single pass over large byte blocks
+    :param file: path of the libFM file
+    :param chunk_bytes: size of each block read from the file
+    :param parse_block: function parsing a block of libFM lines into labels, row lengths, feature ids and values,
+    None: parse_libfm_block
+    return: labels, indptr, indices, values (the CSR arrays of the file) and features_M (max feature id + 1)
+    '''
+    parse_block = parse_block or parse_libfm_block
+    parsed = list(zip(*[parse_block(block) for block in iter_libfm_blocks(file, chunk_bytes)]))
+    if not parsed:
+        parsed = [[np.zeros([0])], [np.zeros([0], dtype=np.int64)], [np.zeros([0], dtype=np.int64)], [np.zeros([0])]]
+    labels, row_nnz, indices, values = [np.concatenate(arrays) for arrays in parsed]
+    indptr = np.zeros([row_nnz.shape[0] + 1], dtype=np.int64)
+    np.cumsum(row_nnz, out=indptr[1:])
+    features_M = int(indices.max()) + 1 if indices.shape[0] > 0 else 0
+    return labels, indptr, indices, values, features_M
+
+
+def scan_libfm(file, chunk_bytes=CHUNK_BYTES):
+    '''features_M and the number of rows of a libFM file, holding one block of the file in memory at a time'''
+    features_M, num = 0, 0
+    for block in iter_libfm_blocks(file, chunk_bytes):
+        labels, row_nnz, indices, values = parse_libfm_block(block)
+        if indices.shape[0] > 0:
+            features_M = max(features_M, int(indices.max()) + 1)
+        num = num + labels.shape[0]
+    return features_M, num
+
+
+def size_libfm(file, chunk_bytes=CHUNK_BYTES):
+    '''No. of rows and of entries of a libFM file, counted on the bytes of its blocks without parsing the numbers'''
+    num, nnz = 0, 0
+    for block in iter_libfm_blocks(file, chunk_bytes):
+        bounds, visible = line_bounds(np.frombuffer(block, dtype=np.uint8))
+        num, nnz = num + np.count_nonzero(visible), nnz + block.count(b':')
+    return num, nnz
+
+
+def iter_libfm_blocks(file, chunk_bytes=CHUNK_BYTES):
+    '''read a libFM file in large byte blocks, each block ends at the end of a line'''
+    tail = b''
+    with open(file, 'rb') as f:
+        block = f.read(chunk_bytes)
+        while block:
+            block = tail + block
+            end = block.rfind(b'\n') + 1  # only complete lines are parsed, the rest goes to the next block
+            tail = block[end:]
+            if end > 0:
+                yield block[:end]
+            block = f.read(chunk_bytes)
+    if tail.strip():
+        yield tail
+
+
+def line_bounds(buf):  # offsets of the lines of a block of bytes, and whether each line holds a visible character
+    line_ends = np.flatnonzero(buf == ord('\n')) + 1
+    if line_ends.shape[0] == 0 or line_ends[-1] != buf.shape[0]:
+        line_ends = np.append(line_ends, buf.shape[0])
+    bounds = np.concatenate([[0], line_ends])
+    return bounds, np.diff(np.searchsorted(np.flatnonzero(buf > ord(' ')), bounds)) > 0
+
+
+def parse_libfm_block(block):
+    '''parse a block of complete libFM lines with bulk numpy tokenization
+    return: labels, number of features of each row, feature ids and feature values
+    '''
+    buf = np.frombuffer(block, dtype=np.uint8)
+    bounds, visible = line_bounds(buf)
+    # every 'id:value' pair holds exactly one colon; lines without a visible character are skipped
+    row_nnz = np.diff(np.searchsorted(np.flatnonzero(buf == ord(':')), bounds))[visible]
+
+    numbers = np.fromstring(block.replace(b':', b' '), dtype=np.float64, sep=' ')
+    row_length = 2 * row_nnz + 1
+    if numbers.shape[0] != row_length.sum():
+        raise ValueError('malformed libFM data: %d numbers parsed, %d expected' % (numbers.shape[0], row_length.sum()))
+    is_label = np.zeros(numbers.shape[0], dtype=bool)
+    is_label[np.cumsum(row_length) - row_length] = True
+    pairs = numbers[~is_label].reshape([-1, 2])
+    return numbers[is_label], row_nnz, pairs[:, 0].astype(np.int64), pairs[:, 1]
+
+
+class LibFMStream(object):
+    '''training data read as a stream of minibatches, for data sets which do not fit in memory
+    At most one block of the sources and buffer_size rows are held in memory, whatever the size of the data set.
+    :param sources: paths of libFM files, or (labels, CSRDataset) shards such as the memory-mapped arrays of datacache
+    :param features_M: No. of features in the input data
+    :param loss_type: labels are mapped to 0/1 for log_loss
+    :param buffer_size: No. of rows shuffled together, 0: keep the order of the sources
+    :param passes: No. of passes over the sources in an epoch
+    :param parse_block: function parsing a block of libFM lines into labels, row lengths, feature ids and values
+    :param random_seed:
+    '''
+
+    def __init__(self, sources, features_M, loss_type, buffer_size=100000, passes=1, parse_block=parse_libfm_block,
+                 chunk_bytes=CHUNK_BYTES, random_seed=2016):
+        self.sources = sources
+        self.features_M = features_M
+        self.loss_type = loss_type
+        self.buffer_size = buffer_size
+        self.passes = passes
+        self.parse_block = parse_block
+        self.chunk_bytes = chunk_bytes
+        self.random_state = np.random.RandomState(random_seed)
+        # range of the labels streamed so far
+        self.y_min, self.y_max = np.inf, -np.inf
+
+    def batches(self, batch_size):  # the minibatches of an epoch, as {'X_csr': CSRDataset, 'Y': labels} dictionaries
+        for _ in range(self.passes):
+            buffer_Y, buffer_X = [], []
+            num = 0
+            for Y_, X_csr in self.read_chunks():
+                buffer_Y.append(Y_)
+                buffer_X.append(X_csr)
+                num = num + Y_.shape[0]
+                # emit the full batches of a shuffled buffer, half of the buffer is kept to mix with the next rows
+                emit = (num - self.buffer_size // 2) // batch_size * batch_size
+                if num >= self.buffer_size and emit > 0:
+                    Y_, X_csr, order = self.shuffle(buffer_Y, buffer_X)
+                    for start in range(0, emit, batch_size):
+                        yield {'X_csr': X_csr.take(order[start:start + batch_size]),
+                               'Y': Y_[order[start:start + batch_size]]}
+                    buffer_Y, buffer_X = [Y_[order[emit:]]], [X_csr.take(order[emit:])]
+                    num = num - emit
+            if num > 0:
+                Y_, X_csr, order = self.shuffle(buffer_Y, buffer_X)
+                for start in range(0, num, batch_size):
+                    yield {'X_csr': X_csr.take(order[start:start + batch_size]), 'Y': Y_[order[start:start + batch_size]]}
+
+    def shuffle(self, buffer_Y, buffer_X):
+        Y_ = np.concatenate(buffer_Y)
+        if self.buffer_size > 0:
+            order = self.random_state.permutation(Y_.shape[0])
+        else:
+            order = np.arange(Y_.shape[0])
+        return Y_, csr_concat(buffer_X), order
+
+    def read_chunks(self):  # (labels, CSRDataset) chunks of the sources
+        for source in self.sources:
+            if isinstance(source, tuple):
+                labels, X_csr = source
+                for start in range(0, labels.shape[0], SHARD_ROWS):
+                    stop = min(start + SHARD_ROWS, labels.shape[0])
+                    yield self.labels(labels[start:stop]), X_csr.rows(start, stop)
+            else:
+                for block in iter_libfm_blocks(source, self.chunk_bytes):
+                    labels, row_nnz, indices, values = self.parse_block(block)
+                    indptr = np.zeros([row_nnz.shape[0] + 1], dtype=np.int64)
+                    np.cumsum(row_nnz, out=indptr[1:])
+                    yield self.labels(labels), CSRDataset(indptr, indices, values, self.features_M).compact()
+
+    def labels(self, labels):
+        if self.loss_type == 'log_loss':
+            labels = labels > 0  # > 0 as 1; others as 0
+        labels = np.asarray(labels, dtype=np.float32)
+        if labels.shape[0] > 0:
+            self.y_min, self.y_max = min(self.y_min, labels.min()), max(self.y_max, labels.max())
+        return labels
 
 
 class LoadData(object):
     '''given the path of data, return the data format for DeepFM
     :param path
     return:
-    Train_data: a dictionary, 'Y' refers to a list of y values; 'X' refers to a list of features_M dimension vectors with 0 or 1 entries
+    Train_data: a dictionary, 'Y' refers to an array of y values; 'X_csr' refers to the CSRDataset of the rows, in the
+    compact form (int32 ids, float32 values). Dense rows and SparseTensorValues are built from it batch by batch
     Test_data: same as Train_data
     Validation_data: same as Train_data
     '''
 
     # Three files are needed in the path
-    def __init__(self, path, dataset, loss_type, from_file=False, is_sparse=False):
+    def __init__(self, path, dataset, loss_type, from_file=False, is_sparse=False, cache_dir=None, stream_train=False,
+                 buffer_size=100000, passes=1, hash_bits=0, signed_hash=False, min_count=1, max_features=0,
+                 oov_buckets=1):
         self.path = path + dataset + "/"
         self.trainfile = self.path + dataset + ".train.libfm"
         self.testfile = self.path + dataset + ".test.libfm"
         self.validationfile = self.path + dataset + ".validation.libfm"
-        self.is_sparse = is_sparse
-        if from_file:
-            self.Train_data = pickle.load(open(os.path.join(self.path, dataset + '.train.dat')))
-            self.Test_data = pickle.load(open(os.path.join(self.path, dataset + '.test.dat')))
-            self.Validation_data = pickle.load(open(os.path.join(self.path, dataset + '.validation.dat')))
-            self.features_M = self.Train_data['X'].shape[1]
+        self.is_sparse = is_sparse  # the rows are kept as a CSRDataset either way, models densify their batches
+        # stream_train: Train_data is a LibFMStream over the training file instead of an in-memory dictionary
+        self.stream_train = stream_train
+        self.buffer_size = buffer_size
+        self.passes = passes
+        # hash_bits > 0: the feature ids of the libFM files are hashed into 2 ** hash_bits buckets (featurehash)
+        self.hasher = FeatureHasher(hash_bits, signed_hash) if hash_bits > 0 else None
+        # min_count > 1 or max_features > 0: the frequent ids of the training file are kept, the others share
+        # oov_buckets rows (pruning). self.remap maps the raw ids once it is built from the training counts
+        self.min_count = min_count
+        self.max_features = max_features
+        self.oov_buckets = oov_buckets
+        self.pruned = min_count > 1 or max_features > 0
+        self.remap = None
+        self.train_label_range = None  # [min, max] of the training labels, when the binary cache holds it
+        if self.pruned and self.hasher is not None:
+            raise ValueError('pruning applies to the raw feature ids, it cannot be combined with hashing')
+        if cache_dir is not None:
+            self.features_M = self.load_cache(cache_dir, dataset, from_file)
+            self.Train_data, self.Validation_data, self.Test_data = self.construct_data(loss_type)
+        elif from_file:  # the pickled splits are hashed or pruned as the libFM files are
+            parsed = [self.read_pickled(os.path.join(self.path, dataset + '.' + split + '.dat'), split)
+                      for split in SPLITS]
+            if self.hasher is not None:
+                self.features_M = self.hasher.features_M
+            elif self.remap is not None:
+                self.features_M = self.remap.features_M
+            else:
+                self.features_M = max(features_M for Y_, indptr, indices, values, features_M in parsed)
+            self.Train_data, self.Validation_data, self.Test_data = [
+                self.construct_dataset(np.asarray(Y_, dtype=np.float32),
+                                       CSRDataset(indptr, indices, values, self.features_M).compact())
+                for Y_, indptr, indices, values, features_M in parsed]
         else:
             self.features_M = self.map_features()
             self.Train_data, self.Validation_data, self.Test_data = self.construct_data(loss_type)
 
-    def map_features(self):  # map the feature entries in all files, kept in self.features dictionary
-        features_train, self.train_num = self.read_features(self.trainfile)
+    def map_features(self):  # parse all files once, features_M and the row counts come from the same pass
+        self.parsed = {}
+        if self.stream_train and self.hasher is not None:  # features_M is known, a streamed file is not scanned
+            features_train, self.train_num = 0, None
+        elif self.stream_train and self.pruned:
+            counts, self.train_num = self.count_features(self.trainfile)
+            self.prune(counts)
+        elif self.stream_train:
+            features_train, self.train_num = scan_libfm(self.trainfile)
+        else:
+            features_train, self.train_num = self.read_features(self.trainfile)
+            if self.pruned:
+                self.parsed[self.trainfile] = self.prune(self.parsed[self.trainfile])
+        # the ids of the validation and test files are remapped as they are parsed
         features_validation, self.validation_num = self.read_features(self.validationfile)
         features_test, self.test_num = self.read_features(self.testfile)
+        if self.hasher is not None:
+            return self.hasher.features_M
+        if self.remap is not None:
+            return self.remap.features_M
         return max([features_train, features_validation, features_test])
 
     def read_features(self, file):  # read a feature file
+        self.parsed[file] = read_libfm(file, parse_block=self.parse_block)
+        Y_, indptr, indices, values, features_M = self.parsed[file]
+        return features_M, Y_.shape[0]
+
+    def parse_block(self, block):  # parse_libfm_block, with the feature ids hashed or remapped when these are on
+        labels, row_nnz, indices, values = parse_libfm_block(block)
+        if self.hasher is not None:
+            indices, values = self.hasher.transform(indices, values)
+        if self.remap is not None:
+            row_nnz, indices, values = self.remap.transform(row_nnz, indices, values)
+        return labels, row_nnz, indices, values
+
+    def count_features(self, file):  # No. of occurrences of every raw feature id of a file, and its No. of rows
+        counts, num = np.zeros([0], dtype=np.int64), 0
+        for block in iter_libfm_blocks(file):
+            labels, row_nnz, indices, values = parse_libfm_block(block)
+            block_counts = np.bincount(indices, minlength=counts.shape[0])
+            block_counts[:counts.shape[0]] += counts
+            counts, num = block_counts, num + labels.shape[0]
+        return counts, num
+
+    def prune(self, counts):
+        '''build self.remap from the training counts (an array of counts, or the parsed arrays of the training file)
+        return: the parsed arrays remapped, if given
+        '''
+        parsed = None
+        if isinstance(counts, tuple):
+            parsed = counts
+            counts = np.bincount(parsed[2], minlength=parsed[4])
+        kept = select_features(counts, self.min_count, self.max_features)
+        self.remap = IdRemap(kept, self.oov_buckets)
+        report(counts, kept, self.oov_buckets)
+        if parsed is not None:
+            return self.remap_parsed(parsed)
+
+    def remap_parsed(self, parsed):  # the ids of parsed arrays remapped by self.remap
+        Y_, indptr, indices, values, _ = parsed
+        row_nnz, indices, values = self.remap.transform(np.diff(indptr), indices, values)
+        indptr = np.zeros([row_nnz.shape[0] + 1], dtype=np.int64)
+        np.cumsum(row_nnz, out=indptr[1:])
+        return Y_, indptr, indices, values, self.remap.features_M
+
+    def read_pickled(self, source, split):  # parsed arrays of a pickled split (dense 'X' and 'Y'), hashed or remapped
+        data = pickle.load(open(source))
+        X_csr = sparsify(np.asarray(data['X']))
+        indices, values = X_csr.indices, X_csr.values
+        if self.hasher is not None:
+            indices, values = self.hasher.transform(indices, values)
+        parsed = (data['Y'], X_csr.indptr, indices, values, X_csr.features_M)
+        if self.pruned and split == 'train':  # the training split comes first, its counts make the remap
+            return self.prune(parsed)
+        if self.remap is not None:
+            return self.remap_parsed(parsed)
+        return parsed
+
+    def load_cache(self, cache_dir, dataset, from_file):  # open the parsed files from the binary cache
+        if from_file:
+            sources = [os.path.join(self.path, dataset + '.' + split + '.dat') for split in SPLITS]
+        else:
+            sources = [self.trainfile, self.validationfile, self.testfile]
+        params = {'loader': 'LoadData_nonsparse'}
+        if self.hasher is not None:
+            params.update(hash_bits=self.hasher.hash_bits, signed_hash=self.hasher.signed)
+        if self.pruned:
+            params.update(min_count=self.min_count, max_features=self.max_features, oov_buckets=self.oov_buckets)
+        arrays, meta = datacache.load_or_build(cache_dir, sources,
+                                               lambda: self.build_cache(sources, from_file, cache_dir), params=params)
+        self.parsed = {}
+        for file, split in zip([self.trainfile, self.validationfile, self.testfile], SPLITS):
+            self.parsed[file] = tuple(arrays[split + '_' + field] for field in CSR_FIELDS) + (meta['features_M'],)
+        self.train_num = self.parsed[self.trainfile][0].shape[0]
+        self.validation_num = self.parsed[self.validationfile][0].shape[0]
+        self.test_num = self.parsed[self.testfile][0].shape[0]
+        self.train_label_range = meta.get('train_label_range')
+        return meta['features_M']
+
+    def build_cache(self, sources, from_file, cache_dir):
+        arrays = {}
         features_M = 0
-        num = 0
-        for line in open(file, 'r'):
-            items = line.strip().split(' ')
-            num = num + 1
-            for item in items[1:]:
-                feature_id = int(item.strip().split(':')[0])
-                if features_M < feature_id + 1:
-                    features_M = feature_id + 1
-
-        return features_M, num
+        for split, source in zip(SPLITS, sources):
+            if from_file:
+                parsed = self.read_pickled(source, split)
+            elif self.stream_train and split == 'train':  # a streamed training file is not held in memory
+                parsed = self.write_libfm(source, cache_dir)
+            else:
+                parsed = read_libfm(source, parse_block=self.parse_block)
+                if self.pruned and split == 'train':  # the training file comes first, its counts make the remap
+                    parsed = self.prune(parsed)
+            if split == 'train' and self.train_label_range is None and parsed[0].shape[0] > 0:
+                self.train_label_range = [float(np.min(parsed[0])), float(np.max(parsed[0]))]
+            for field, array in zip(CSR_FIELDS, parsed):
+                arrays[split + '_' + field] = array
+            arrays[split + '_values'] = arrays[split + '_values'].astype(np.float32, copy=False)
+            features_M = max(features_M, parsed[4])
+        if self.hasher is not None:
+            features_M = self.hasher.features_M
+        elif self.remap is not None:
+            features_M = self.remap.features_M
+        for split in SPLITS:  # the compact ids are memory-mapped as they are
+            indices = arrays[split + '_indices']
+            if isinstance(indices, np.memmap) and indices.dtype != index_dtype(features_M):  # ids past int32
+                arrays[split + '_indices'] = datacache.cast_array(indices, index_dtype(features_M), cache_dir)
+            else:
+                arrays[split + '_indices'] = indices.astype(index_dtype(features_M), copy=False)
+        return arrays, {'features_M': features_M, 'train_label_range': self.train_label_range}
+
+    def write_libfm(self, file, cache_dir):
+        '''parse a libFM file into the memory maps of datacache.open_array, holding one block in memory at a time
+        The arrays are sized by a first pass over the bytes of the file (the feature counts when pruning), the range
+        of the labels is kept in self.train_label_range.
+        return: labels, indptr, indices, values and features_M, as read_libfm
+        '''
+        if self.pruned:  # the training counts make the remap
+            counts, num = self.count_features(file)
+            self.prune(counts)
+            nnz = int(np.sum(counts if self.oov_buckets > 0 else counts[self.remap.kept]))
+        else:
+            num, nnz = size_libfm(file)
+        known_M = self.hasher.features_M if self.hasher is not None else self.remap.features_M if self.pruned else 0
+        labels = datacache.open_array(cache_dir, (num,), np.float64)
+        indptr = datacache.open_array(cache_dir, (num + 1,), np.int64)
+        indices = datacache.open_array(cache_dir, (nnz,), index_dtype(known_M))
+        values = datacache.open_array(cache_dir, (nnz,), np.float32)
+        row, entry, features_M = 0, 0, 0
+        y_min, y_max = np.inf, -np.inf
+        for block in iter_libfm_blocks(file):
+            block_labels, row_nnz, block_indices, block_values = self.parse_block(block)
+            rows, entries = block_labels.shape[0], block_indices.shape[0]
+            if row + rows > num or entry + entries > nnz:
+                raise ValueError('%s changed while it was cached' % file)
+            if entries > 0 and block_indices.max() > np.iinfo(indices.dtype).max:  # raw ids past int32
+                indices = datacache.cast_array(indices, np.int64, cache_dir)
+            labels[row:row + rows] = block_labels
+            indptr[row + 1:row + rows + 1] = entry + np.cumsum(row_nnz)
+            indices[entry:entry + entries] = block_indices
+            values[entry:entry + entries] = block_values
+            row, entry = row + rows, entry + entries
+            if rows > 0:
+                y_min, y_max = min(y_min, block_labels.min()), max(y_max, block_labels.max())
+            if entries > 0:
+                features_M = max(features_M, int(block_indices.max()) + 1)
+        if (row, entry) != (num, nnz):
+            raise ValueError('%s changed while it was cached' % file)
+        indptr[0] = 0
+        if num > 0:
+            self.train_label_range = [float(y_min), float(y_max)]
+        return labels, indptr, indices, values, features_M
 
     def construct_data(self, loss_type):
-        X_, Y_, Y_for_logloss, X_sparse_list, X_sparse = self.read_data(self.trainfile, self.train_num)
-        if loss_type == 'log_loss':
-            Train_data = self.construct_dataset(X_, Y_for_logloss, X_sparse_list, X_sparse)
+        if self.stream_train:
+            Train_data = self.construct_stream(self.trainfile, loss_type)
         else:
-            Train_data = self.construct_dataset(X_, Y_, X_sparse_list, X_sparse)
-        print("# of training:", len(Y_))
+            Y_, Y_for_logloss, X_csr = self.read_data(self.trainfile, self.train_num)
+            if loss_type == 'log_loss':
+                Train_data = self.construct_dataset(Y_for_logloss, X_csr)
+            else:
+                Train_data = self.construct_dataset(Y_, X_csr)
+        print("# of training:", self.train_num if self.train_num is not None else 'streamed')
 
-        X_, Y_, Y_for_logloss, X_sparse_list, X_sparse = self.read_data(self.validationfile, self.validation_num)
+        Y_, Y_for_logloss, X_csr = self.read_data(self.validationfile, self.validation_num)
         if loss_type == 'log_loss':
-            Validation_data = self.construct_dataset(X_, Y_for_logloss, X_sparse_list, X_sparse)
+            Validation_data = self.construct_dataset(Y_for_logloss, X_csr)
         else:
-            Validation_data = self.construct_dataset(X_, Y_, X_sparse_list, X_sparse)
+            Validation_data = self.construct_dataset(Y_, X_csr)
         print("# of validation:", len(Y_))
 
-        X_, Y_, Y_for_logloss, X_sparse_list, X_sparse = self.read_data(self.testfile, self.test_num)
+        Y_, Y_for_logloss, X_csr = self.read_data(self.testfile, self.test_num)
         if loss_type == 'log_loss':
-            Test_data = self.construct_dataset(X_, Y_for_logloss, X_sparse_list, X_sparse)
+            Test_data = self.construct_dataset(Y_for_logloss, X_csr)
         else:
-            Test_data = self.construct_dataset(X_, Y_, X_sparse_list, X_sparse)
+            Test_data = self.construct_dataset(Y_, X_csr)
         print("# of test:", len(Y_))
 
         return Train_data, Validation_data, Test_data
 
     def read_data(self, file, data_num):
-        # read a data file. For a row, the first column goes into Y_;
-        # the other columns become a row in X_ and entries are maped to indexs in self.features
-        if not self.is_sparse:
-            X_ = np.zeros([data_num, self.features_M], dtype=np.float32)
+        # build the data of a file from its parsed CSR arrays. For a row, the label goes into Y_;
+        # the (feature id, value) pairs become a row of X_csr, the only copy of the features
+        Y_, indptr, indices, values, _ = self.parsed.pop(file)
+        Y_ = Y_.astype(np.float32)
+        Y_for_logloss = (Y_ > 0).astype(np.float32)  # > 0 as 1; others as 0
+        X_csr = CSRDataset(indptr, indices, values, self.features_M).compact()
+        return Y_, Y_for_logloss, X_csr
+
+    def construct_stream(self, file, loss_type):
+        if file in self.parsed:  # memory-mapped arrays of the binary cache
+            Y_, indptr, indices, values, _ = self.parsed.pop(file)
+            source = (Y_, CSRDataset(indptr, indices, values, self.features_M).compact())
         else:
-            X_ = None
-        Y_ = np.zeros([data_num], dtype=np.float32)
-        X_sparse_list = []
-        Y_for_logloss = np.zeros([data_num], dtype=np.float32)
-        i = 0
-        for line in open(file, 'r'):
-            indices = []
-            values = []
-            items = line.strip().split(' ')
-            Y_[i] = 1.0 * float(items[0])
-
-            if float(items[0]) > 0:  # > 0 as 1; others as 0
-                v = 1.0
-            else:
-                v = 0.0
-            Y_for_logloss[i] = v
-
-            for item in items[1:]:
-                key_value_pair = item.strip().split(':')
-                key = int(key_value_pair[0])
-                value = float(key_value_pair[1])
-                if not self.is_sparse:
-                    X_[i, key] = float(value)
-                indices.append(key)
-                values.append(float(value))
-            X_sparse_list.append({'indices': indices, 'values': values})
-
-            i = i + 1
-
-        X_sparse = sparse_concat(X_sparse_list, self.features_M)
-
-        return X_, Y_, Y_for_logloss, X_sparse_list, X_sparse
-
-    def construct_dataset(self, X_, Y_, X_sparse_list, X_sparse):
+            source = file
+        stream = LibFMStream([source], self.features_M, loss_type, self.buffer_size, self.passes,
+                             parse_block=self.parse_block)
+        if self.train_label_range is not None:  # the range of the cached labels, the stream needs no pass to find it
+            stream.labels(np.asarray(self.train_label_range))
+        return stream
+
+    def construct_dataset(self, Y_, X_csr):
         Data_Dic = {}
         Data_Dic['Y'] = Y_
-        Data_Dic['X'] = X_
-        Data_Dic['X_sparse_list'] = X_sparse_list
-        Data_Dic['X_sparse'] = X_sparse
+        Data_Dic['X_csr'] = X_csr
         return Data_Dic
 
-    def truncate_features(self):
-        """
-        Make sure each feature vector is of the same length
-        """
-        num_variable = len(self.Train_data['X'][0])
-        for i in xrange(len(self.Train_data['X'])):
-            num_variable = min([num_variable, len(self.Train_data['X'][i])])
-        # truncate train, validation and test
-        for i in xrange(len(self.Train_data['X'])):
-            self.Train_data['X'][i] = self.Train_data['X'][i][0:num_variable]
-        for i in xrange(len(self.Validation_data['X'])):
-            self.Validation_data['X'][i] = self.Validation_data['X'][i][0:num_variable]
-        for i in xrange(len(self.Test_data['X'])):
-            self.Test_data['X'][i] = self.Test_data['X'][i][0:num_variable]
-        return num_variable
-
 
 def transform_data(dataset='data/banana/banana'):
     random.seed(2017)
@@ -0,0 +1,108 @@
+'''
+Approximate nearest-anchor search for LLFM inference.
+
+The anchors of LLFM are the columns of weights['anchor_points'] ([features_M, A]). AnchorIndex clusters them with
+k-means into n_lists cells (a coarse quantizer); a sample is compared to the centroids of the cells and the exact
+distance is computed only to the anchors of its n_probe nearest cells, so a query costs about
+nnz * (n_lists + n_probe * A / n_lists) instead of nnz * A. n_probe = n_lists is the exact search.
+
+'''
+import hashlib
+import numpy as np
+
+
+def fingerprint(anchors):  # content hash of an anchor matrix
+    anchors = np.ascontiguousarray(anchors)
+    return hashlib.sha1(str(anchors.shape).encode('utf-8') + anchors.tobytes()).hexdigest()
+
+
+class AnchorIndex(object):
+    '''
+    :param n_lists: No. of k-means cells, None: sqrt(A)
+    :param n_probe: No. of cells searched for each sample
+    :param iterations: No. of k-means iterations
+    '''
+
+    def __init__(self, n_lists=None, n_probe=1, iterations=10, random_seed=2016):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.iterations = iterations
+        self.random_seed = random_seed
+        self.fingerprint = None
+
+    def update(self, anchors):  # rebuild the index when the anchors have changed, return: whether it was rebuilt
+        key = fingerprint(anchors)
+        if key == self.fingerprint:
+            return False
+        self.build(anchors)
+        self.fingerprint = key
+        return True
+
+    def build(self, anchors):
+        self.anchors = np.asarray(anchors, dtype=np.float64)  # features_M * A
+        self.anchor_norms = np.sum(np.square(self.anchors), 0)  # A
+        num_anchors = self.anchors.shape[1]
+        n_lists = self.n_lists or int(round(np.sqrt(num_anchors)))
+        n_lists = max(1, min(n_lists, num_anchors))
+
+        # k-means over the anchors, empty cells keep their centroid
+        points = self.anchors.T  # A * features_M
+        random_state = np.random.RandomState(self.random_seed)
+        centroids = points[random_state.choice(num_anchors, n_lists, replace=False)]  # n_lists * features_M
+        for _ in range(self.iterations):
+            assignment = np.argmin(np.sum(np.square(centroids), 1) - 2 * np.dot(points, centroids.T), 1)
+            counts = np.bincount(assignment, minlength=n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, points)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+        assignment = np.argmin(np.sum(np.square(centroids), 1) - 2 * np.dot(points, centroids.T), 1)
+
+        self.centroids = np.ascontiguousarray(centroids.T)  # features_M * n_lists
+        self.centroid_norms = np.sum(np.square(centroids), 1)  # n_lists
+        # the anchors of cell l are list_anchors[list_ptr[l]:list_ptr[l + 1]]
+        self.list_anchors = np.argsort(assignment, kind='mergesort')
+        self.list_ptr = np.zeros([n_lists + 1], dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=self.list_ptr[1:])
+
+    def search(self, X, k, n_probe=None):
+        '''k nearest anchors of the rows of a CSRDataset
+        Anchors outside the probed cells are not candidates; when fewer than k anchors are candidates the remaining
+        slots hold the anchor -1 at distance inf.
+        return: distances (None * k, ascending), anchors (None * k)
+        '''
+        n_lists = self.list_ptr.shape[0] - 1
+        n_probe = min(n_probe or self.n_probe, n_lists)
+        if n_probe < n_lists:
+            centroid_distance = self.centroid_norms - 2 * X.dot(self.centroids)  # None * n_lists
+            probes = np.argpartition(centroid_distance, n_probe - 1, axis=1)[:, :n_probe]
+        else:
+            probes = np.tile(np.arange(n_lists), (len(X), 1))
+
+        distance = np.full([len(X), self.anchors.shape[1]], np.inf)
+        for cell in range(n_lists):
+            rows = np.nonzero(np.any(probes == cell, axis=1))[0]
+            members = self.list_anchors[self.list_ptr[cell]:self.list_ptr[cell + 1]]
+            if rows.shape[0] == 0 or members.shape[0] == 0:
+                continue
+            distance[rows[:, np.newaxis], members] = self.anchor_norms[members] - 2 * X.take(rows).dot(
+                self.anchors[:, members])
+        distance += X.square_norms()[:, np.newaxis]
+
+        k = min(k, distance.shape[1])
+        rows = np.arange(len(X))[:, np.newaxis]
+        anchors = np.argpartition(distance, k - 1, axis=1)[:, :k] if k < distance.shape[1] else np.tile(
+            np.arange(k), (len(X), 1))
+        order = np.argsort(distance[rows, anchors], axis=1, kind='mergesort')
+        anchors = anchors[rows, order]
+        distances = distance[rows, anchors]
+        anchors[np.isinf(distances)] = -1
+        return np.sqrt(np.maximum(distances, 0)), anchors
+
+    def exact(self, X, k):  # exact k nearest anchors, the search over all the cells
+        return self.search(X, k, n_probe=self.list_ptr.shape[0] - 1)
+
+    def recall(self, X, k, n_probe=None):  # fraction of the exact k nearest anchors found by the search
+        _, found = self.search(X, k, n_probe)
+        _, exact = self.exact(X, k)
+        return np.mean(np.any(exact[:, :, np.newaxis] == found[:, np.newaxis, :], axis=2))
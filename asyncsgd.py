@@ -0,0 +1,41 @@
+'''
+Hogwild-style asynchronous training.
+
+Worker threads pull batches from a shared iterator and run the optimizer step of the same session concurrently. The
+variables are updated without locks (use_locking=False, the tensorflow default): the steps of sparse batches touch few
+embedding rows, so concurrent updates rarely collide. Only the batch iterator is behind a lock. The sparse update
+paths are the ones where the gradients are IndexedSlices: FM.py (embedding_lookup) and LLFM with gather_active or
+local_anchors; plain SGD or Adagrad keep the updates sparse, Adam decays its slots densely on every step.
+
+'''
+import threading
+
+
+def fit_async(model, batches, workers):
+    '''run model.partial_fit on the batches with workers concurrent threads
+    return: No. of steps
+    '''
+    batches = iter(batches)
+    lock = threading.Lock()
+    steps, errors = [0], []
+
+    def work():
+        while not errors:
+            with lock:
+                batch = next(batches, None)
+                if batch is None:
+                    return
+                steps[0] += 1
+            try:
+                model.partial_fit(batch)
+            except Exception as error:  # raised again in the caller
+                errors.append(error)
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return steps[0]
@@ -0,0 +1,81 @@
+'''
+Benchmark of the Hogwild trainer: validation error per wall-clock second of training, synchronous steps against
+asynchronous steps of several threads.
+
+    python benchmark_async.py --path data/ --dataset frappe --model LLFM --workers 1 4 8
+
+'''
+import argparse
+from time import time
+import numpy as np
+import asyncsgd
+import LoadData_nonsparse as DATA
+from FM_nonsparse import FM
+from LLFM import LLFM
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark asynchronous training.")
+    parser.add_argument('--path', nargs='?', default='data/',
+                        help='Input data path.')
+    parser.add_argument('--dataset', nargs='?', default='frappe',
+                        help='Choose a dataset.')
+    parser.add_argument('--model', nargs='?', default='LLFM',
+                        help='Model to train (FM or LLFM).')
+    parser.add_argument('--workers', type=int, nargs='+', default=[4],
+                        help='No. of asynchronous threads of each run, synchronous training is always run first')
+    parser.add_argument('--epoch', type=int, default=10,
+                        help='Number of epochs.')
+    parser.add_argument('--batch_size', type=int, default=128,
+                        help='Batch size.')
+    parser.add_argument('--hidden_factor', type=int, default=64,
+                        help='Number of hidden factors.')
+    parser.add_argument('--anchor_points', type=int, default=2,
+                        help='Number of anchor points')
+    parser.add_argument('--lr', type=float, default=0.05,
+                        help='Learning rate.')
+    parser.add_argument('--loss_type', nargs='?', default='square_loss',
+                        help='Specify a loss type (square_loss or log_loss).')
+    parser.add_argument('--optimizer', nargs='?', default='AdagradOptimizer',
+                        help='Specify an optimizer type, sparse updates need AdagradOptimizer or GradientDescentOptimizer.')
+    return parser.parse_args()
+
+
+def train(args, data, workers):  # (training seconds, validation result) after each epoch
+    if args.model == 'LLFM':
+        model = LLFM(data.features_M, 0, '', args.hidden_factor, args.anchor_points, args.loss_type, args.epoch,
+                     args.batch_size, args.lr, 0, 1.0, args.optimizer, 0, 0, prefetch=0, gather_active=True)
+    else:
+        model = FM(data.features_M, 0, '', args.hidden_factor, args.loss_type, args.epoch, args.batch_size, args.lr, 0,
+                   1.0, args.optimizer, 0, 0, prefetch=0)
+    history = []
+    seconds = 0.0
+    for epoch in xrange(args.epoch):
+        t1 = time()
+        if workers > 0:
+            asyncsgd.fit_async(model, model.epoch_batches(data.Train_data), workers)
+        else:
+            for batch_xs in model.epoch_batches(data.Train_data):
+                model.partial_fit(batch_xs)
+        seconds += time() - t1
+        history.append((seconds, model.evaluate(data.Validation_data)))
+    return history
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    data = DATA.LoadData(args.path, args.dataset, args.loss_type, False, True)
+    better = min if args.loss_type == 'square_loss' else max
+    runs = [(0, train(args, data, 0))] + [(workers, train(args, data, workers)) for workers in args.workers]
+    target = better(result for _, result in runs[0][1])  # best validation result of the synchronous trainer
+
+    print("%-8s %-6s %-10s %-10s" % ('workers', 'epoch', 'seconds', 'validation'))
+    for workers, history in runs:
+        for epoch, (seconds, result) in enumerate(history):
+            print("%-8s %-6d %-10.1f %-10.4f" % (workers or 'sync', epoch + 1, seconds, result))
+    for workers, history in runs:
+        reached = [seconds for seconds, result in history if better(result, target) == result]
+        steps_per_second = len(history) * (len(data.Train_data['Y']) // args.batch_size) / history[-1][0]
+        print("%s: %.0f steps/s, time to the best synchronous validation %s"
+              % ('%d workers' % workers if workers else 'sync', steps_per_second,
+                 '%.1f s' % reached[0] if reached else 'not reached'))
@@ -0,0 +1,99 @@
+'''
+Benchmark of the LLFM warm start: epochs and wall-clock seconds to reach a target validation result, from random
+weights against the warm starts of warmstart.py. The time of a warm start includes the training of the FM and the
+k-means it needs.
+
+    python benchmark_warmstart.py --path data/ --dataset frappe --epoch 50 --fm_epoch 20
+
+'''
+import argparse
+from time import time
+import LoadData_nonsparse as DATA
+import warmstart
+from FM_nonsparse import FM
+from LLFM import LLFM
+
+RUNS = ['random', 'fm', 'kmeans', 'fm+kmeans']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the LLFM warm start.")
+    parser.add_argument('--path', nargs='?', default='data/',
+                        help='Input data path.')
+    parser.add_argument('--dataset', nargs='?', default='frappe',
+                        help='Choose a dataset.')
+    parser.add_argument('--epoch', type=int, default=50,
+                        help='Maximum number of LLFM epochs of a run.')
+    parser.add_argument('--fm_epoch', type=int, default=20,
+                        help='Number of epochs of the FM the fm runs start from.')
+    parser.add_argument('--batch_size', type=int, default=128,
+                        help='Batch size.')
+    parser.add_argument('--hidden_factor', type=int, default=16,
+                        help='Number of hidden factors.')
+    parser.add_argument('--anchor_points', type=int, default=2,
+                        help='Number of anchor points')
+    parser.add_argument('--lr', type=float, default=0.05,
+                        help='Learning rate.')
+    parser.add_argument('--loss_type', nargs='?', default='square_loss',
+                        help='Specify a loss type (square_loss or log_loss).')
+    parser.add_argument('--optimizer', nargs='?', default='AdagradOptimizer',
+                        help='Specify an optimizer type.')
+    parser.add_argument('--kmeans_iterations', type=int, default=100,
+                        help='No. of mini-batch k-means iterations')
+    parser.add_argument('--target', type=float, default=0,
+                        help='Validation result to reach. 0: the best result of the run from random weights')
+    return parser.parse_args()
+
+
+def fit_epoch(model, data):  # seconds of an epoch of synchronous steps
+    t1 = time()
+    for batch_xs in model.epoch_batches(data.Train_data):
+        model.partial_fit(batch_xs)
+    return time() - t1
+
+
+def train(args, data, weights, seconds):  # (training seconds, validation result) after each epoch
+    model = LLFM(data.features_M, 0, '', args.hidden_factor, args.anchor_points, args.loss_type, args.epoch,
+                 args.batch_size, args.lr, 0, 1.0, args.optimizer, 0, 0, prefetch=0)
+    model.set_weights(weights)
+    history = []
+    for epoch in xrange(args.epoch):
+        seconds += fit_epoch(model, data)
+        history.append((seconds, model.evaluate(data.Validation_data)))
+    return history
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    data = DATA.LoadData(args.path, args.dataset, args.loss_type, False, True)
+    better = min if args.loss_type == 'square_loss' else max
+
+    fm = FM(data.features_M, 0, '', args.hidden_factor, args.loss_type, args.fm_epoch, args.batch_size, args.lr, 0, 1.0,
+            args.optimizer, 0, 0, prefetch=0)
+    fm_seconds = sum(fit_epoch(fm, data) for _ in xrange(args.fm_epoch))
+    t1 = time()
+    anchors = warmstart.kmeans_anchors(data.Train_data['X_csr'], args.anchor_points,
+                                       iterations=args.kmeans_iterations)
+    kmeans_seconds = time() - t1
+    fm_weights = warmstart.from_fm(fm.get_weights(), args.anchor_points, 0.001)
+    print("FM: %d epochs [%.1f s], validation=%.4f; k-means [%.1f s]"
+          % (args.fm_epoch, fm_seconds, fm.evaluate(data.Validation_data), kmeans_seconds))
+
+    starts = {'random': ({}, 0.0), 'fm': (fm_weights, fm_seconds),
+              'kmeans': ({'anchor_points': anchors}, kmeans_seconds),
+              'fm+kmeans': (dict(fm_weights, anchor_points=anchors), fm_seconds + kmeans_seconds)}
+    histories = [(run, train(args, data, *starts[run])) for run in RUNS]
+    target = args.target or better(result for _, result in histories[0][1])
+
+    print("%-10s %-6s %-10s %-10s" % ('start', 'epoch', 'seconds', 'validation'))
+    for run, history in histories:
+        for epoch, (seconds, result) in enumerate(history):
+            print("%-10s %-6d %-10.1f %-10.4f" % (run, epoch + 1, seconds, result))
+    print("target validation %.4f" % target)
+    for run, history in histories:
+        reached = [epoch for epoch, (seconds, result) in enumerate(history) if better(result, target) == result]
+        print("%s: best validation %.4f, target %s" % (
+            run, better(result for _, result in history),
+            'reached after %d epochs, %.1f s (%.1f s of warm start)' % (reached[0] + 1, history[reached[0]][0],
+                                                                       starts[run][1]) if reached
+            else 'not reached in %d epochs' % len(history)))
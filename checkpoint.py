@@ -0,0 +1,226 @@
+'''
+Checkpoints of a training run, written in the background and resumed exactly.
+
+A checkpoint holds every variable of the graph of a model (the weights, the optimizer slots such as the Adam moments
+and the Adagrad accumulators, the batch-norm statistics, the No. of steps run), the NumPy random states the batches of
+an epoch are drawn from, the position in the run (epoch and No. of steps done in it), the results of the epochs
+already run and the weights of the best epoch kept by the early stopping of the model. save() copies the variables
+out of the session, the only part run on the training thread: a background thread compares them with the previous
+checkpoint and writes the file while training goes on.
+
+A full checkpoint is followed by delta checkpoints which hold only the rows of the variables changed since the
+previous checkpoint (with sparse updates most rows of the tables are untouched in between), a variable changed in
+most of its rows is written whole. Every full_every checkpoints a full one starts a new chain and the files of the
+previous chain are removed. The manifest (checkpoint.json) names the files of the current chain and is replaced
+atomically once a file is complete, so a run stopped while writing resumes from the checkpoint before.
+
+resume() loads the full checkpoint and applies its deltas in order. Within an epoch the batches are drawn again from
+the random state of the start of the epoch and the batches already fitted are skipped. The random ops of the graphs
+have no state to save: the dropout masks are drawn by step_dropout from the No. of steps run and the tf.data shuffle
+is seeded by the epoch (tf.data epochs are checkpointed at their end only), so with synchronous steps a resumed run
+takes the same steps as an uninterrupted one.
+
+'''
+import json
+import os
+import threading
+import Queue
+import numpy as np
+import tensorflow as tf
+
+MANIFEST = 'checkpoint.json'
+ROW_DELTA_MAX = 0.5  # a delta holds the whole variable when a larger fraction of its rows changed
+BEST = 'best_weights/'  # prefix of the arrays of the best epoch of the early stopping
+
+
+def delta(previous, arrays):  # the arrays changed since previous, as changed rows where that is smaller
+    changes = {}
+    for name, array in arrays.items():
+        old = previous.get(name)
+        if old is None or old.shape != array.shape or array.ndim == 0 or array.shape[0] == 1:
+            if old is None or not np.array_equal(old, array):
+                changes[name] = array
+            continue
+        rows = np.flatnonzero(np.any((old != array).reshape([array.shape[0], -1]), 1))
+        if rows.shape[0] > ROW_DELTA_MAX * array.shape[0]:
+            changes[name] = array
+        elif rows.shape[0] > 0:
+            changes[name + '@rows'] = rows
+            changes[name + '@values'] = array[rows]
+    return changes
+
+
+def write_atomic(path, write):  # write(file object) to a temporary file renamed to path once complete
+    with open(path + '.tmp', 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
+
+
+def load(directory):
+    '''the arrays and the state of the last checkpoint of a directory, the deltas of its chain applied
+    return: arrays, state, chain (file names), or None if the directory holds no checkpoint
+    '''
+    manifest = os.path.join(directory, MANIFEST)
+    if not os.path.exists(manifest):
+        return None
+    with open(manifest) as f:
+        chain = json.load(f)['chain']
+    arrays, state = {}, None
+    for name in chain:
+        with np.load(os.path.join(directory, name)) as checkpoint:
+            state = json.loads(str(checkpoint['__state__']))
+            for key in checkpoint.files:
+                if key.endswith('@rows'):
+                    arrays[key[:-5]][checkpoint[key]] = checkpoint[key[:-5] + '@values']
+                elif key != '__state__' and not key.endswith('@values'):
+                    arrays[key] = checkpoint[key]
+    return arrays, state, chain
+
+
+def step_dropout(x, keep_prob, seed, step):
+    '''tf.nn.dropout with its mask drawn by a stateless random op from (seed, step)
+    :param seed: python int, seeds of the dropout layers of a graph differ
+    :param step: int64 tensor, the No. of training steps run
+    '''
+    uniform = tf.contrib.stateless.stateless_random_uniform(tf.shape(x), tf.stack([tf.constant(seed, tf.int64), step]))
+    return tf.div(x, keep_prob) * tf.floor(keep_prob + uniform)
+
+
+def get_random_state(random):  # json-able state of np.random or a RandomState
+    kind, keys, position, has_gauss, cached_gaussian = random.get_state()
+    return [kind, keys.tolist(), position, has_gauss, cached_gaussian]
+
+
+def set_random_state(random, state):
+    kind, keys, position, has_gauss, cached_gaussian = state
+    random.set_state((str(kind), np.array(keys, dtype=np.uint32), position, has_gauss, cached_gaussian))
+
+
+class Checkpointer(object):
+    '''
+    :param model: FM, FM_nonsparse or LLFM model, the variables of its graph are saved
+    :param directory: directory of the checkpoint files, created if missing
+    :param every_steps: also save every every_steps steps within an epoch, 0: at the end of the epochs only
+    :param full_every: No. of checkpoints of a chain, the first one full and the others deltas. 1: full checkpoints only
+    '''
+
+    def __init__(self, model, directory, every_steps=0, full_every=5):
+        self.model = model
+        self.directory = directory
+        self.every_steps = every_steps
+        self.full_every = max(full_every, 1)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.variables = model.graph.get_collection('variables')
+        self.names = [variable.op.name for variable in self.variables]
+        self.previous = None  # arrays of the last checkpoint, the deltas are taken against them
+        self.chain = []  # files of the current chain, the full checkpoint first
+        self.count = 0  # No. of checkpoints written
+        self.randoms = [np.random]  # random states the batches are drawn from
+        self.epoch_states = None  # their states at the start of the epoch
+        self.epoch, self.step, self.skip = 0, 0, 0
+        self.queue = Queue.Queue(1)  # a checkpoint waits for the previous one to be written
+        self.thread = None  # background writer, running from a save() to the next wait()
+        self.error = None
+
+    def resume(self, data):
+        '''restore the last checkpoint of the directory, if any
+        :param data: training set, the random state of a LibFMStream is restored too
+        return: epoch to start from, the batches of its fitted steps are skipped by track()
+        '''
+        self._set_data(data)
+        loaded = load(self.directory)
+        if loaded is None:
+            return 0
+        arrays, state, self.chain = loaded
+        for variable, name in zip(self.variables, self.names):
+            variable.load(arrays[name], self.model.sess)
+        self.model.train_rmse[:], self.model.valid_rmse[:], self.model.test_rmse[:] = state['results']
+        for random, random_state in zip(self.randoms, state['random_states']):
+            set_random_state(random, random_state)
+        self.previous, self.count, self.skip = arrays, state['count'] + 1, state['step']
+        if state.get('best_epoch', -1) >= 0:  # kept for the replay of the results by EarlyStopping
+            stopper = self.model.early_stopping
+            stopper.best_epoch = state['best_epoch']
+            stopper.best_weights = [(variable, arrays[BEST + name])
+                                    for variable, name in zip(self.variables, self.names) if BEST + name in arrays]
+        if self.model.verbose > 0:
+            print("Resumed from %s: epoch %d, step %d" % (self.chain[-1], state['epoch'] + 1, state['step']))
+        return state['epoch']
+
+    def _set_data(self, data):
+        self.randoms = [np.random]
+        if hasattr(data, 'random_state'):
+            self.randoms.append(data.random_state)
+
+    def begin_epoch(self, epoch):  # called before the batches of an epoch are drawn
+        self.epoch, self.step = epoch, 0
+        self.epoch_states = [get_random_state(random) for random in self.randoms]
+
+    def track(self, batches):  # the batches of the epoch, the fitted ones skipped after resume, saved every every_steps
+        for batch in batches:
+            self.step += 1
+            if self.skip > 0:
+                self.skip -= 1
+                continue
+            yield batch
+            if self.every_steps > 0 and self.step % self.every_steps == 0:
+                self.save(self.epoch, self.step)
+
+    def end_epoch(self, epoch):
+        self.save(epoch + 1, 0)
+
+    def save(self, epoch, step):
+        '''copy the variables and queue the checkpoint for the background thread
+        :param epoch: epoch of the position
+        :param step: No. of steps of the epoch already fitted, 0: the epoch has not started
+        '''
+        self._raise_error()
+        arrays = dict(zip(self.names, self.model.sess.run(self.variables)))
+        random_states = self.epoch_states if step > 0 else [get_random_state(random) for random in self.randoms]
+        state = {'epoch': epoch, 'step': step, 'random_states': random_states,
+                 'results': [list(self.model.train_rmse), list(self.model.valid_rmse), list(self.model.test_rmse)]}
+        stopper = self.model.early_stopping
+        if stopper.best_weights:  # unchanged since the previous checkpoint unless an epoch improved, deltas skip them
+            arrays.update((BEST + variable.op.name, value) for variable, value in stopper.best_weights)
+            state['best_epoch'] = stopper.best_epoch
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._write_loop)
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put((arrays, state))
+
+    def wait(self):  # block until the queued checkpoints are written, then stop the background thread
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self._raise_error()
+
+    def _raise_error(self):  # raise an error of the background thread in the training thread
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _write_loop(self):
+        for job in iter(self.queue.get, None):
+            try:
+                self._write(*job)
+            except Exception as error:
+                self.error = error
+
+    def _write(self, arrays, state):
+        full = self.previous is None or len(self.chain) >= self.full_every
+        content = dict(arrays) if full else delta(self.previous, arrays)
+        state['count'] = self.count
+        content['__state__'] = np.array(json.dumps(state))
+        name = 'ckpt-%06d%s.npz' % (self.count, '' if full else '-delta')
+        write_atomic(os.path.join(self.directory, name), lambda f: np.savez(f, **content))
+        previous_chain = self.chain if full else []
+        self.chain = [name] if full else self.chain + [name]
+        write_atomic(os.path.join(self.directory, MANIFEST), lambda f: f.write(json.dumps({'chain': self.chain})))
+        for old in previous_chain:
+            os.remove(os.path.join(self.directory, old))
+        self.previous, self.count = arrays, self.count + 1
@@ -0,0 +1,125 @@
+'''
+Binary on-disk cache of parsed datasets.
+
+A cache entry is a directory holding one .npy file per array (CSR arrays, labels, feature map) and a meta.json
+with the scalar fields (features_M, row counts). Entries are keyed by the content hash of the source files and
+the loader parameters, so they invalidate themselves when the sources change. The arrays are opened with
+np.memmap, hence processes reading the same entry share the page cache. Arrays too large for memory are written
+through the memory maps of open_array and moved into their entry as they are.
+
+'''
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+CACHE_VERSION = 2  # 2: token_ids mixes the bytes of the tokens instead of crc32
+HASH_BLOCK_BYTES = 1 << 24
+COPY_ITEMS = 1 << 22  # items copied at a time by cast_array
+
+
+def file_digest(file, cache_dir):
+    '''sha1 of the content of a file
+    The digest is remembered in cache_dir together with the size and mtime of the file, so an unchanged file is
+    hashed only once.
+    '''
+    stat = os.stat(file)
+    digests_file = os.path.join(cache_dir, 'digests.json')
+    digests = {}
+    if os.path.exists(digests_file):
+        with open(digests_file) as f:
+            digests = json.load(f)
+    key = os.path.abspath(file)
+    if key in digests and digests[key][:2] == [stat.st_size, stat.st_mtime]:
+        return digests[key][2]
+
+    sha1 = hashlib.sha1()
+    with open(file, 'rb') as f:
+        block = f.read(HASH_BLOCK_BYTES)
+        while block:
+            sha1.update(block)
+            block = f.read(HASH_BLOCK_BYTES)
+    digests[key] = [stat.st_size, stat.st_mtime, sha1.hexdigest()]
+    _write_json(digests_file, digests, cache_dir)
+    return sha1.hexdigest()
+
+
+def cache_key(files, cache_dir, params=None):
+    key = hashlib.sha1(json.dumps([CACHE_VERSION, params], sort_keys=True).encode('utf-8'))
+    for file in files:
+        key.update(file_digest(file, cache_dir).encode('utf-8'))
+    return key.hexdigest()
+
+
+def open_array(cache_dir, shape, dtype):
+    '''a writable .npy memory map in cache_dir, filled by the caller and moved into its entry by save'''
+    fd, file = tempfile.mkstemp(suffix='.npy', dir=cache_dir)
+    os.close(fd)
+    return np.lib.format.open_memmap(file, mode='w+', dtype=dtype, shape=shape)
+
+
+def cast_array(array, dtype, cache_dir):  # an array of open_array cast to dtype in a new one, COPY_ITEMS at a time
+    cast = open_array(cache_dir, array.shape, dtype)
+    for start in range(0, array.shape[0], COPY_ITEMS):
+        cast[start:start + COPY_ITEMS] = array[start:start + COPY_ITEMS]
+    os.remove(array.filename)
+    return cast
+
+
+def save(directory, arrays, meta):
+    '''write the arrays and meta of a cache entry
+    The entry is written to a temporary directory which is then renamed, so readers never see a partial entry.
+    '''
+    parent = os.path.dirname(os.path.abspath(directory))
+    tmp_directory = tempfile.mkdtemp(dir=parent)
+    for name, array in arrays.items():
+        file = os.path.join(tmp_directory, name + '.npy')
+        if isinstance(array, np.memmap) and os.path.dirname(array.filename) == parent:  # a file of open_array
+            array.flush()
+            os.rename(array.filename, file)
+        else:
+            np.save(file, np.ascontiguousarray(array))
+    with open(os.path.join(tmp_directory, 'meta.json'), 'w') as f:
+        json.dump(dict(meta, arrays=sorted(arrays)), f)
+    try:
+        os.rename(tmp_directory, directory)
+    except OSError:  # another process has written the same entry meanwhile
+        shutil.rmtree(tmp_directory)
+
+
+def load(directory):
+    '''open a cache entry, the arrays are read-only memory maps
+    return: arrays, meta
+    '''
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+    arrays = {}
+    for name in meta.pop('arrays'):
+        arrays[name] = np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+    return arrays, meta
+
+
+def load_or_build(cache_dir, files, build, params=None):
+    '''open the cache entry of files, calling build() to create it when it is missing
+    :param cache_dir: directory holding the cache entries
+    :param files: source files of the entry
+    :param build: function returning the arrays (a dictionary of numpy arrays) and the meta (a dictionary) of the entry
+    :param params: parameters of the loader which change the content of the entry
+    return: arrays, meta
+    '''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    directory = os.path.join(cache_dir, cache_key(files, cache_dir, params))
+    if not os.path.exists(directory):
+        arrays, meta = build()
+        save(directory, arrays, meta)
+    return load(directory)
+
+
+def _write_json(file, content, directory):
+    fd, tmp_file = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(content, f)
+    os.rename(tmp_file, file)
@@ -0,0 +1,87 @@
+'''
+Early stopping of the training loops, with the weights of the best epoch kept in memory.
+
+EarlyStopping follows the validation result of every epoch. An epoch improves on the best one when its result is
+better by more than min_delta in the direction of the metric ('min': rmse and log loss, 'max': accuracy), and training
+stops after patience epochs in a row without improvement. With restore_best the weights of the best epoch (the
+trainable variables and the batch-norm moving statistics of the graph, not the optimizer slots) are copied out of the
+session when it is reached and assigned back by restore() at the end of training, so that train() leaves the best
+model rather than the last one.
+
+'''
+import numpy as np
+
+
+def model_variables(graph):  # trainable and batch-norm variables of a graph, without duplicates
+    variables = []
+    for variable in graph.get_collection('trainable_variables') + graph.get_collection('model_variables'):
+        if variable not in variables:
+            variables.append(variable)
+    return variables
+
+
+class EarlyStopping(object):
+    '''
+    :param patience: No. of epochs without improvement after which training stops, 0: never stop
+    :param min_delta: smallest change of the validation result counted as an improvement
+    :param mode: 'min' or 'max', the direction in which the validation result improves
+    :param restore_best: keep the weights of the best epoch in memory, restore() assigns them back
+    '''
+
+    def __init__(self, patience=0, min_delta=0.0, mode='min', restore_best=True):
+        if mode not in ('min', 'max'):
+            raise ValueError("mode must be 'min' or 'max', got %r" % mode)
+        self.patience = patience
+        self.min_delta = min_delta
+        self.mode = mode
+        self.restore_best = restore_best
+        self.reset()
+
+    def reset(self):
+        self.best, self.best_epoch, self.wait = None, -1, 0
+        self.best_weights = None  # (variable, value) pairs of the best epoch
+
+    def improved(self, result):  # whether a validation result improves on the best one
+        if not np.isfinite(result):
+            return False
+        if self.best is None:
+            return True
+        if self.mode == 'min':
+            return result < self.best - self.min_delta
+        return result > self.best + self.min_delta
+
+    def stopped(self):
+        return 0 < self.patience <= self.wait
+
+    def update(self, model, epoch, result):  # record the validation result of an epoch, return: whether to stop
+        if self.improved(result):
+            self.best, self.best_epoch, self.wait = result, epoch, 0
+            if self.restore_best:
+                variables = model_variables(model.graph)
+                self.best_weights = list(zip(variables, model.sess.run(variables)))
+        else:
+            self.wait += 1
+        return self.stopped()
+
+    def replay(self, results):
+        '''start over from the validation results of the epochs already run (a resumed checkpoint), the weights of
+        their best epoch are kept if the checkpoint restored them (best_epoch and best_weights)
+        return: whether these epochs had stopped the training
+        '''
+        best_epoch, best_weights = self.best_epoch, self.best_weights
+        self.reset()
+        for epoch, result in enumerate(results):
+            if self.improved(result):
+                self.best, self.best_epoch, self.wait = result, epoch, 0
+            else:
+                self.wait += 1
+        if self.best_epoch == best_epoch:
+            self.best_weights = best_weights
+        return self.stopped()
+
+    def restore(self, model):  # assign the weights of the best epoch, return: whether they were restored
+        if not self.best_weights:
+            return False
+        for variable, value in self.best_weights:
+            variable.load(value, model.sess)
+        return True
@@ -0,0 +1,78 @@
+'''
+Feature hashing for the loaders.
+
+A FeatureHasher maps feature tokens (LoadData) or raw feature ids (LoadData_nonsparse) into a fixed space of
+2 ** hash_bits buckets, so features_M, and the size of the model, no longer depend on the data and no mapping
+dictionary is built. Colliding features share a row of the tables; with signed=True a feature also gets a hashed sign
+which multiplies its value, so that collisions cancel out in expectation instead of adding up.
+
+Ids are hashed with the splitmix64 finalizer, tokens with 64-bit ids mixed from their bytes (token_ids) followed by the
+same finalizer. The low hash_bits of the hash give the bucket and its top bit the sign. Both functions are deterministic, so train, validation and test files
+(and streamed blocks) hash the same way without a pre-pass.
+
+'''
+import numpy as np
+
+MIX_CONSTANTS = [np.uint64(0x9E3779B97F4A7C15), np.uint64(0xBF58476D1CE4E5B9), np.uint64(0x94D049BB133111EB)]
+
+
+def mix64(x):  # splitmix64 finalizer of an array of 64-bit integers
+    x = np.atleast_1d(np.asarray(x).astype(np.uint64)) + MIX_CONSTANTS[0]
+    x = (x ^ (x >> np.uint64(30))) * MIX_CONSTANTS[1]
+    x = (x ^ (x >> np.uint64(27))) * MIX_CONSTANTS[2]
+    return x ^ (x >> np.uint64(31))
+
+
+def token_ids(tokens):
+    '''64-bit ids of string tokens, the input of mix64
+    The fixed-width byte strings are read as little-endian 64-bit words; starting from the No. of words of a token,
+    each of them is xored in and mixed with mix64. The zero bytes padding a token to the width of the array are not
+    part of it, so a token gets the same id in arrays of any width.
+    '''
+    tokens = np.asarray(tokens, dtype=np.string_).ravel()
+    width = -(-tokens.dtype.itemsize // 8) * 8
+    chars = np.zeros([tokens.shape[0], width], dtype=np.uint8)
+    chars[:, :tokens.dtype.itemsize] = tokens.view(np.uint8).reshape([tokens.shape[0], tokens.dtype.itemsize])
+    words = chars.view('<u8')
+    # a token ends at its last non-zero word
+    num_words = np.max((words != 0) * np.arange(1, width // 8 + 1, dtype=np.uint64), 1) if width > 0 else np.zeros(
+        [tokens.shape[0]], dtype=np.uint64)
+    ids = num_words
+    for word in range(width // 8):
+        ids = np.where(num_words > np.uint64(word), mix64(ids ^ words[:, word]), ids)
+    return ids
+
+
+class FeatureHasher(object):
+    '''
+    :param hash_bits: the features are hashed into 2 ** hash_bits buckets
+    :param signed: multiply the values by a hashed sign (+1 or -1)
+    '''
+
+    def __init__(self, hash_bits, signed=False):
+        if not 0 < hash_bits < 63:
+            raise ValueError('hash_bits must be in [1, 62], got %d' % hash_bits)
+        self.hash_bits = hash_bits
+        self.signed = signed
+        self.features_M = 1 << hash_bits
+        self.mask = np.uint64(self.features_M - 1)
+
+    def hash_ids(self, ids):
+        '''
+        :param ids: raw feature ids (non-negative integers)
+        return: buckets (int64), signs (float32, None unless signed)
+        '''
+        hashed = mix64(ids)
+        buckets = (hashed & self.mask).astype(np.int64)
+        if not self.signed:
+            return buckets, None
+        return buckets, 1 - 2 * (hashed >> np.uint64(63)).astype(np.float32)
+
+    def hash_tokens(self, tokens):  # buckets and signs of string tokens
+        return self.hash_ids(token_ids(tokens))
+
+    def transform(self, indices, values):  # hashed feature ids of CSR indices, and their signed values
+        buckets, signs = self.hash_ids(indices)
+        if signs is not None:
+            values = values * signs
+        return buckets, values
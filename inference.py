@@ -0,0 +1,210 @@
+'''
+NumPy inference for trained FM and LLFM models.
+
+export() writes the weights of a model and its batch-norm statistics to a .npz file, save() writes weights given as
+numpy arrays (the snapshots of online.py). load() reads the file back as a NumpyFM or a NumpyLLFM, whose predict()
+computes the out tensor of the training graph (at evaluation: no dropout, batch norm with the moving statistics) on the
+rows of a CSRDataset. This module does not import tensorflow.
+
+The weights are frozen at inference, so the squared embeddings of the square_sum term and the squared norms of the
+anchors are computed once, written to the file by export() and loaded with the weights: scoring a row then only
+gathers and adds rows of these tables (score_row).
+
+'''
+import numpy as np
+from sparsify import CSRDataset, csr_from_lists, row_sums
+
+BN_PARAMS = ['beta', 'gamma', 'moving_mean', 'moving_variance']
+BN_EPSILON = 0.001  # epsilon of tf.contrib.layers.batch_norm
+
+
+def export(model, file):
+    '''write the weights of a trained FM, FM_nonsparse or LLFM model
+    The batch-norm parameters are those of the bn_fm scope, over the last axis of the FM layer.
+    '''
+    arrays = model.get_weights()
+    variables = dict((variable.op.name, variable) for variable in model.graph.get_collection('variables'))
+    if 'bn_fm/moving_mean' in variables:
+        values = model.sess.run([variables['bn_fm/' + name] for name in BN_PARAMS])
+        for name, value in zip(BN_PARAMS, values):
+            arrays['bn_' + name] = value
+    save(file, arrays, model.loss_type, getattr(model, 'local_anchors', 0))
+
+
+def save(file, arrays, loss_type, local_anchors=0):
+    '''write weights in the export format
+    :param arrays: 'feature_embeddings', 'feature_bias', 'bias', 'anchor_points' for LLFM and the 'bn_' parameters if any
+    '''
+    arrays = dict(arrays)
+    # precomputed terms of the scoring
+    arrays['squared_embeddings'] = np.square(arrays['feature_embeddings'])
+    if 'anchor_points' in arrays:
+        arrays['anchor_norms'] = np.sum(np.square(arrays['anchor_points']), 0)
+    arrays['model'] = np.array('LLFM' if 'anchor_points' in arrays else 'FM')
+    arrays['loss_type'] = np.array(loss_type)
+    arrays['local_anchors'] = np.array(local_anchors)
+    with open(file, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def load(file):  # the NumpyFM or NumpyLLFM of an exported model
+    with np.load(file) as arrays:
+        arrays = dict((name, arrays[name]) for name in arrays.files)
+    model = str(arrays.pop('model'))
+    loss_type = str(arrays.pop('loss_type'))
+    local_anchors = int(arrays.pop('local_anchors'))
+    bn = None
+    if 'bn_moving_mean' in arrays:
+        bn = dict((name, arrays.pop('bn_' + name)) for name in BN_PARAMS)
+    if model == 'LLFM':
+        return NumpyLLFM(arrays['feature_embeddings'], arrays['feature_bias'], arrays['bias'], arrays['anchor_points'],
+                         loss_type, bn, local_anchors, arrays.get('squared_embeddings'), arrays.get('anchor_norms'))
+    return NumpyFM(arrays['feature_embeddings'], arrays['feature_bias'], arrays['bias'], loss_type, bn,
+                   arrays.get('squared_embeddings'))
+
+
+def batch_norm(x, bn):  # batch norm at inference, the parameters broadcast over the last axis
+    return x * bn['scale'] + bn['shift']
+
+
+def fold_batch_norm(bn):  # the moving statistics folded into a scale and a shift
+    if bn is None:
+        return None
+    scale = bn['gamma'] / np.sqrt(bn['moving_variance'] + BN_EPSILON)
+    return {'scale': scale, 'shift': bn['beta'] - bn['moving_mean'] * scale}
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def as_csr(X, features_M):  # a CSRDataset of X, which is a CSRDataset or a list of feature id lists (FM.py input)
+    if isinstance(X, CSRDataset):
+        return X
+    return csr_from_lists(X, features_M)
+
+
+class NumpyFM(object):
+    '''
+    :param feature_embeddings: features_M * K
+    :param feature_bias: features_M * 1
+    :param bias: scalar
+    :param loss_type: 'square_loss' or 'log_loss', log_loss outputs are passed through a sigmoid
+    :param bn: batch-norm parameters ('beta', 'gamma', 'moving_mean', 'moving_variance'), None: no batch norm
+    :param squared_embeddings: square of feature_embeddings, None: computed here
+    '''
+
+    def __init__(self, feature_embeddings, feature_bias, bias, loss_type, bn=None, squared_embeddings=None):
+        self.feature_embeddings = feature_embeddings
+        self.feature_bias = feature_bias[:, 0]
+        self.bias = float(bias)
+        self.loss_type = loss_type
+        self.bn = fold_batch_norm(bn)
+        self.squared_embeddings = np.square(feature_embeddings) if squared_embeddings is None else squared_embeddings
+        self.features_M = feature_embeddings.shape[0]
+
+    def predict(self, X):  # None * 1 outputs of the rows of X
+        X = as_csr(X, self.features_M)
+        values = X.values[:, np.newaxis].astype(np.float64)
+        summed = row_sums(values * self.feature_embeddings[X.indices], X.indptr)  # None * K
+        squared_sum = row_sums(np.square(values) * self.squared_embeddings[X.indices], X.indptr)  # None * K
+        FM = 0.5 * (np.square(summed) - squared_sum)
+        if self.bn is not None:
+            FM = batch_norm(FM, self.bn)
+        out = np.sum(FM, 1) + row_sums(X.values * self.feature_bias[X.indices], X.indptr) + self.bias
+        if self.loss_type == 'log_loss':
+            out = sigmoid(out)
+        return out[:, np.newaxis]
+
+    def score_row(self, indices, values=None):  # output of one row, values=None: binary features
+        if values is None:
+            summed = np.sum(self.feature_embeddings[indices], 0)
+            squared_sum = np.sum(self.squared_embeddings[indices], 0)
+            linear = np.sum(self.feature_bias[indices])
+        else:
+            values = np.asarray(values, dtype=np.float64)
+            summed = np.dot(values, self.feature_embeddings[indices])
+            squared_sum = np.dot(np.square(values), self.squared_embeddings[indices])
+            linear = np.dot(values, self.feature_bias[indices])
+        FM = 0.5 * (np.square(summed) - squared_sum)  # K
+        if self.bn is not None:
+            FM = batch_norm(FM, self.bn)
+        out = np.sum(FM) + linear + self.bias
+        if self.loss_type == 'log_loss':
+            out = sigmoid(out)
+        return out
+
+
+class NumpyLLFM(object):
+    '''
+    :param feature_embeddings: features_M * K * A
+    :param feature_bias: features_M * A
+    :param bias: 1 * A
+    :param anchor_points: features_M * A
+    :param loss_type: 'square_loss' or 'log_loss', log_loss outputs are passed through a sigmoid
+    :param bn: batch-norm parameters ('beta', 'gamma', 'moving_mean', 'moving_variance'), None: no batch norm
+    :param local_anchors: No. of nearest anchors kept by each sample, 0: all anchors
+    :param squared_embeddings: square of feature_embeddings, None: computed here
+    :param anchor_norms: squared L2 norms of the anchors (A), None: computed here
+    '''
+
+    def __init__(self, feature_embeddings, feature_bias, bias, anchor_points, loss_type, bn=None, local_anchors=0,
+                 squared_embeddings=None, anchor_norms=None):
+        self.feature_embeddings = feature_embeddings
+        self.feature_bias = feature_bias
+        self.bias = bias[0]
+        self.anchor_points = anchor_points
+        self.loss_type = loss_type
+        # batch norm is not applied in the local-anchor mode
+        self.bn = fold_batch_norm(bn) if local_anchors == 0 else None
+        self.local_anchors = local_anchors
+        self.squared_embeddings = np.square(feature_embeddings) if squared_embeddings is None else squared_embeddings
+        self.anchor_norms = np.sum(np.square(anchor_points), 0) if anchor_norms is None else anchor_norms
+        self.features_M, self.hidden_factor, self.num_anchors = feature_embeddings.shape
+
+    def coefficients(self, square_norms, XY):  # None * A softmax coefficients of the anchors, 0 outside the local anchors
+        distance = -10 * np.sqrt(np.maximum(square_norms[:, np.newaxis] + self.anchor_norms - 2 * XY, 0))
+        if 0 < self.local_anchors < self.num_anchors:
+            far = np.argpartition(-distance, self.local_anchors - 1, axis=1)[:, self.local_anchors:]
+            distance[np.arange(distance.shape[0])[:, np.newaxis], far] = -np.inf
+        coefficient = np.exp(distance - np.max(distance, 1, keepdims=True))
+        return coefficient / np.sum(coefficient, 1, keepdims=True)
+
+    def predict(self, X):  # None * 1 outputs of the rows of X
+        X = as_csr(X, self.features_M)
+        coefficient = self.coefficients(X.square_norms(), X.dot(self.anchor_points))
+        values = X.values[:, np.newaxis].astype(np.float64)
+        summed = row_sums(values[:, :, np.newaxis] * self.feature_embeddings[X.indices], X.indptr)  # None * K * A
+        squared_sum = row_sums(np.square(values)[:, :, np.newaxis] * self.squared_embeddings[X.indices],
+                               X.indptr)  # None * K * A
+        FM = 0.5 * (np.square(summed) - squared_sum)
+        if self.bn is not None:
+            FM = batch_norm(FM, self.bn)
+        out = np.sum((np.sum(FM, 1) + row_sums(values * self.feature_bias[X.indices], X.indptr) + self.bias)
+                     * coefficient, 1)
+        if self.loss_type == 'log_loss':
+            out = sigmoid(out)
+        return out[:, np.newaxis]
+
+    def score_row(self, indices, values=None):  # output of one row, values=None: binary features
+        if values is None:
+            square_norm = float(len(indices))
+            XY = np.sum(self.anchor_points[indices], 0)
+            summed = np.sum(self.feature_embeddings[indices], 0)
+            squared_sum = np.sum(self.squared_embeddings[indices], 0)
+            linear = np.sum(self.feature_bias[indices], 0)
+        else:
+            values = np.asarray(values, dtype=np.float64)
+            square_norm = np.dot(values, values)
+            XY = np.dot(values, self.anchor_points[indices])
+            summed = np.tensordot(values, self.feature_embeddings[indices], 1)
+            squared_sum = np.tensordot(np.square(values), self.squared_embeddings[indices], 1)
+            linear = np.dot(values, self.feature_bias[indices])
+        coefficient = self.coefficients(np.array([square_norm]), XY[np.newaxis])[0]  # A
+        FM = 0.5 * (np.square(summed) - squared_sum)  # K * A
+        if self.bn is not None:
+            FM = batch_norm(FM, self.bn)
+        out = np.dot(np.sum(FM, 0) + linear + self.bias, coefficient)
+        if self.loss_type == 'log_loss':
+            out = sigmoid(out)
+        return out
@@ -0,0 +1,41 @@
+'''
+Evaluation metrics accumulated chunk by chunk, so that a split is evaluated without holding all of its predictions.
+
+'''
+import math
+import numpy as np
+
+
+class StreamingMetric(object):
+    '''
+    :param metric: 'rmse', 'log_loss' or 'accuracy'
+    :param y_min: lower bound of the predictions for rmse, the smallest label of the split
+    :param y_max: higher bound of the predictions for rmse, the largest label of the split
+    :param eps: predictions are clipped to [eps, 1 - eps] for log_loss, as sklearn.metrics.log_loss does
+    '''
+
+    def __init__(self, metric, y_min=None, y_max=None, eps=1e-15):
+        self.metric = metric
+        self.y_min = y_min
+        self.y_max = y_max
+        self.eps = eps
+        self.total = 0.0
+        self.num = 0
+
+    def update(self, y_true, y_pred):
+        y_true = np.reshape(y_true, [-1]).astype(np.float64)
+        y_pred = np.reshape(y_pred, [-1]).astype(np.float64)
+        if self.metric == 'rmse':
+            predictions_bounded = np.minimum(np.maximum(y_pred, self.y_min), self.y_max)  # bound the predictions
+            self.total += np.sum(np.square(y_true - predictions_bounded))
+        elif self.metric == 'log_loss':
+            y_pred = np.clip(y_pred, self.eps, 1 - self.eps)
+            self.total -= np.sum(y_true * np.log(y_pred) + (1 - y_true) * np.log(1 - y_pred))
+        elif self.metric == 'accuracy':
+            self.total += np.sum((y_pred > 0.499).astype(np.int32) == y_true.astype(np.int32))
+        self.num += y_true.shape[0]
+
+    def result(self):
+        if self.metric == 'rmse':
+            return math.sqrt(self.total / self.num)
+        return self.total / self.num
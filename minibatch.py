@@ -0,0 +1,100 @@
+'''
+Epoch iterators over the rows of an in-memory dataset.
+
+An epoch draws a permutation of the rows and cuts it into batches of indexes, so every row is visited once per epoch
+and the rows of a batch are gathered at once (CSRDataset.take). With drop_last the last partial batch is dropped and
+an epoch of N rows is N // B steps of exactly B rows.
+
+Prefetcher builds the batches of an iterator in a background thread, a queue of depth batches ahead of the
+trainer, so that batch assembly overlaps sess.run (which releases the GIL).
+
+'''
+import threading
+import Queue
+from time import time
+import numpy as np
+
+_END = object()
+
+
+def epoch_batches(num_rows, batch_size, drop_last=True):  # index arrays of the batches of an epoch
+    permutation = np.random.permutation(num_rows)
+    stop = num_rows - num_rows % batch_size if drop_last else num_rows
+    for start in xrange(0, stop, batch_size):
+        yield permutation[start:start + batch_size]
+
+
+def bucket_batches(lengths, batch_size, drop_last=True):
+    '''index arrays of the batches of an epoch, the rows of a batch have the same length
+    The rows of each length are permuted and cut into batches, and the batches of all lengths are visited in a
+    random order. With drop_last the partial batch of every length is dropped.
+    '''
+    lengths = np.asarray(lengths)
+    permutation = np.random.permutation(lengths.shape[0])
+    permutation = permutation[np.argsort(lengths[permutation], kind='mergesort')]  # grouped by length, shuffled
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(lengths[permutation])) + 1, [lengths.shape[0]]])
+    batches = []
+    for begin, end in zip(bounds[:-1], bounds[1:]):
+        stop = end - (end - begin) % batch_size if drop_last else end
+        batches.extend(permutation[start:min(start + batch_size, end)] for start in xrange(begin, stop, batch_size))
+    for i in np.random.permutation(len(batches)):
+        yield batches[i]
+
+
+def length_groups(lengths, size):  # indexes of at most size rows with the same length, in order
+    for length in np.unique(lengths):
+        index = np.flatnonzero(lengths == length)
+        for start in xrange(0, index.shape[0], size):
+            yield index[start:start + size]
+
+
+class Prefetcher(object):
+    '''iterate over the items of an iterator produced in a background thread
+    :param iterator: the batches, built by the background thread
+    :param depth: No. of batches built ahead of the consumer
+    stall_time: seconds the consumer has waited for a batch, the time training is bound by the input
+    '''
+
+    def __init__(self, iterator, depth=2):
+        self.queue = Queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.stall_time = 0.0
+        self.thread = threading.Thread(target=self._produce, args=(iterator,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _produce(self, iterator):
+        try:
+            for item in iterator:
+                if not self._put((item, None)):
+                    return
+        except Exception as error:  # raised again in the consumer
+            self._put((_END, error))
+            return
+        self._put((_END, None))
+
+    def _put(self, item):  # put an item unless the consumer has stopped, return: whether it was put
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        try:
+            while True:
+                t1 = time()
+                item, error = self.queue.get()
+                self.stall_time += time() - t1
+                if item is _END:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            self.close()
+
+    def close(self):  # stop the background thread
+        self.stopped.set()
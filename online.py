@@ -0,0 +1,380 @@
+'''
+Online learning of FM and LLFM with FTRL-Proximal.
+
+The training rows arrive as a stream of libFM lines (id:value entries) instead of fixed splits: from stdin, from a
+file followed as `tail -f` does, or from a local TCP socket standing in for the production feed. Lines are grouped in
+micro-batches, every batch is first scored (progressive validation: the error of a row is measured before the model
+learns from it) and then applied as per-coordinate FTRL-Proximal updates of the bias, the linear weights and the
+embeddings, on the rows of the features present in the batch only.
+
+The LLFM variant keeps its anchors fixed (random, or those of an exported model), so the coefficients of a row only
+depend on the row and the locally linear FM is learned as A FMs weighted by these coefficients. Feature ids are hashed
+into 2 ** hash_bits rows (featurehash.py), the stream has no vocabulary pass; with hash_bits 0 the raw ids are used
+and the ids >= features_M are dropped.
+
+The model is written every snapshot_every rows in the export format of inference.py (load() reads it back), through
+a temporary file renamed over the previous snapshot so that a reader never sees a partial file. The throughput and the
+latency of the updates (from the arrival of a line to the update of its batch) are reported every report_every
+seconds.
+
+    python online.py --model LLFM --loss_type log_loss --snapshot model.npz < data/frappe/frappe.train.libfm
+    python online.py --source tail --file events.libfm --snapshot model.npz
+    python online.py --source socket --port 9099 --snapshot model.npz
+
+'''
+import argparse
+import os
+import socket
+import sys
+from time import sleep, time
+import numpy as np
+import inference
+from featurehash import FeatureHasher
+from LoadData_nonsparse import parse_libfm_block
+from metrics import StreamingMetric
+from pruning import drop_missing
+from sparsify import CSRDataset, row_sums
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Online FTRL-Proximal training of FM and LLFM.")
+    parser.add_argument('--source', nargs='?', default='stdin',
+                        help='Source of the libFM lines (stdin, tail or socket).')
+    parser.add_argument('--file', nargs='?', default=None,
+                        help='File followed by the tail source.')
+    parser.add_argument('--from_start', type=int, default=1,
+                        help='Whether the tail source reads the lines already in the file (0 or 1)')
+    parser.add_argument('--host', nargs='?', default='127.0.0.1',
+                        help='Address the socket source listens on.')
+    parser.add_argument('--port', type=int, default=9099,
+                        help='Port the socket source listens on.')
+    parser.add_argument('--model', nargs='?', default='FM',
+                        help='Model to learn (FM or LLFM).')
+    parser.add_argument('--hidden_factor', type=int, default=16,
+                        help='Number of hidden factors.')
+    parser.add_argument('--anchor_points', type=int, default=2,
+                        help='Number of anchor points of LLFM')
+    parser.add_argument('--loss_type', nargs='?', default='square_loss',
+                        help='Specify a loss type (square_loss or log_loss).')
+    parser.add_argument('--hash_bits', type=int, default=20,
+                        help='Hash the feature ids into 2 ** hash_bits rows. 0: raw ids below features_M')
+    parser.add_argument('--features_M', type=int, default=0,
+                        help='No. of features when hash_bits is 0')
+    parser.add_argument('--alpha', type=float, default=0.05,
+                        help='FTRL learning rate.')
+    parser.add_argument('--beta', type=float, default=1.0,
+                        help='FTRL smoothing of the per-coordinate learning rates.')
+    parser.add_argument('--l1', type=float, default=0.0,
+                        help='L1 regularization of the bias and linear weights.')
+    parser.add_argument('--l2', type=float, default=0.0,
+                        help='L2 regularization of all the weights.')
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='No. of lines of a micro-batch.')
+    parser.add_argument('--init_model', nargs='?', default=None,
+                        help='Exported model (inference.py format) the weights and anchors start from, its No. of '
+                             'features must match --hash_bits (0 for a model of raw ids). None: random')
+    parser.add_argument('--snapshot', nargs='?', default=None,
+                        help='File the model snapshots are written to. None: no snapshot')
+    parser.add_argument('--snapshot_every', type=int, default=100000,
+                        help='No. of rows between two snapshots')
+    parser.add_argument('--report_every', type=float, default=10.0,
+                        help='Seconds between two reports of the throughput and latency')
+    parser.add_argument('--poll_interval', type=float, default=0.5,
+                        help='Seconds the tail and socket sources wait for new lines before flushing a partial batch')
+    return parser.parse_args()
+
+
+class FTRL(object):
+    '''
+    FTRL-Proximal weights of a table, with the per-coordinate state z and n (McMahan et al., 2013)
+    :param initial: initial weights, z starts where the proximal solution gives them back
+    '''
+
+    def __init__(self, initial, alpha, beta, l1, l2):
+        self.alpha = alpha
+        self.beta = beta
+        self.l1 = l1
+        self.l2 = l2
+        self.weights = np.array(initial, dtype=np.float32)
+        self.n = np.zeros(self.weights.shape, dtype=np.float32)
+        self.z = -(self.weights * (beta / alpha + l2) + np.sign(self.weights) * l1)
+
+    def update(self, rows, gradients):  # apply the gradients of distinct rows
+        n, z = self.n[rows], self.z[rows]
+        sigma = (np.sqrt(n + np.square(gradients)) - np.sqrt(n)) / self.alpha
+        z += gradients - sigma * self.weights[rows]
+        n += np.square(gradients)
+        self.n[rows], self.z[rows] = n, z
+        self.weights[rows] = self.solve(z, n)
+
+    def solve(self, z, n):  # the weights of the closed-form proximal step, 0 where |z| <= l1
+        weights = -(z - np.sign(z) * self.l1) / ((self.beta + np.sqrt(n)) / self.alpha + self.l2)
+        weights[np.abs(z) <= self.l1] = 0
+        return weights
+
+
+class OnlineLLFM(object):
+    '''
+    FM (anchor_points=0) or LLFM with fixed anchors, learned with FTRL-Proximal
+    :param features_M: No. of rows of the tables
+    :param hidden_factor: K
+    :param anchor_points: A, 0: FM
+    :param loss_type: 'square_loss' or 'log_loss'
+    :param init: inference.NumpyFM or NumpyLLFM the weights (and anchors) start from, None: random weights
+    The bias and linear weights get the L1 penalty, the embeddings only the L2 one (an L1 would keep them at 0).
+    '''
+
+    def __init__(self, features_M, hidden_factor, anchor_points, loss_type, alpha=0.05, beta=1.0, l1=0.0, l2=0.0,
+                 init=None, random_seed=2016):
+        self.features_M = features_M
+        self.hidden_factor = hidden_factor
+        self.anchor_points = anchor_points
+        self.loss_type = loss_type
+        A = max(anchor_points, 1)
+        random = np.random.RandomState(random_seed)
+        if init is None:
+            embeddings = random.normal(0.0, 0.01, [features_M, hidden_factor, A])
+            feature_bias, bias = np.zeros([features_M, A]), np.zeros([1, A])
+            self.anchors = random.uniform(size=[features_M, A]).astype(np.float32) if anchor_points > 0 else None
+        elif anchor_points > 0:
+            embeddings, feature_bias, bias = init.feature_embeddings, init.feature_bias, init.bias[np.newaxis]
+            self.anchors = init.anchor_points.astype(np.float32)
+        else:
+            embeddings = init.feature_embeddings[:, :, np.newaxis]
+            feature_bias, bias = init.feature_bias[:, np.newaxis], np.array([[init.bias]])
+            self.anchors = None
+        self.embeddings = FTRL(embeddings, alpha, beta, 0.0, l2)  # features_M * K * A
+        self.feature_bias = FTRL(feature_bias, alpha, beta, l1, l2)  # features_M * A
+        self.bias = FTRL(bias, alpha, beta, l1, l2)  # 1 * A
+        self.anchor_norms = np.sum(np.square(self.anchors, dtype=np.float64), 0) if anchor_points > 0 else None
+
+    def coefficients(self, X):  # None * A softmax coefficients of the fixed anchors, ones for FM
+        if self.anchors is None:
+            return np.ones([len(X), 1])
+        distance = -10 * np.sqrt(np.maximum(X.square_norms()[:, np.newaxis] + self.anchor_norms
+                                            - 2 * X.dot(self.anchors), 0))
+        coefficient = np.exp(distance - np.max(distance, 1, keepdims=True))
+        return coefficient / np.sum(coefficient, 1, keepdims=True)
+
+    def forward(self, X):  # outputs before the sigmoid, coefficients, summed embeddings (None * K * A)
+        values = X.values[:, np.newaxis, np.newaxis].astype(np.float64)
+        embeddings = self.embeddings.weights[X.indices]  # nnz * K * A
+        summed = row_sums(values * embeddings, X.indptr)
+        squared_sum = row_sums(np.square(values) * np.square(embeddings), X.indptr)
+        FM = 0.5 * np.sum(np.square(summed) - squared_sum, 1)  # None * A
+        linear = row_sums(values[:, :, 0] * self.feature_bias.weights[X.indices], X.indptr)  # None * A
+        coefficient = self.coefficients(X)
+        return np.sum((FM + linear + self.bias.weights) * coefficient, 1), coefficient, summed
+
+    def predict(self, X):  # None outputs of the rows of a CSRDataset
+        out = self.forward(X)[0]
+        return sigmoid(out) if self.loss_type == 'log_loss' else out
+
+    def partial_fit(self, X, Y):
+        '''score a micro-batch, then update the weights of its features
+        return: the predictions of the rows before the update
+        '''
+        out, coefficient, summed = self.forward(X)
+        predictions = sigmoid(out) if self.loss_type == 'log_loss' else out
+        # gradient of the loss of every row and anchor, the square loss is the l2_loss of the training graph
+        d = (predictions - Y)[:, np.newaxis] * coefficient  # None * A
+        rows = np.repeat(np.arange(len(X)), np.diff(X.indptr))
+        values = X.values[:, np.newaxis].astype(np.float64)
+        d_entries = d[rows]  # nnz * A
+        embedding_gradients = d_entries[:, np.newaxis, :] * (
+            values[:, :, np.newaxis] * summed[rows]
+            - np.square(values)[:, :, np.newaxis] * self.embeddings.weights[X.indices])  # nnz * K * A
+        # the gradients of the entries of a feature are summed
+        ids, inverse = np.unique(X.indices, return_inverse=True)
+        order = np.argsort(inverse, kind='mergesort')
+        bounds = np.zeros([ids.shape[0] + 1], dtype=np.int64)
+        np.cumsum(np.bincount(inverse, minlength=ids.shape[0]), out=bounds[1:])
+        self.embeddings.update(ids, row_sums(embedding_gradients[order], bounds))
+        self.feature_bias.update(ids, row_sums((values * d_entries)[order], bounds))
+        self.bias.update(np.array([0]), np.sum(d, 0, keepdims=True))
+        return predictions
+
+    def snapshot(self, file):  # write the model in the export format, replacing the previous snapshot atomically
+        if self.anchors is None:
+            arrays = {'feature_embeddings': self.embeddings.weights[:, :, 0],
+                      'feature_bias': self.feature_bias.weights, 'bias': self.bias.weights[0, 0]}
+        else:
+            arrays = {'feature_embeddings': self.embeddings.weights, 'feature_bias': self.feature_bias.weights,
+                      'bias': self.bias.weights, 'anchor_points': self.anchors}
+        inference.save(file + '.tmp', arrays, self.loss_type)
+        os.rename(file + '.tmp', file)
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def stdin_lines():  # the lines of stdin, until its end
+    return iter(sys.stdin.readline, '')
+
+
+def tail_lines(file, from_start=True, poll_interval=0.5):
+    '''follow a file as tail -f does, '' is yielded whenever no complete line came for poll_interval seconds'''
+    with open(file) as f:
+        if not from_start:
+            f.seek(0, os.SEEK_END)
+        partial = ''
+        while True:
+            line = f.readline()
+            if line.endswith('\n'):
+                yield partial + line
+                partial = ''
+            else:
+                partial += line  # a line still being written
+                yield ''
+                sleep(poll_interval)
+
+
+def socket_lines(host, port, poll_interval=0.5):
+    '''the lines sent by the clients of a TCP socket, one client at a time; '' is yielded whenever no line came for
+    poll_interval seconds'''
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(1)
+    try:
+        while True:
+            connection, address = server.accept()
+            connection.settimeout(poll_interval)
+            partial = ''
+            try:
+                while True:
+                    try:
+                        received = connection.recv(1 << 16)
+                    except socket.timeout:
+                        yield ''
+                        continue
+                    if not received:
+                        break
+                    lines = (partial + received).split('\n')
+                    partial = lines.pop()
+                    for line in lines:
+                        yield line + '\n'
+                if partial.strip():
+                    yield partial + '\n'
+            finally:
+                connection.close()
+    finally:
+        server.close()
+
+
+def micro_batches(lines, batch_size):  # (lines, arrival times) of at most batch_size lines, '' flushes a partial batch
+    batch, arrivals = [], []
+    for line in lines:
+        if line.strip():
+            batch.append(line)
+            arrivals.append(time())
+        if batch and (len(batch) >= batch_size or not line):
+            yield batch, arrivals
+            batch, arrivals = [], []
+    if batch:
+        yield batch, arrivals
+
+
+class LineParser(object):
+    '''
+    labels and CSRDataset of a micro-batch of libFM lines
+    :param hasher: FeatureHasher of the ids, None: the raw ids, those >= features_M are dropped
+    '''
+
+    def __init__(self, features_M, loss_type, hasher=None):
+        self.features_M = features_M
+        self.loss_type = loss_type
+        self.hasher = hasher
+        self.skipped = 0  # No. of malformed lines
+
+    def __call__(self, lines):
+        try:
+            labels, row_nnz, indices, values = parse_libfm_block(''.join(lines))
+        except ValueError:  # parse the lines one by one, the malformed ones are skipped
+            parsed = []
+            for line in lines:
+                try:
+                    parsed.append(parse_libfm_block(line))
+                except ValueError:
+                    self.skipped += 1
+            if not parsed:
+                parsed = [parse_libfm_block('')]
+            labels, row_nnz, indices, values = [np.concatenate(arrays) for arrays in zip(*parsed)]
+        if self.hasher is not None:
+            indices, values = self.hasher.transform(indices, values)
+        else:
+            row_nnz, indices, values = drop_missing(row_nnz, np.where(indices < self.features_M, indices, -1), values)
+        if self.loss_type == 'log_loss':
+            labels = (labels > 0).astype(np.float64)  # > 0 as 1; others as 0
+        indptr = np.zeros([row_nnz.shape[0] + 1], dtype=np.int64)
+        np.cumsum(row_nnz, out=indptr[1:])
+        return labels, CSRDataset(indptr, indices, values, self.features_M).compact()
+
+
+def learn(model, lines, parse, batch_size=32, snapshot=None, snapshot_every=100000, report_every=10.0, verbose=1):
+    '''train a model on a stream of lines until the stream ends (or is interrupted)
+    return: No. of rows learned, seconds, progressive validation error of all the rows
+    '''
+    metric = 'log_loss' if model.loss_type == 'log_loss' else 'rmse'
+    total = StreamingMetric(metric, -np.inf, np.inf)
+    interval, latencies = StreamingMetric(metric, -np.inf, np.inf), []
+    num_rows, next_snapshot = 0, snapshot_every
+    t0 = last_report = time()
+    try:
+        for batch, arrivals in micro_batches(lines, batch_size):
+            Y, X = parse(batch)
+            predictions = model.partial_fit(X, Y)
+            done = time()
+            latencies.extend(done - arrival for arrival in arrivals)
+            total.update(Y, predictions)
+            interval.update(Y, predictions)
+            num_rows += len(X)
+            if snapshot is not None and num_rows >= next_snapshot:
+                model.snapshot(snapshot)
+                next_snapshot = num_rows + snapshot_every
+            if verbose > 0 and done - last_report >= report_every:
+                print("%d rows, %.0f rows/s (%.0f rows/s overall), update latency mean %.1f ms p99 %.1f ms, "
+                      "progressive %s=%.4f" % (num_rows, len(latencies) / (done - last_report),
+                                               num_rows / (done - t0), 1000 * np.mean(latencies),
+                                               1000 * np.percentile(latencies, 99), metric, interval.result()))
+                interval, latencies, last_report = StreamingMetric(metric, -np.inf, np.inf), [], done
+    except KeyboardInterrupt:
+        pass
+    if snapshot is not None and num_rows > 0:
+        model.snapshot(snapshot)
+    return num_rows, time() - t0, total.result() if total.num > 0 else None
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.hash_bits > 0:
+        hasher = FeatureHasher(args.hash_bits)
+        features_M = hasher.features_M
+    else:
+        hasher, features_M = None, args.features_M
+    init = inference.load(args.init_model) if args.init_model else None
+    if init is not None:  # the exported model sets the model type and the size of the tables
+        if hasher is not None and hasher.features_M != init.features_M:
+            raise ValueError('%s has %d feature rows, the ids hashed with --hash_bits %d would index 2 ** %d rows: '
+                             'pass the --hash_bits the model was trained with, or --hash_bits 0 for raw ids'
+                             % (args.init_model, init.features_M, args.hash_bits, args.hash_bits))
+        features_M = init.features_M
+        args.model = 'LLFM' if isinstance(init, inference.NumpyLLFM) else 'FM'
+        if args.model == 'LLFM':
+            args.anchor_points = init.num_anchors
+        args.hidden_factor = init.feature_embeddings.shape[1]
+    model = OnlineLLFM(features_M, args.hidden_factor, args.anchor_points if args.model == 'LLFM' else 0,
+                       args.loss_type, args.alpha, args.beta, args.l1, args.l2, init)
+    if args.source == 'tail':
+        lines = tail_lines(args.file, args.from_start, args.poll_interval)
+    elif args.source == 'socket':
+        lines = socket_lines(args.host, args.port, args.poll_interval)
+    else:
+        lines = stdin_lines()
+    parse = LineParser(features_M, args.loss_type, hasher)
+    num_rows, seconds, error = learn(model, lines, parse, args.batch_size, args.snapshot, args.snapshot_every,
+                                     args.report_every)
+    print("Online %s: %d rows in %.1f s (%.0f rows/s), progressive error=%s, %d malformed lines skipped"
+          % (args.model, num_rows, seconds, num_rows / max(seconds, 1e-9),
+             'n/a' if error is None else '%.4f' % error, parse.skipped))
@@ -0,0 +1,284 @@
+'''
+Parameter-server style sharded tables for LLFM.
+
+The rows of feature_embeddings (K * A), feature_bias (A) and anchor_points (A) are partitioned by feature id: feature
+id belongs to the shard id % num_shards, at row id // num_shards. A shard holds its rows, applies the pushed gradients
+(SGD or Adagrad) and keeps the partial sums of the squared anchor rows, so the anchor norms are the sum of num_shards
+vectors instead of a pass over features_M rows. The global bias (1 * A) lives in shard 0.
+
+The shards run in worker processes (processes=True) or in the calling process, the local stand-in of a parameter
+server. ShardedLLFM trains LLFM against a server: a step pulls the rows of the feature ids of its batch, computes the
+gradients with respect to these rows and pushes them back, so no step reads or writes the other rows.
+
+The terms of the dense model which reach the other rows are applied when the rows are next pulled, as the lazy updates
+of LLFM do: the gradient of the anchor norms scales the rows of anchor_points absent from a step (a pending scale per
+anchor, see LLFM._lazy_step), and the L2 decay of an embedding row is scaled by the No. of steps since it was last
+updated. With 'sgd' the anchor steps are those of the dense model; 'adagrad' takes the scale as a plain gradient step.
+
+'''
+import multiprocessing
+import threading
+import numpy as np
+import tensorflow as tf
+from LLFM import LLFM
+
+TABLES = ['feature_embeddings', 'feature_bias', 'anchor_points']
+
+
+class Shard(object):
+    '''
+    :param num_rows: No. of rows held by the shard
+    :param hidden_factor: K
+    :param anchor_points: A
+    :param optimizer: 'sgd' or 'adagrad'
+    :param has_bias: holds the global bias
+    '''
+
+    def __init__(self, num_rows, hidden_factor, anchor_points, learning_rate, optimizer='adagrad', has_bias=False,
+                 random_seed=2016):
+        random_state = np.random.RandomState(random_seed)
+        # initialized as LLFM._initialize_weights
+        self.tables = {
+            'feature_embeddings': random_state.normal(0.0, 0.01, [num_rows, hidden_factor, anchor_points]).astype(
+                np.float32),
+            'feature_bias': np.zeros([num_rows, anchor_points], dtype=np.float32),
+            'anchor_points': random_state.uniform(size=[num_rows, anchor_points]).astype(np.float32)}
+        if has_bias:
+            self.tables['bias'] = random_state.uniform(size=[1, anchor_points]).astype(np.float32)
+        self.learning_rate = learning_rate
+        self.optimizer = optimizer
+        self.accumulators = dict((name, np.full(table.shape, 1e-8, dtype=np.float32))
+                                 for name, table in self.tables.items()) if optimizer == 'adagrad' else {}
+        self.anchor_norms = np.sum(np.square(self.tables['anchor_points'], dtype=np.float64), 0)  # partial sums, A
+        # product of the scales of the anchors, and its value when every row of anchor_points was last brought up to
+        # date; No. of pushes, and the push of the last update of every row
+        self.anchor_scale = np.ones([anchor_points])
+        self.row_scale = np.ones([num_rows, anchor_points])
+        self.step = 0
+        self.last_seen = np.zeros([num_rows], dtype=np.int64)
+
+    def bring_up(self, rows):  # apply the pending scales to rows (unique) of anchor_points
+        self.tables['anchor_points'][rows] *= (self.anchor_scale / self.row_scale[rows]).astype(np.float32)
+        self.row_scale[rows] = self.anchor_scale
+
+    def fold(self):  # apply the pending scales to all the rows, before their product leaves the float range
+        self.tables['anchor_points'] *= (self.anchor_scale / self.row_scale).astype(np.float32)
+        self.anchor_scale[:] = 1
+        self.row_scale[:] = 1
+
+    def pull(self, rows):  # the rows of the tables, their No. of steps since the last update, the partial anchor norms
+        # and the bias of shard 0
+        self.bring_up(rows)
+        pulled = dict((name, self.tables[name][rows]) for name in TABLES)
+        pulled['gap'] = self.step + 1 - self.last_seen[rows]
+        pulled['anchor_norms'] = self.anchor_norms
+        if 'bias' in self.tables:
+            pulled['bias'] = self.tables['bias']
+        return pulled
+
+    def push(self, rows, gradients):  # apply the gradients of the rows (unique), of the bias and of the anchor norms
+        self.bring_up(rows)
+        old_anchors = self.tables['anchor_points'][rows]
+        for name, gradient in gradients.items():
+            if name not in self.tables:
+                continue
+            index = slice(None) if name == 'bias' else rows
+            if self.optimizer == 'adagrad':
+                self.accumulators[name][index] += np.square(gradient)
+                gradient = gradient / np.sqrt(self.accumulators[name][index])
+            self.tables[name][index] -= self.learning_rate * gradient
+        # the other rows of the anchors are scaled by the step of the norms, the partial norms follow all the rows
+        scale = 1 - 2 * self.learning_rate * np.asarray(gradients['anchor_norms'], dtype=np.float64).reshape([-1])
+        old_norms = np.sum(np.square(old_anchors, dtype=np.float64), 0)
+        new_norms = np.sum(np.square(self.tables['anchor_points'][rows], dtype=np.float64), 0)
+        self.anchor_norms = (self.anchor_norms - old_norms) * np.square(scale) + new_norms
+        self.anchor_scale *= scale
+        self.row_scale[rows] = self.anchor_scale
+        self.step += 1
+        self.last_seen[rows] = self.step
+        if not np.all((np.abs(self.anchor_scale) > 1e-6) & (np.abs(self.anchor_scale) < 1e6)):
+            self.fold()
+        return True
+
+    def handle(self, request):
+        method, args = request
+        return getattr(self, method)(*args)
+
+
+def serve(connection, shard_args):  # loop of a shard process
+    shard = Shard(*shard_args)
+    request = connection.recv()
+    while request is not None:
+        connection.send(shard.handle(request))
+        request = connection.recv()
+
+
+class LocalShard(object):  # a shard in the calling process
+    def __init__(self, *shard_args):
+        self.shard = Shard(*shard_args)
+        self.result = None
+
+    def request(self, method, *args):
+        self.result = self.shard.handle((method, args))
+
+    def receive(self):
+        return self.result
+
+    def close(self):
+        pass
+
+
+class ProcessShard(object):  # a shard in a worker process, requests and results go through a pipe
+    def __init__(self, *shard_args):
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve, args=(child, shard_args))
+        self.process.daemon = True
+        self.process.start()
+
+    def request(self, method, *args):
+        self.connection.send((method, args))
+
+    def receive(self):
+        return self.connection.recv()
+
+    def close(self):
+        self.connection.send(None)
+        self.process.join()
+
+
+class ParameterServer(object):
+    '''
+    :param features_M: No. of features
+    :param hidden_factor: K
+    :param anchor_points: A
+    :param num_shards: No. of shards the feature ids are partitioned across
+    :param processes: run every shard in its own process, False: in this process
+    :param optimizer: 'sgd' or 'adagrad', applied by the shards
+    '''
+
+    def __init__(self, features_M, hidden_factor, anchor_points, num_shards=1, processes=False, learning_rate=0.05,
+                 optimizer='adagrad', random_seed=2016):
+        self.features_M = features_M
+        self.hidden_factor = hidden_factor
+        self.anchor_points = anchor_points
+        self.num_shards = num_shards
+        shard_type = ProcessShard if processes else LocalShard
+        self.shards = [shard_type(len(xrange(shard, features_M, num_shards)), hidden_factor, anchor_points,
+                                  learning_rate, optimizer, shard == 0, random_seed + shard)
+                       for shard in range(num_shards)]
+        self.lock = threading.Lock()  # a request and its result are not interleaved with those of another thread
+
+    def partition(self, ids):  # for every shard: the positions in ids and the rows of its ids
+        shards = ids % self.num_shards
+        positions = [np.flatnonzero(shards == shard) for shard in range(self.num_shards)]
+        return [(position, ids[position] // self.num_shards) for position in positions]
+
+    def pull(self, ids):
+        '''
+        :param ids: unique feature ids
+        return: the rows of the tables for ids, their No. of steps since the last update ('gap'), the anchor norms
+        (1 * A) and the bias (1 * A)
+        '''
+        parts = self.partition(ids)
+        with self.lock:
+            for shard, (_, rows) in zip(self.shards, parts):
+                shard.request('pull', rows)
+            results = [shard.receive() for shard in self.shards]
+        pulled = {}
+        for name in TABLES + ['gap']:
+            pulled[name] = np.empty((ids.shape[0],) + results[0][name].shape[1:], dtype=results[0][name].dtype)
+            for (position, _), result in zip(parts, results):
+                pulled[name][position] = result[name]
+        pulled['anchor_norms'] = np.sum([result['anchor_norms'] for result in results], 0)[np.newaxis].astype(
+            np.float32)
+        pulled['bias'] = results[0]['bias']
+        return pulled
+
+    def push(self, ids, gradients):  # gradients of the rows of the unique ids, of the bias and of the anchor norms
+        parts = self.partition(ids)
+        with self.lock:
+            for index, (shard, (position, rows)) in enumerate(zip(self.shards, parts)):
+                shard_gradients = dict((name, gradients[name][position]) for name in TABLES)
+                shard_gradients['anchor_norms'] = gradients['anchor_norms']
+                if index == 0:
+                    shard_gradients['bias'] = gradients['bias']
+                shard.request('push', rows, shard_gradients)
+            for shard in self.shards:
+                shard.receive()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+class ShardedLLFM(LLFM):
+    '''LLFM whose weights are held by a ParameterServer
+    The graph computes the model on the rows pulled for the feature ids of a batch, fed in place of the weights. The
+    anchor norms are read from the server; their gradient, which involves every row of anchor_points, is applied to
+    the pulled rows and pushed to the shards, which scale the other rows with it. The regularizer of a pulled row is
+    scaled by its No. of steps since the last update.
+    :param server: the ParameterServer, it applies the gradients with its own optimizer and learning rate
+    '''
+
+    def __init__(self, server, loss_type, epoch, batch_size, lambda_bilinear, keep, verbose, random_seed=2016,
+                 eval_batch_size=10000, drop_last=True, prefetch=2, async_workers=0):
+        self.server = server
+        LLFM.__init__(self, server.features_M, 0, None, server.hidden_factor, server.anchor_points, loss_type, epoch,
+                      batch_size, None, lambda_bilinear, keep, None, 0, verbose, random_seed,
+                      eval_batch_size=eval_batch_size, drop_last=drop_last, prefetch=prefetch,
+                      async_workers=async_workers)
+
+    def _init_graph(self):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.set_random_seed(self.random_seed)
+            # the columns of the features are the positions of the feature ids of the batch in the pulled rows
+            self.train_features = tf.sparse_placeholder(tf.float32, shape=[None, None])  # None * U
+            self.train_labels = tf.placeholder(tf.float32, shape=[None, 1])  # None * 1
+            self.dropout_keep = tf.placeholder(tf.float32)
+            self.train_phase = tf.placeholder(tf.bool)
+            self.train_steps = None  # no checkpoints, the dropout masks are those of tf.nn.dropout
+            self.weights = {
+                'feature_embeddings': tf.placeholder(tf.float32, [None, self.hidden_factor, self.anchor_points]),
+                'feature_bias': tf.placeholder(tf.float32, [None, self.anchor_points]),  # U * A
+                'anchor_points': tf.placeholder(tf.float32, [None, self.anchor_points]),  # U * A
+                'anchor_norms': tf.placeholder(tf.float32, [1, self.anchor_points]),
+                'bias': tf.placeholder(tf.float32, [1, self.anchor_points])}
+            self.row_gap = tf.placeholder(tf.float32, [None])  # U, No. of steps since the last update of the rows
+
+            self.out, self.loss = self._forward(self.train_features, self.train_labels)
+            if self.lambda_bilinear > 0:  # regulizer of the pulled rows, for all the steps they missed
+                rows = tf.reshape(self.weights['feature_embeddings'], [-1, self.hidden_factor * self.anchor_points])
+                self.loss = self.loss + self.lambda_bilinear * 0.5 * tf.reduce_sum(
+                    self.row_gap * tf.reduce_sum(tf.square(rows), 1))
+            names = TABLES + ['anchor_norms', 'bias']
+            self.gradients = dict(zip(names, tf.gradients(self.loss, [self.weights[name] for name in names])))
+            self.sess = tf.Session()
+
+    def pull(self, X):  # feed_dict of the pulled rows, the features of X remapped to them, and the ids
+        ids, columns = np.unique(X.indices[:, 1], return_inverse=True)
+        pulled = self.server.pull(ids)
+        feed_dict = {self.row_gap: pulled.pop('gap')}
+        feed_dict.update((self.weights[name], pulled[name]) for name in pulled)
+        feed_dict[self.train_features] = tf.SparseTensorValue(np.stack([X.indices[:, 0], columns], 1), X.values,
+                                                              (X.dense_shape[0], ids.shape[0]))
+        return feed_dict, ids
+
+    def partial_fit(self, data):  # fit a batch
+        feed_dict, ids = self.pull(data['X'])
+        feed_dict.update({self.train_labels: data['Y'], self.dropout_keep: self.keep, self.train_phase: True})
+        loss, gradients = self.sess.run((self.loss, self.gradients), feed_dict=feed_dict)
+        # d anchor_norms / d anchor_points = 2 * anchor_points, on the pulled rows; the shards scale the others
+        gradients['anchor_points'] += 2 * gradients['anchor_norms'] * feed_dict[self.weights['anchor_points']]
+        self.server.push(ids, gradients)
+        return loss
+
+    def predict_batch(self, X, Y):
+        feed_dict, _ = self.pull(X)
+        feed_dict.update({self.train_labels: Y[:, np.newaxis], self.dropout_keep: 1.0, self.train_phase: False})
+        return self.sess.run((self.out), feed_dict=feed_dict)
+
+    def get_weights(self):  # all the rows of the server
+        pulled = self.server.pull(np.arange(self.features_M))
+        del pulled['anchor_norms'], pulled['gap']
+        return pulled
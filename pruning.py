@@ -0,0 +1,74 @@
+'''
+Frequency-based pruning of the feature ids.
+
+The features seen fewer than min_count times in the training set, or beyond the max_features most frequent ones, are
+not given their own row in the model: they share oov_buckets out-of-vocabulary rows, picked by a hash of the feature,
+or are dropped when oov_buckets is 0. The kept features keep their relative order and are numbered first, the OOV rows
+follow them, so features_M = No. of kept features + oov_buckets.
+
+LoadData prunes its Vocabulary (Vocabulary.prune), LoadData_nonsparse remaps the raw ids with an IdRemap.
+
+'''
+import numpy as np
+from featurehash import mix64
+
+
+def select_features(counts, min_count=1, max_features=0):
+    '''ids of the kept features, ascending
+    :param counts: No. of occurrences of every feature id in the training set
+    :param min_count: features seen fewer times are pruned
+    :param max_features: keep at most the max_features most frequent features (ties go to the smaller id), 0: no cap
+    '''
+    kept = np.flatnonzero(counts >= max(min_count, 1))
+    if 0 < max_features < kept.shape[0]:
+        kept = np.sort(kept[np.argsort(-counts[kept], kind='mergesort')[:max_features]])
+    return kept
+
+
+def oov_rows(keys, num_kept, oov_buckets):  # rows of the OOV features of 64-bit keys (ids, or token_ids)
+    return num_kept + (mix64(keys) % np.uint64(oov_buckets)).astype(np.int64)
+
+
+def drop_missing(row_nnz, indices, values=None):  # remove the entries of id -1, the row lengths follow
+    found = indices >= 0
+    if np.all(found):
+        return row_nnz, indices, values
+    rows = np.repeat(np.arange(row_nnz.shape[0]), row_nnz)
+    row_nnz = np.bincount(rows[found], minlength=row_nnz.shape[0]).astype(np.int64)
+    return row_nnz, indices[found], values[found] if values is not None else None
+
+
+def report(counts, kept, oov_buckets):  # print the pruning statistics of the training counts
+    seen = np.count_nonzero(counts)
+    covered = float(np.sum(counts[kept])) / max(np.sum(counts), 1)
+    print("pruning: %d of %d training features kept (+%d OOV rows), %.1f%% of the rows of the tables, "
+          "%.2f%% of the training entries remapped to %s"
+          % (kept.shape[0], seen, oov_buckets, 100.0 * (kept.shape[0] + oov_buckets) / max(counts.shape[0], 1),
+             100 * (1 - covered), 'OOV rows' if oov_buckets > 0 else 'nothing (dropped)'))
+
+
+class IdRemap(object):
+    '''
+    :param kept: raw ids of the kept features, ascending
+    :param oov_buckets: No. of OOV rows, 0: the other features are dropped
+    '''
+
+    def __init__(self, kept, oov_buckets=1):
+        self.kept = np.asarray(kept, dtype=np.int64)
+        self.oov_buckets = oov_buckets
+        self.features_M = self.kept.shape[0] + oov_buckets
+
+    def map(self, ids):  # new ids of raw ids, -1 for the dropped features
+        ids = np.asarray(ids, dtype=np.int64)
+        if self.kept.shape[0] == 0:
+            position, found = np.zeros_like(ids), np.zeros(ids.shape, dtype=bool)
+        else:
+            position = np.minimum(np.searchsorted(self.kept, ids), self.kept.shape[0] - 1)
+            found = self.kept[position] == ids
+        mapped = np.where(found, position, -1)
+        if self.oov_buckets > 0:
+            mapped[~found] = oov_rows(ids[~found], self.kept.shape[0], self.oov_buckets)
+        return mapped
+
+    def transform(self, row_nnz, indices, values):  # remapped CSR entries of a block
+        return drop_missing(row_nnz, self.map(indices), values)
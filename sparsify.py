@@ -1,32 +1,111 @@
 import numpy as np
-import tensorflow as tf
 
 
-def sparse_concat(input_list, features_M):
-    data_shape = (len(input_list), features_M)
-    indices = []
-    values = []
+def index_dtype(features_M):  # smallest integer type of the feature ids
+    return np.int32 if features_M <= np.iinfo(np.int32).max else np.int64
+
+
+class CSRDataset(object):
+    '''rows of a [None, features_M] sparse matrix kept in CSR arrays
+    indptr: row i holds the entries indptr[i]:indptr[i + 1] of indices and values
+    indices: feature ids of the nonzero entries
+    values: feature values of the nonzero entries
+    The compact form (int32 ids and float32 values, 8 bytes per nonzero) is the one the loaders keep, dense arrays and
+    SparseTensorValues are built from it on demand.
+    '''
+
+    def __init__(self, indptr, indices, values, features_M):
+        self.indptr = indptr
+        self.indices = indices
+        self.values = values
+        self.features_M = features_M
+
+    def __len__(self):
+        return self.indptr.shape[0] - 1
+
+    def rows(self, start, stop):  # rows start:stop, indices and values are views of this dataset
+        begin, end = self.indptr[start], self.indptr[stop]
+        return CSRDataset(self.indptr[start:stop + 1] - begin, self.indices[begin:end], self.values[begin:end],
+                          self.features_M)
+
+    def take(self, index):  # rows given by an index array, in the order of index
+        index = np.asarray(index)
+        lengths = self.indptr[index + 1] - self.indptr[index]
+        indptr = np.zeros([index.shape[0] + 1], dtype=self.indptr.dtype)
+        np.cumsum(lengths, out=indptr[1:])
+        positions = np.arange(indptr[-1]) + np.repeat(self.indptr[index] - indptr[:-1], lengths)
+        return CSRDataset(indptr, self.indices[positions], self.values[positions], self.features_M)
+
+    def compact(self):  # the dataset with int32 (or int64) indices and float32 values, arrays of these types are kept
+        return CSRDataset(self.indptr.astype(np.int64, copy=False),
+                          self.indices.astype(index_dtype(self.features_M), copy=False),
+                          self.values.astype(np.float32, copy=False), self.features_M)
+
+    def nbytes(self):  # memory of the arrays
+        return self.indptr.nbytes + self.indices.nbytes + self.values.nbytes
+
+    def coo(self):  # [nnz, 2] (row, feature id) indices and the values of the nonzero entries
+        rows = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        return np.stack([rows, self.indices], axis=1), self.values
+
+    def dot(self, dense):  # [None, features_M] x [features_M, N] product, as a [None, N] float64 array
+        products = self.values[:, np.newaxis].astype(np.float64) * dense[self.indices]  # nnz * N
+        return row_sums(products, self.indptr)
 
-    i = 0
-    for item in input_list:
-        values.extend(item['values'])
-        item_indices = i * np.ones([len(item['indices']), 2], dtype=np.int32)
-        item_indices[:, 1] = item['indices']
-        indices.extend(item_indices.tolist())
-        i = i + 1
+    def square_norms(self):  # squared L2 norm of every row
+        return row_sums(np.square(self.values, dtype=np.float64), self.indptr)
 
-    return tf.SparseTensorValue(indices, values, data_shape)
+    def to_dense(self):
+        dense = np.zeros([len(self), self.features_M], dtype=np.float32)
+        dense[np.repeat(np.arange(len(self)), np.diff(self.indptr)), self.indices] = self.values
+        return dense
+
+    def to_sparse_tensor(self):
+        import tensorflow as tf  # imported on use, the numpy inference reads CSRDatasets without tensorflow
+        indices, values = self.coo()
+        return tf.SparseTensorValue(indices, values, (len(self), self.features_M))
+
+    def to_list(self):  # one {'indices', 'values'} dictionary per row
+        indices = self.indices.tolist()
+        values = self.values.tolist()
+        return [{'indices': indices[start:end], 'values': values[start:end]}
+                for start, end in zip(self.indptr[:-1], self.indptr[1:])]
+
+
+def row_sums(entries, indptr):  # sum the entries of every row, empty rows sum to 0
+    sums = np.zeros((indptr.shape[0] - 1,) + entries.shape[1:])
+    if entries.shape[0] > 0:
+        sums = np.add.reduceat(entries, np.minimum(indptr[:-1], entries.shape[0] - 1), axis=0)
+        sums[indptr[:-1] == indptr[1:]] = 0
+    return sums
+
+
+def csr_from_lists(rows, features_M):  # CSRDataset of lists of feature ids, the values are 1
+    indptr = np.zeros([len(rows) + 1], dtype=np.int64)
+    np.cumsum([len(ids) for ids in rows], out=indptr[1:])
+    indices = np.fromiter((id for ids in rows for id in ids), dtype=np.int64, count=indptr[-1])
+    return CSRDataset(indptr, indices, np.ones(indices.shape, dtype=np.float32), features_M)
+
+
+def csr_concat(datasets):  # stack the rows of several CSRDatasets
+    indptr = [np.zeros([1], dtype=np.int64)]
+    for dataset in datasets:
+        indptr.append(dataset.indptr[1:] + indptr[-1][-1])
+    return CSRDataset(np.concatenate(indptr), np.concatenate([dataset.indices for dataset in datasets]),
+                      np.concatenate([dataset.values for dataset in datasets]), datasets[0].features_M)
+
+
+def sparse_concat(input_list, features_M):
+    indptr = np.zeros([len(input_list) + 1], dtype=np.int64)
+    np.cumsum([len(item['indices']) for item in input_list], out=indptr[1:])
+    indices = np.fromiter((key for item in input_list for key in item['indices']), dtype=np.int64, count=indptr[-1])
+    values = np.fromiter((value for item in input_list for value in item['values']), dtype=np.float32,
+                         count=indptr[-1])
+    return CSRDataset(indptr, indices, values, features_M).to_sparse_tensor()
 
 
 def sparsify(input_data):
-    sparse_list = []
-    for i in range(input_data.shape[0]):
-        indices = []
-        values = []
-        for j in range(input_data.shape[1]):
-            if input_data[i, j] >= 0.0001 or input_data[i, j] <= -0.0001:
-                indices.append(j)
-                values.append(input_data[i, j])
-        sparse_list.append({'indices': indices, 'values': values})
-
-    return sparse_list
+    rows, columns = np.nonzero(np.abs(input_data) >= 0.0001)
+    indptr = np.zeros([input_data.shape[0] + 1], dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=input_data.shape[0]), out=indptr[1:])
+    return CSRDataset(indptr, columns, input_data[rows, columns], input_data.shape[1]).compact()
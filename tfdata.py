@@ -0,0 +1,196 @@
+'''
+tf.data input pipeline for the FM and LLFM models.
+
+A TFDataSplit is a split of a dataset read through tf.data instead of feed_dict: libFM files are parsed in the graph
+(string_split, num_parallel_calls parallel batches) and in-memory or memory-mapped CSR shards (the binary cache) are
+sliced in a background generator. The batches are prefetched and read by the models from an iterator whose outputs
+replace their placeholders, feeding the placeholders still works.
+
+A batch is SPARSE_STRUCTURE (indices, values, dense_shape, labels of a [None, features_M] SparseTensor), or
+IDS_STRUCTURE for FM.py (a [None, length] matrix of feature ids, rows of a batch have the same length).
+
+'''
+import numpy as np
+import tensorflow as tf
+import minibatch
+from LoadData_nonsparse import LibFMStream
+from sparsify import csr_from_lists
+
+SPARSE_STRUCTURE = ((tf.int64, tf.float32, tf.int64, tf.float32),
+                    (tf.TensorShape([None, 2]), tf.TensorShape([None]), tf.TensorShape([2]), tf.TensorShape([None])))
+IDS_STRUCTURE = ((tf.int32, tf.float32), (tf.TensorShape([None, None]), tf.TensorShape([None])))
+SEED_STRIDE = 1000003  # the shuffle seed of epoch e is random_seed + SEED_STRIDE * e
+
+
+class TFDataSplit(object):
+    '''
+    :param sources: libFM file paths, or (labels, CSRDataset) shards
+    :param features_M: No. of features
+    :param loss_type: labels > 0 are 1 and others 0 for log_loss
+    :param ids: batches of IDS_STRUCTURE instead of SPARSE_STRUCTURE
+    :param vocab: vocab.Vocabulary of the libFM entries (FM.py), None: the entries are id:value pairs
+    :param hasher: FeatureHasher of the loader, the entries (or ids) of the files are hashed instead of looked up in
+    vocab. The hash, and the OOV rows of a pruned vocab, run in a py_func so that they are the same as the loader's
+    :param remap: pruning.IdRemap of LoadData_nonsparse, the raw ids of the files are remapped to the kept and OOV
+    rows in the same py_func (ids dropped by the remap are removed from their rows)
+    :param shuffle_buffer: No. of lines shuffled together when reading files
+    :param num_parallel_calls: No. of batches parsed in parallel
+    :param prefetch: No. of batches prepared ahead
+    '''
+
+    def __init__(self, sources, features_M, loss_type, ids=False, vocab=None, shuffle_buffer=100000,
+                 num_parallel_calls=4, prefetch=2, random_seed=2016, hasher=None, remap=None):
+        self.sources = sources
+        self.from_files = all(isinstance(source, str) for source in sources)
+        self.features_M = features_M
+        self.loss_type = loss_type
+        self.ids = ids
+        self.vocab = vocab
+        self.hasher = hasher
+        self.remap = remap
+        self.shuffle_buffer = shuffle_buffer
+        self.num_parallel_calls = num_parallel_calls
+        self.prefetch = prefetch
+        self.random_seed = random_seed
+        self.y_min, self.y_max = None, None
+
+    def label_range(self):  # smallest and largest label, after the log_loss mapping
+        if self.y_min is None:
+            if self.from_files:
+                labels = []
+                for file in self.sources:
+                    with open(file) as f:
+                        labels.extend(float(line.split(' ', 1)[0]) for line in f if line.strip())
+            else:
+                labels = np.concatenate([source[0] for source in self.sources])
+            labels = self.labels(np.asarray(labels, dtype=np.float32))
+            self.y_min, self.y_max = np.min(labels), np.max(labels)
+        return self.y_min, self.y_max
+
+    def labels(self, labels):  # labels of a numpy array or a tensor
+        if self.loss_type == 'log_loss':  # > 0 as 1; others as 0
+            if isinstance(labels, tf.Tensor):
+                return tf.cast(labels > 0, tf.float32)
+            return (labels > 0).astype(np.float32)
+        return labels
+
+    def dataset(self, batch_size, shuffle=False, drop_last=False, epoch=None):
+        '''the tf.data.Dataset of an epoch
+        :param epoch: int64 tensor of the No. of the epoch, fed when the iterator is initialized: the shuffle of the
+        lines of the files is seeded by it, so that an epoch of a resumed run reads them in the same order. None: a new
+        seed every time the iterator is initialized
+        '''
+        if self.from_files:
+            dataset = tf.data.TextLineDataset(self.sources).filter(
+                lambda line: tf.size(tf.string_split([line]).values) > 0)
+            if shuffle and epoch is not None:
+                dataset = dataset.shuffle(self.shuffle_buffer, seed=self.random_seed + SEED_STRIDE * epoch)
+            elif shuffle:
+                # a new shuffle seed every time the iterator is initialized, i.e. every epoch
+                dataset = dataset.shuffle(self.shuffle_buffer, seed=tf.random_uniform(
+                    [], maxval=1 << 62, dtype=tf.int64, seed=self.random_seed))
+            if self.ids:
+                if self.hasher is not None or self.vocab.oov_buckets > 0:
+                    dataset = dataset.map(self.parse_mapped_ids, num_parallel_calls=self.num_parallel_calls)
+                else:
+                    table = tf.contrib.lookup.HashTable(tf.contrib.lookup.KeyValueTensorInitializer(
+                        self.vocab.keys, self.vocab.ids.astype(np.int32), tf.string, tf.int32), -1)
+                    dataset = dataset.map(lambda line: self.parse_ids(line, table),
+                                          num_parallel_calls=self.num_parallel_calls)
+                # rows of a batch fed to the embedding lookup must have the same No. of features
+                dataset = dataset.apply(tf.contrib.data.group_by_window(
+                    lambda ids, labels: tf.cast(tf.size(ids), tf.int64),
+                    lambda length, rows: rows.batch(batch_size), batch_size))
+                if drop_last:
+                    dataset = dataset.filter(lambda ids, labels: tf.equal(tf.shape(ids)[0], batch_size))
+            else:
+                dataset = dataset.batch(batch_size)
+                if drop_last:
+                    dataset = dataset.filter(lambda lines: tf.equal(tf.shape(lines)[0], batch_size))
+                dataset = dataset.map(self.parse_lines, num_parallel_calls=self.num_parallel_calls)
+        else:
+            structure = IDS_STRUCTURE if self.ids else SPARSE_STRUCTURE
+            dataset = tf.data.Dataset.from_generator(lambda: self.generate(batch_size, shuffle, drop_last),
+                                                     structure[0], structure[1])
+        return dataset.prefetch(self.prefetch)
+
+    def parse_lines(self, lines):  # SPARSE_STRUCTURE of a batch of libFM lines
+        tokens = tf.string_split(lines, ' ')
+        is_label = tf.equal(tokens.indices[:, 1], 0)
+        labels = tf.string_to_number(tf.boolean_mask(tokens.values, is_label), tf.float32)
+        entries = tf.reshape(tf.string_split(tf.boolean_mask(tokens.values, tf.logical_not(is_label)), ':').values,
+                             [-1, 2])  # id, value
+        rows = tf.boolean_mask(tokens.indices[:, 0], tf.logical_not(is_label))
+        ids = tf.string_to_number(entries[:, 0], tf.int64)
+        values = tf.string_to_number(entries[:, 1], tf.float32)
+        if self.hasher is not None or self.remap is not None:
+            rows, ids, values = tf.py_func(lambda rows, ids, values: [array.astype(dtype) for array, dtype in zip(
+                self.map_entries(rows, ids, values), [np.int64, np.int64, np.float32])], [rows, ids, values],
+                [tf.int64, tf.int64, tf.float32], stateful=False)
+            for tensor in [rows, ids, values]:
+                tensor.set_shape([None])
+        indices = tf.stack([rows, ids], 1)
+        dense_shape = tf.stack([tf.cast(tf.shape(lines)[0], tf.int64), tf.constant(self.features_M, tf.int64)])
+        return indices, values, dense_shape, self.labels(labels)
+
+    def map_entries(self, rows, ids, values):  # the entries of a batch hashed or remapped, as the loader does it
+        if self.hasher is not None:
+            ids, values = self.hasher.transform(ids, values)
+        if self.remap is not None:
+            ids = self.remap.map(ids)
+            found = ids >= 0  # dropped features (oov_buckets 0)
+            rows, ids, values = rows[found], ids[found], values[found]
+        return rows, ids, values
+
+    def parse_ids(self, line, table):  # IDS_STRUCTURE row of a libFM line, entries missing in vocab are skipped
+        tokens = tf.string_split([line], ' ').values
+        ids = table.lookup(tokens[1:])
+        return tf.boolean_mask(ids, ids >= 0), self.labels(tf.string_to_number(tokens[0], tf.float32))
+
+    def parse_mapped_ids(self, line):  # IDS_STRUCTURE row of a libFM line, the entries hashed or mapped to OOV rows
+        tokens = tf.string_split([line], ' ').values
+        ids = tf.py_func(lambda tokens: self.map_tokens(tokens).astype(np.int32), [tokens[1:]], tf.int32,
+                         stateful=False)
+        ids.set_shape([None])
+        return ids, self.labels(tf.string_to_number(tokens[0], tf.float32))
+
+    def map_tokens(self, tokens):  # feature ids of tokens, as the loader maps them
+        if self.hasher is not None:
+            return self.hasher.hash_tokens(tokens)[0]
+        return self.vocab.lookup(tokens)
+
+    def generate(self, batch_size, shuffle, drop_last):  # batches of the (labels, CSRDataset) shards
+        for labels, X_csr in self.sources:
+            labels = self.labels(np.asarray(labels, dtype=np.float32))
+            if self.ids:
+                lengths = np.diff(X_csr.indptr)
+                if shuffle:
+                    batches = minibatch.bucket_batches(lengths, batch_size, drop_last)
+                else:
+                    batches = minibatch.length_groups(lengths, batch_size)
+                for index in batches:
+                    yield X_csr.take(index).indices.reshape([index.shape[0], -1]).astype(np.int32), labels[index]
+            else:
+                if shuffle:
+                    batches = minibatch.epoch_batches(len(X_csr), batch_size, drop_last)
+                else:
+                    batches = (np.arange(start, min(start + batch_size, len(X_csr)))
+                               for start in xrange(0, len(X_csr), batch_size))
+                for index in batches:
+                    X_ = X_csr.take(index)
+                    indices, values = X_.coo()
+                    yield (indices.astype(np.int64), values.astype(np.float32),
+                           np.array([len(X_), self.features_M], dtype=np.int64), labels[index])
+
+
+def from_data(data, features_M, loss_type, ids=False, vocab=None, shuffle_buffer=100000, hasher=None, remap=None):
+    '''TFDataSplit of a split of LoadData or LoadData_nonsparse
+    A LibFMStream keeps its sources (files, or the shards of the binary cache), a dictionary is read from memory.
+    hasher and remap apply to the raw ids of libFM files only, the shards and dictionaries hold mapped ids already.
+    '''
+    if isinstance(data, LibFMStream):
+        sources = data.sources
+    else:
+        X_csr = data['X_csr'] if 'X_csr' in data else csr_from_lists(data['X'], features_M)
+        sources = [(np.asarray(data['Y']), X_csr)]
+    return TFDataSplit(sources, features_M, loss_type, ids, vocab, shuffle_buffer, hasher=hasher, remap=remap)
@@ -0,0 +1,120 @@
+'''
+Compact feature vocabulary of LoadData.
+
+The libFM entries of FM.py ("token" strings) are mapped to feature ids by a Vocabulary: the distinct tokens are kept
+in a sorted fixed-width byte array and their ids in an int64 array, so an entry costs its length plus 8 bytes instead
+of a dictionary slot and a string object. Tokens are added and looked up a whole block at a time (np.unique and
+np.searchsorted), the new tokens of a block are merged into the sorted keys without sorting them again. Ids follow the
+first appearance of the tokens, as the dictionary of LoadData did.
+
+A pruned Vocabulary (pruning.py) keeps the frequent tokens only; the other tokens are mapped to oov_buckets shared rows
+after the kept ones. A Vocabulary is saved to and loaded from a .npz file, with its OOV buckets, so that a model is
+served with the feature ids it was trained with.
+
+'''
+import numpy as np
+from featurehash import token_ids
+from pruning import oov_rows, select_features
+
+WHITESPACE = np.array([ord(c) for c in ' \t\n\r\x0b\x0c'], dtype=np.uint8)  # the separators of str.split()
+
+
+def tokenize_block(block):
+    '''split a block of complete libFM lines into tokens with bulk numpy operations on its bytes
+    A token runs from a byte after a separator to a byte before one, the tokens are gathered into a fixed-width
+    byte-string array and counted per line. The array is filled one byte column at a time, so no temporary grows with
+    the width.
+    return: labels, number of entries of each line, entries (byte-string array); lines without a token are skipped
+    '''
+    buf = np.frombuffer(block, dtype=np.uint8)
+    line_ends = np.flatnonzero(buf == ord('\n')) + 1
+    bounds = np.concatenate([[0], line_ends, [buf.shape[0]]])
+    visible = np.concatenate([[False], ~np.in1d(buf, WHITESPACE), [False]])
+    starts = np.flatnonzero(visible[1:-1] & ~visible[:-2])  # first byte of every token
+    ends = np.flatnonzero(visible[1:-1] & ~visible[2:]) + 1  # past its last byte
+    row_tokens = np.diff(np.searchsorted(starts, bounds))
+    row_tokens = row_tokens[row_tokens > 0]
+    lengths = ends - starts
+    width = max(np.max(lengths) if lengths.shape[0] > 0 else 0, 1)
+    chars = np.empty([lengths.shape[0], width], dtype=np.uint8)
+    for offset in range(width):
+        chars[:, offset] = buf[np.minimum(starts + offset, buf.shape[0] - 1)]
+        chars[lengths <= offset, offset] = 0
+    tokens = chars.view('S%d' % width).ravel()  # the padding zero bytes are not part of the tokens
+    is_label = np.zeros(tokens.shape[0], dtype=bool)
+    is_label[np.cumsum(row_tokens) - row_tokens] = True
+    return tokens[is_label].astype(np.float64), row_tokens - 1, tokens[~is_label]
+
+
+class Vocabulary(object):
+    '''
+    :param tokens: tokens added in order, None: empty
+    :param oov_buckets: No. of rows shared by the tokens missing in the vocabulary, 0: missing tokens have no id
+    '''
+
+    def __init__(self, tokens=None, oov_buckets=0):
+        self.keys = np.array([], dtype=np.string_)  # distinct tokens, sorted
+        self.ids = np.array([], dtype=np.int64)  # feature id of every key
+        self.oov_buckets = oov_buckets
+        if tokens is not None:
+            self.update(tokens)
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def find(self, tokens):  # feature ids of an array of tokens, -1 for the tokens missing in the vocabulary
+        tokens = np.asarray(tokens, dtype=np.string_)
+        if len(self) == 0:
+            return np.full(tokens.shape, -1, dtype=np.int64)
+        position = np.minimum(np.searchsorted(self.keys, tokens), len(self) - 1)
+        return np.where(self.keys[position] == tokens, self.ids[position], -1)
+
+    def lookup(self, tokens):  # feature ids of an array of tokens, the missing tokens get their OOV row (or -1)
+        ids = self.find(tokens)
+        if self.oov_buckets > 0:
+            missing = ids < 0
+            ids[missing] = oov_rows(token_ids(np.asarray(tokens)[missing]), len(self), self.oov_buckets)
+        return ids
+
+    def update(self, tokens):  # add the new tokens of an array, numbered in the order of their first appearance
+        unique, first = np.unique(np.asarray(tokens, dtype=np.string_), return_index=True)
+        new = self.find(unique) < 0
+        unique, first = unique[new], first[new]
+        if unique.shape[0] == 0:
+            return
+        ids = np.empty(unique.shape[0], dtype=np.int64)
+        ids[np.argsort(first, kind='mergesort')] = np.arange(len(self), len(self) + unique.shape[0])
+        # unique is sorted: merged at their positions in keys, the keys stay sorted
+        position = np.searchsorted(self.keys, unique)
+        if unique.dtype.itemsize > self.keys.dtype.itemsize:  # the fixed width of the keys grows to the new tokens
+            self.keys = self.keys.astype(unique.dtype)
+        self.keys = np.insert(self.keys, position, unique)
+        self.ids = np.insert(self.ids, position, ids)
+
+    def tokens(self):  # the tokens ordered by feature id
+        return self.keys[np.argsort(self.ids)]
+
+    def counts(self, tokens):  # No. of occurrences of every feature id in an array of tokens
+        ids = self.find(tokens)
+        return np.bincount(ids[ids >= 0], minlength=len(self))
+
+    def prune(self, counts, min_count=1, max_features=0, oov_buckets=1):
+        '''the Vocabulary of the kept tokens (pruning.select_features), in the order of their ids
+        :param counts: No. of occurrences of every feature id in the training set
+        return: the pruned Vocabulary, ids of the kept tokens in this one
+        '''
+        kept = select_features(counts, min_count, max_features)
+        return Vocabulary(self.tokens()[kept], oov_buckets), kept
+
+    def save(self, file):
+        with open(file, 'wb') as f:
+            np.savez(f, keys=self.keys, ids=self.ids, oov_buckets=self.oov_buckets)
+
+    @staticmethod
+    def load(file):
+        vocabulary = Vocabulary()
+        with np.load(file) as arrays:
+            vocabulary.keys, vocabulary.ids = arrays['keys'], arrays['ids']
+            if 'oov_buckets' in arrays.files:
+                vocabulary.oov_buckets = int(arrays['oov_buckets'])
+        return vocabulary
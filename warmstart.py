@@ -0,0 +1,88 @@
+'''
+Warm start of LLFM.
+
+LLFM draws its embeddings from tf.random_normal and its anchors from tf.random_uniform, so its first epochs are spent
+learning what an FM already knows, around anchors which are about equally far from every sample (random points of
+[0, 1) ** features_M). Two initializations replace them:
+
+from_fm() gives every anchor the weights of a trained FM (FM_nonsparse.py, whose feature ids are those of LLFM): the
+embeddings, linear weights and bias are tiled over the A anchors. The coefficients of a sample sum to 1, so the LLFM
+starts out as the FM (batch norm aside) and only has to learn how the anchors differ; a little noise on the
+embeddings breaks the tie between the anchors.
+
+kmeans_anchors() places the anchors at the centroids of mini-batch k-means (Sculley, 2010) over the training rows, so
+that each anchor stands for a region of the data.
+
+The weights are given to LLFM.set_weights, in the layout of LLFM.get_weights.
+
+'''
+import numpy as np
+from sparsify import csr_concat
+
+
+def load_fm(file):  # weights of an FM exported by inference.export (FM_nonsparse.py --export)
+    with np.load(file) as arrays:
+        if str(arrays['model']) != 'FM':
+            raise ValueError('%s is not an exported FM model' % file)
+        if 'bn_moving_mean' in arrays.files:
+            print("Warm start: the batch norm of %s is not carried over to LLFM" % file)
+        return dict((name, arrays[name]) for name in ['feature_embeddings', 'feature_bias', 'bias'])
+
+
+def from_fm(fm_weights, anchor_points, noise=0.0, random_seed=2016):
+    '''LLFM weights with every anchor set to the weights of an FM
+    :param fm_weights: 'feature_embeddings' (features_M * K), 'feature_bias' (features_M * 1) and 'bias' of an FM, as
+    FM.get_weights or load_fm give them
+    :param noise: standard deviation of the gaussian noise added to the embeddings of each anchor
+    return: 'feature_embeddings' (features_M * K * A), 'feature_bias' (features_M * A), 'bias' (1 * A)
+    '''
+    embeddings = np.repeat(np.asarray(fm_weights['feature_embeddings'])[:, :, np.newaxis], anchor_points, 2)
+    if noise > 0:
+        embeddings = embeddings + np.random.RandomState(random_seed).normal(0.0, noise, embeddings.shape)
+    feature_bias = np.repeat(np.reshape(fm_weights['feature_bias'], [-1, 1]), anchor_points, 1)
+    bias = np.full([1, anchor_points], float(fm_weights['bias']))
+    return {'feature_embeddings': embeddings.astype(np.float32), 'feature_bias': feature_bias.astype(np.float32),
+            'bias': bias.astype(np.float32)}
+
+
+def nearest(X, centroids):  # nearest centroid (A * features_M) of every row of a CSRDataset
+    return np.argmin(np.sum(np.square(centroids), 1) - 2 * X.dot(centroids.T), 1)
+
+
+def kmeans_anchors(X_csr, anchor_points, batch_size=1024, iterations=100, random_seed=2016):
+    '''anchors at the centroids of mini-batch k-means over the rows of a CSRDataset
+    The centroids start at random rows. Every iteration assigns a random batch of rows to their nearest centroids and
+    moves each centroid towards the mean of its rows by (rows of the batch) / (rows assigned so far), the per-center
+    learning rate of mini-batch k-means.
+    return: anchor_points (features_M * A)
+    '''
+    random_state = np.random.RandomState(random_seed)
+    num_rows = len(X_csr)
+    centroids = X_csr.take(random_state.choice(num_rows, anchor_points, replace=num_rows < anchor_points)).to_dense()
+    centroids = centroids.astype(np.float64)  # A * features_M
+    counts = np.zeros([anchor_points])
+    for _ in range(iterations):
+        X_ = X_csr.take(random_state.choice(num_rows, min(batch_size, num_rows), replace=False))
+        assignment = nearest(X_, centroids)
+        batch_counts = np.bincount(assignment, minlength=anchor_points)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, (np.repeat(assignment, np.diff(X_.indptr)), X_.indices), X_.values)
+        counts += batch_counts
+        filled = batch_counts > 0
+        step = (batch_counts[filled] / counts[filled])[:, np.newaxis]
+        centroids[filled] += step * (sums[filled] / batch_counts[filled, np.newaxis] - centroids[filled])
+    return centroids.T.astype(np.float32)
+
+
+def sample_rows(data, max_rows=1000000):
+    '''CSRDataset of the training rows k-means runs on: those of an in-memory split, or the first max_rows rows of a
+    LibFMStream'''
+    if isinstance(data, dict):
+        return data['X_csr']
+    chunks, num_rows = [], 0
+    for labels, X_csr in data.read_chunks():
+        chunks.append(X_csr)
+        num_rows += len(X_csr)
+        if num_rows >= max_rows:
+            break
+    return csr_concat(chunks).rows(0, min(num_rows, max_rows))